@@ -0,0 +1,82 @@
+"""
+Measure how many requests a second a broker forwards between a client
+and an echo worker, for a range of payload sizes, with and without
+zero copy forwarding.
+
+usage: python benchmarks/broker_throughput.py [requests] [window]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+import zmq
+
+from xodb.net.broker import Broker
+
+SIZES = (100, 1000, 10000, 100000, 1000000)
+
+
+def echo_worker(context, worker_url):
+    """Answer every request with its own payload."""
+    socket = context.socket(zmq.DEALER)
+    socket.connect(worker_url)
+    socket.send_multipart(['', 'READY', 'echo', '1'])
+    while True:
+        frames = socket.recv_multipart(copy=False)
+        client, request = frames[1], frames[2:]
+        socket.send_multipart(['', 'echo', client, ''] + request, copy=False)
+
+
+def run(directory, zero_copy, size, requests, window):
+    url = 'ipc://%s/%%s-%s-%s' % (directory, int(zero_copy), size)
+    broker = Broker(url % 'workers', url % 'clients', url % 'events')
+    broker.zero_copy = zero_copy
+    thread = threading.Thread(target=broker.run)
+    thread.daemon = True
+    thread.start()
+
+    context = zmq.Context()
+    thread = threading.Thread(target=echo_worker,
+                              args=(context, url % 'workers'))
+    thread.daemon = True
+    thread.start()
+
+    client = context.socket(zmq.DEALER)
+    client.connect(url % 'clients')
+    payload = os.urandom(size)
+    # one round trip to make sure the worker is registered
+    client.send_multipart(['', payload])
+    client.recv_multipart()
+
+    start = time.time()
+    sent = received = 0
+    while received < requests:
+        while sent < requests and sent - received < window:
+            client.send_multipart(['', payload], copy=False)
+            sent += 1
+        client.recv_multipart(copy=False)
+        received += 1
+    return time.time() - start
+
+
+def main(requests=10000, window=100):
+    directory = tempfile.mkdtemp()
+    try:
+        print '%10s %10s %12s %10s' % ('size', 'zero copy', 'requests/s',
+                                        'MB/s')
+        for size in SIZES:
+            count = max(100, requests * 1000 / max(size, 1000))
+            for zero_copy in (False, True):
+                elapsed = run(directory, zero_copy, size, count, window)
+                print '%10d %10s %12.0f %10.1f' % (
+                    size, zero_copy, count / elapsed,
+                    count * size * 2 / elapsed / 1e6)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
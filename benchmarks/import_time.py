@@ -0,0 +1,39 @@
+"""
+Measure how long it takes a fresh interpreter to import xodb, and how
+long the first stopword lookup for a language costs afterwards.
+
+usage: python benchmarks/import_time.py [runs]
+"""
+import sys
+import subprocess
+
+SNIPPET = """
+import time
+start = time.time()
+import xodb
+imported = time.time()
+from xodb import snowball
+snowball.stoppers['en']
+stopped = time.time()
+print imported - start, stopped - imported
+"""
+
+
+def main(runs=20):
+    imports = []
+    stoppers = []
+    for i in xrange(runs):
+        out = subprocess.check_output([sys.executable, '-c', SNIPPET])
+        imported, stopped = out.split()
+        imports.append(float(imported))
+        stoppers.append(float(stopped))
+    imports.sort()
+    stoppers.sort()
+    print "import xodb:      min %.2fms  median %.2fms" % (
+        imports[0] * 1000, imports[len(imports) / 2] * 1000)
+    print "first 'en' stop:  min %.2fms  median %.2fms" % (
+        stoppers[0] * 1000, stoppers[len(stoppers) / 2] * 1000)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,119 @@
+"""
+Load test the prefork JSON-RPC server against a temporary database.
+
+Fills a database with documents, serves it with a PreforkServer and
+has a number of client processes send query and count requests over
+keep-alive connections, then prints the request rate and latencies.
+
+usage: python benchmarks/rpc_load.py [documents] [workers] [clients] [seconds]
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import httplib
+import tempfile
+import multiprocessing
+
+import xodb
+from xodb.tools.rpc import PreforkServer
+
+PORT = 27301
+
+WORDS = ('apple banana cherry grape lemon lime mango melon orange peach '
+         'pear plum berry kiwi fig date guava papaya quince apricot').split()
+
+
+class Fruit(object):
+
+    def __init__(self, name, text, size):
+        self.name = name
+        self.text = text
+        self.size = size
+
+
+class FruitSchema(xodb.Schema):
+    language = 'en'
+    name = xodb.String.using(facet=True)
+    text = xodb.Text
+    size = xodb.Integer
+
+
+def fill(path, documents):
+    db = xodb.open(path)
+    db.map(Fruit, FruitSchema)
+    for i in xrange(documents):
+        db.add(Fruit(random.choice(WORDS),
+                     ' '.join(random.sample(WORDS, 5)),
+                     i))
+    db.flush()
+    db.close()
+
+
+def call(connection, method, params):
+    connection.request('POST', '/', json.dumps(
+        dict(id=1, method=method, params=params)))
+    response = json.loads(connection.getresponse().read())
+    if response['error']:
+        raise Exception(response['error'])
+    return response['result']
+
+
+def client(seconds, latencies):
+    connection = httplib.HTTPConnection('localhost', PORT)
+    stop = time.time() + seconds
+    timings = []
+    while time.time() < stop:
+        word = random.choice(WORDS)
+        start = time.time()
+        if random.random() < 0.5:
+            call(connection, 'query', dict(query=word, limit=20))
+        else:
+            call(connection, 'count', [word])
+        timings.append(time.time() - start)
+    latencies.put(timings)
+
+
+def main(documents=10000, workers=4, clients=8, seconds=10):
+    path = tempfile.mkdtemp()
+    try:
+        fill(path, documents)
+        server = PreforkServer(path, port=PORT, workers=workers)
+        pid = os.fork()
+        if not pid:
+            try:
+                server.run()
+            finally:
+                os._exit(0)
+        time.sleep(1)
+
+        latencies = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=client,
+                                             args=(seconds, latencies))
+                     for i in xrange(clients)]
+        for process in processes:
+            process.start()
+        timings = []
+        for process in processes:
+            timings.extend(latencies.get())
+        for process in processes:
+            process.join()
+
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+        timings.sort()
+        print '%s documents, %s workers, %s clients' % (
+            documents, workers, clients)
+        print 'requests/s: %.0f' % (len(timings) / float(seconds))
+        print 'latency:    median %.2fms  p95 %.2fms  p99 %.2fms' % tuple(
+            timings[int(len(timings) * p)] * 1000 for p in (.5, .95, .99))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,106 @@
+"""
+Measure how many queries a second xaql and xapian's QueryParser turn
+into xapian queries, for a set of typical queries.
+
+xaql is measured three ways: parsing and compiling every query from
+scratch, compiling cached expressions, and through Database.querify,
+which caches compiled queries.  QueryParser is measured with a parser
+prepared the way Database prepares them, with and without querify's
+query cache.
+
+usage: python benchmarks/xaql_parse.py [rounds]
+"""
+import sys
+import time
+import shutil
+import tempfile
+from datetime import date
+
+from xapian import Query
+
+import xodb
+from xodb import xaql
+
+QUERIES = (
+    'apple',
+    'apple banana cherry',
+    'name:apple',
+    'name:(apple OR lemon) text:pie',
+    'apple AND banana OR cherry -grape',
+    'text:"apple pie" size:10..500',
+    'name:apple size:..1000 picked:20100101..20101231',
+    'apple OR banana OR cherry OR grape OR lemon OR lime OR mango',
+    )
+
+
+class Fruit(object):
+
+    def __init__(self, name, text, size, picked):
+        self.name = name
+        self.text = text
+        self.size = size
+        self.picked = picked
+
+
+class FruitSchema(xodb.Schema):
+    language = 'en'
+    name = xodb.String.using(facet=True)
+    text = xodb.Text
+    size = xodb.Integer.using(sortable=True)
+    picked = xodb.Date.using(sortable=True)
+
+
+def rate(function, rounds):
+    start = time.time()
+    for i in xrange(rounds):
+        for query in QUERIES:
+            function(query)
+    return rounds * len(QUERIES) / (time.time() - start)
+
+
+def main(rounds=2000):
+    path = tempfile.mkdtemp()
+    try:
+        db = xodb.open(path)
+        db.map(Fruit, FruitSchema)
+        db.add(Fruit('apple', 'apple pie', 10, date(2010, 9, 9)))
+        db.flush()
+
+        parser = db.get_query_parser('en', Query.OP_AND,
+                                     check_cache=False)
+        flags = xodb.database.default_parser_flags
+
+        def uncached_xaql(query):
+            xaql.parse_cache.clear()
+            xaql.parse(query).compile(db, 'en')
+
+        def uncached_querify(query):
+            db.query_cache.clear()
+            db.querify(query, 'en')
+
+        def uncached_querify_xaql(query):
+            db.query_cache.clear()
+            db.querify(xaql.parse(query), 'en')
+
+        results = [
+            ('QueryParser', lambda query: parser.parse_query(
+                query.lower(), flags)),
+            ('xaql parse + compile', uncached_xaql),
+            ('xaql compile', lambda query: xaql.parse(query).compile(
+                db, 'en')),
+            ('querify', uncached_querify),
+            ('querify xaql', uncached_querify_xaql),
+            ('querify, cached', lambda query: db.querify(query, 'en')),
+            ('querify xaql, cached', lambda query: db.querify(
+                xaql.parse(query), 'en')),
+            ]
+        print '%-24s %12s' % ('', 'queries/s')
+        for name, function in results:
+            print '%-24s %12.0f' % (name, rate(function, rounds))
+        db.close()
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -33,6 +33,7 @@ setup(
         'translitcodec',
         'nose',
 	'pyzmq',
+        'futures',
         'nilsimsa',
         ],
   classifiers=[
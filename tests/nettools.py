@@ -0,0 +1,108 @@
+"""
+Helpers for driving a broker one loop at a time, with DEALER sockets
+in the broker's own zmq context standing in for its clients and
+workers.
+"""
+import itertools
+
+import zmq
+
+from xodb.net import envelope, stats
+from xodb.net.codec import get_codec
+
+codec = get_codec('pickle')
+
+_ids = itertools.count()
+
+
+def make_broker(broker_cls, worker_url=None, **options):
+    """Return a broker bound to inproc urls of its own context, ready
+    to be pumped."""
+    n = _ids.next()
+    broker = broker_cls(worker_url or 'inproc://test-workers-%s' % n,
+                        'inproc://test-clients-%s' % n,
+                        'inproc://test-events-%s' % n, **options)
+    for socket in (broker.backend, broker.frontend, broker.events):
+        broker.poller.register(socket, zmq.POLLIN)
+    return broker
+
+
+def close(broker):
+    broker.context.destroy(linger=0)
+
+
+def pump(broker, timeout=20):
+    """Run passes of the broker's loop until one finds nothing to
+    receive within *timeout* milliseconds."""
+    while True:
+        socks = dict(broker.poller.poll(timeout))
+        if socks.get(broker.events) == zmq.POLLIN:
+            broker.handle_event()
+        if socks.get(broker.backend) == zmq.POLLIN:
+            broker.handle_backend()
+        if socks.get(broker.frontend) == zmq.POLLIN:
+            broker.handle_frontend()
+        broker.handle_timers()
+        broker.housekeeping()
+        broker.dispatch_queued()
+        if not socks:
+            return
+
+
+def connect(broker, url, identity):
+    socket = broker.context.socket(zmq.DEALER)
+    socket.setsockopt(zmq.IDENTITY, identity)
+    socket.connect(url)
+    return socket
+
+
+def fake_client(broker, identity='client'):
+    return connect(broker, broker.client_url, identity)
+
+
+def fake_worker(broker, name, capacity=1):
+    """Return a fake worker that is registered with the broker."""
+    socket = connect(broker, broker.worker_url, name)
+    socket.send_multipart(['', 'READY', name, str(capacity)])
+    pump(broker)
+    return socket
+
+
+def request(socket, rid, method, *args, **options):
+    """Send a request from a fake client, with *options* for its
+    envelope."""
+    socket.send_multipart(['', rid, envelope.pack(**options),
+                           codec.dumps((method, args, {}))])
+
+
+def recv(socket, timeout=1000):
+    assert socket.poll(timeout), 'Nothing received'
+    return socket.recv_multipart()
+
+
+def idle(socket, timeout=50):
+    """Return True if nothing arrives on *socket* for a while."""
+    return not socket.poll(timeout)
+
+
+def reply(socket, name, message, result, failed=None):
+    """Answer a request *message* received by a fake worker."""
+    client, headers, payload = message[1], message[2:-1], message[-1]
+    if failed is None:
+        failed = isinstance(result, Exception)
+    socket.send_multipart(['', name, client, ''] + headers +
+                          [stats.pack_timing(codec.loads(payload)[0],
+                                             0.001, failed),
+                           codec.dumps(result)])
+
+
+def answer(message):
+    """Return the request id and result of a reply received by a fake
+    client."""
+    return message[1], codec.loads(message[-1])
+
+
+def called(message):
+    """Return the request id and the (method, args, kwargs) of a
+    request received by a fake worker."""
+    return message[2], codec.loads(message[-1])
@@ -0,0 +1,358 @@
+import time
+
+import zmq
+
+from xodb.net import envelope
+from xodb.net.broker import (
+    ZERO_COPY_THRESHOLD,
+    Broker,
+    OverloadError,
+    RequestTimeoutError,
+    )
+from xodb.net.worker import revision_event
+from tests.nettools import (
+    answer,
+    called,
+    close,
+    connect,
+    fake_client,
+    fake_worker,
+    idle,
+    make_broker,
+    pump,
+    recv,
+    reply,
+    request,
+    )
+
+
+def publish_revision(broker, revision):
+    """Announce a revision on the broker's events channel."""
+    events = broker.context.socket(zmq.PUB)
+    events.bind(broker.events_url)
+    try:
+        # subscriptions take a moment to reach a new publisher
+        deadline = time.time() + 1
+        while broker.revision != revision and time.time() < deadline:
+            events.send(revision_event('writer', revision))
+            pump(broker, 10)
+        assert broker.revision == revision
+    finally:
+        events.close()
+
+
+def test_coalesce():
+    broker = make_broker(Broker, coalesce=True)
+    try:
+        worker = fake_worker(broker, 'w1', capacity=2)
+        first, second = fake_client(broker, 'a'), fake_client(broker, 'b')
+
+        # identical requests in flight go to one worker
+        request(first, '1', 'count', 'x')
+        request(second, '2', 'count', 'x')
+        pump(broker)
+        message = recv(worker)
+        assert idle(worker)
+        assert broker.coalesce_counts['coalesced'] == 1
+
+        # and every client gets the reply
+        reply(worker, 'w1', message, 5)
+        pump(broker)
+        assert answer(recv(first)) == ('1', 5)
+        assert answer(recv(second)) == ('2', 5)
+        assert not broker.inflight
+
+        # requests that are no longer in flight are sent again
+        request(first, '3', 'count', 'x')
+        pump(broker)
+        assert called(recv(worker))[0] == '3'
+    finally:
+        close(broker)
+
+
+def test_coalesce_cancel():
+    broker = make_broker(Broker, coalesce=True)
+    try:
+        worker = fake_worker(broker, 'w1', capacity=2)
+        leader, follower = fake_client(broker, 'a'), fake_client(broker, 'b')
+        request(leader, '1', 'count', 'x')
+        pump(broker)
+        message = recv(worker)
+        request(follower, '2', 'count', 'x')
+        pump(broker)
+        assert broker.coalesce_counts['coalesced'] == 1
+
+        # cancelling the request a follower waits on only drops the
+        # cancelling client's reply
+        leader.send_multipart(['', '1', message[3], envelope.CANCEL])
+        pump(broker)
+        assert idle(worker)
+        reply(worker, 'w1', message, 5)
+        pump(broker)
+        assert answer(recv(follower)) == ('2', 5)
+        assert idle(leader)
+        assert not broker.dropped
+
+        # without followers the worker is told
+        request(leader, '3', 'count', 'y')
+        pump(broker)
+        message = recv(worker)
+        leader.send_multipart(['', '3', message[3], envelope.CANCEL])
+        pump(broker)
+        assert recv(worker)[-1] == envelope.CANCEL
+    finally:
+        close(broker)
+
+
+def test_cache():
+    broker = make_broker(Broker, cache_size=10)
+    try:
+        worker = fake_worker(broker, 'w1')
+        client = fake_client(broker)
+
+        request(client, '1', 'count', 'x')
+        pump(broker)
+        reply(worker, 'w1', recv(worker), 5)
+        pump(broker)
+        assert answer(recv(client)) == ('1', 5)
+
+        # a repeated request is answered from the cache
+        request(client, '2', 'count', 'x')
+        pump(broker)
+        assert answer(recv(client)) == ('2', 5)
+        assert idle(worker)
+        assert broker.coalesce_counts['cache_hits'] == 1
+
+        # until a writer announces a new revision
+        publish_revision(broker, 2)
+        request(client, '3', 'count', 'x')
+        pump(broker)
+        reply(worker, 'w1', recv(worker), 6)
+        pump(broker)
+        assert answer(recv(client)) == ('3', 6)
+        request(client, '4', 'count', 'x')
+        pump(broker)
+        assert answer(recv(client)) == ('4', 6)
+
+        # replies to requests sent before a revision are not cached
+        request(client, '5', 'count', 'y')
+        pump(broker)
+        message = recv(worker)
+        broker.handle_revision(3)
+        reply(worker, 'w1', message, 7)
+        pump(broker)
+        assert answer(recv(client)) == ('5', 7)
+        request(client, '6', 'count', 'y')
+        pump(broker)
+        reply(worker, 'w1', recv(worker), 8)
+        pump(broker)
+        assert answer(recv(client)) == ('6', 8)
+
+        # writers with no revision numbers announce every commit
+        broker.handle_revision(None)
+        request(client, '7', 'count', 'y')
+        pump(broker)
+        reply(worker, 'w1', recv(worker), 9)
+        pump(broker)
+        assert answer(recv(client)) == ('7', 9)
+        request(client, '8', 'count', 'y')
+        pump(broker)
+        assert answer(recv(client)) == ('8', 9)
+        broker.handle_revision(None)
+        request(client, '9', 'count', 'y')
+        pump(broker)
+        assert called(recv(worker))[0] == '9'
+    finally:
+        close(broker)
+
+
+def test_cache_large():
+    broker = make_broker(Broker, cache_size=10)
+    try:
+        worker = fake_worker(broker, 'w1')
+        client = fake_client(broker)
+        query = 'x' * ZERO_COPY_THRESHOLD
+
+        # payloads passed on without copying are cached by their bytes
+        request(client, '1', 'count', query)
+        pump(broker)
+        reply(worker, 'w1', recv(worker), 5)
+        pump(broker)
+        assert answer(recv(client)) == ('1', 5)
+        assert all(isinstance(key, str) for key in broker.cache.keys())
+        request(client, '2', 'count', query)
+        pump(broker)
+        assert answer(recv(client)) == ('2', 5)
+        assert idle(worker)
+        assert broker.coalesce_counts['cache_hits'] == 1
+    finally:
+        close(broker)
+
+
+def test_cache_errors():
+    broker = make_broker(Broker, cache_size=10)
+    try:
+        worker = fake_worker(broker, 'w1')
+        client = fake_client(broker)
+
+        # failed replies are not cached
+        request(client, '1', 'count', 'x')
+        pump(broker)
+        reply(worker, 'w1', recv(worker), ValueError('x'))
+        pump(broker)
+        rid, error = answer(recv(client))
+        assert rid == '1' and isinstance(error, ValueError)
+        request(client, '2', 'count', 'x')
+        pump(broker)
+        assert called(recv(worker))[0] == '2'
+        assert broker.coalesce_counts['cache_hits'] == 0
+    finally:
+        close(broker)
+
+
+def test_priority():
+    broker = make_broker(Broker, max_queue=3)
+    try:
+        client = fake_client(broker)
+        request(client, '1', 'count', 'low', priority='low')
+        request(client, '2', 'count', 'normal')
+        request(client, '3', 'count', 'high', priority='high')
+        pump(broker)
+        assert broker.queue_depth() == 3
+
+        # a full queue rejects requests right away
+        request(client, '4', 'count', 'high', priority='high')
+        pump(broker)
+        rid, error = answer(recv(client))
+        assert rid == '4' and isinstance(error, OverloadError)
+        assert broker.queue_counts['rejected'] == 1
+
+        # queued requests go to workers most urgent first
+        worker = fake_worker(broker, 'w1', capacity=3)
+        assert [called(recv(worker))[0] for i in range(3)] == [
+            '3', '2', '1']
+        assert broker.queue_depth() == 0
+    finally:
+        close(broker)
+
+
+def test_deadline():
+    broker = make_broker(Broker)
+    try:
+        worker = fake_worker(broker, 'w1')
+        client = fake_client(broker)
+        request(client, '1', 'count', 'busy')
+        pump(broker)
+        busy = recv(worker)
+
+        # requests that expired are dropped when they arrive
+        request(client, '2', 'count', 'late', deadline=time.time() - 1)
+        pump(broker)
+        assert broker.queue_depth() == 0
+        assert broker.queue_counts['expired'] == 1
+
+        # or when their turn comes
+        request(client, '3', 'count', 'expiring',
+                deadline=time.time() + 0.2)
+        request(client, '4', 'count', 'waiting',
+                deadline=time.time() + 10)
+        pump(broker)
+        assert broker.queue_depth() == 2
+        time.sleep(0.25)
+        reply(worker, 'w1', busy, 1)
+        pump(broker)
+        assert answer(recv(client)) == ('1', 1)
+        assert called(recv(worker))[0] == '4'
+        assert broker.queue_counts['expired'] == 2
+        assert idle(client)
+
+        # a full queue drops expired requests before rejecting any
+        broker.max_queue = 1
+        request(client, '5', 'count', 'expiring',
+                deadline=time.time() + 0.2)
+        pump(broker)
+        time.sleep(0.25)
+        request(client, '6', 'count', 'waiting')
+        pump(broker)
+        assert broker.queue_depth() == 1
+        assert broker.queue_counts == dict(expired=3, rejected=0,
+                                           cancelled=0)
+        assert idle(client)
+    finally:
+        close(broker)
+
+
+def housekeeping(broker):
+    """Run the broker's housekeeping now."""
+    broker.housekeeping_at = 0
+    pump(broker)
+
+
+def test_heartbeat():
+    broker = make_broker(Broker, heartbeat_timeout=100)
+    try:
+        # heartbeats register workers the broker does not know
+        worker = connect(broker, broker.worker_url, 'w1')
+        worker.send_multipart(['', 'HEARTBEAT', 'w1', '2'])
+        pump(broker)
+        assert broker.capacity == {'w1': 2}
+
+        # and idle workers that stop sending them are evicted
+        time.sleep(0.15)
+        housekeeping(broker)
+        assert 'w1' not in broker.capacity
+        assert broker.worker_counts['evicted'] == 1
+
+        # busy ones are left to the request timeout
+        worker.send_multipart(['', 'HEARTBEAT', 'w1', '1'])
+        client = fake_client(broker)
+        request(client, '1', 'count', 'x')
+        pump(broker)
+        message = recv(worker)
+        time.sleep(0.15)
+        housekeeping(broker)
+        assert 'w1' in broker.capacity
+        reply(worker, 'w1', message, 1)
+        pump(broker)
+        assert answer(recv(client)) == ('1', 1)
+        assert broker.worker_counts['evicted'] == 1
+    finally:
+        close(broker)
+
+
+def test_request_timeout():
+    broker = make_broker(Broker, request_timeout=100)
+    try:
+        worker = fake_worker(broker, 'w1', capacity=2)
+        client = fake_client(broker)
+        request(client, '1', 'count', 'hung')
+        pump(broker)
+        hung = recv(worker)
+        time.sleep(0.15)
+        request(client, '2', 'count', 'fine')
+        pump(broker)
+        recv(worker)
+
+        # the request that hung fails, the worker is evicted and its
+        # other requests are retried
+        housekeeping(broker)
+        rid, error = answer(recv(client))
+        assert rid == '1' and isinstance(error, RequestTimeoutError)
+        assert 'w1' not in broker.capacity
+        assert broker.queue_depth() == 1
+        other = fake_worker(broker, 'w2')
+        retried = recv(other)
+        assert called(retried)[0] == '2'
+
+        # a late reply from the evicted worker is dropped
+        reply(worker, 'w1', hung, 1)
+        pump(broker)
+        assert idle(client)
+        reply(other, 'w2', retried, 2)
+        pump(broker)
+        assert answer(recv(client)) == ('2', 2)
+        assert broker.worker_counts == dict(evicted=1, stale_replies=1,
+                                            timed_out=1, retried=1,
+                                            failed=0)
+    finally:
+        close(broker)
@@ -0,0 +1,157 @@
+import time
+
+import zmq
+from nose.tools import assert_raises
+
+from xodb.net import envelope
+from xodb.net.client import AsyncClient, HedgePolicy, TimeoutError
+from xodb.net.codec import get_codec
+
+codec = get_codec('pickle')
+
+
+def fake_broker(name):
+    """Return a context and a ROUTER socket bound where an AsyncClient
+    in that context can reach it."""
+    context = zmq.Context()
+    broker = context.socket(zmq.ROUTER)
+    broker.bind('inproc://test-client-%s' % name)
+    return context, broker
+
+
+def recv(socket, timeout=1000):
+    assert socket.poll(timeout), 'Nothing received'
+    return socket.recv_multipart()
+
+
+def answer(broker, message, result):
+    """Send a request the fake broker received its reply."""
+    broker.send_multipart(message[:-1] + [codec.dumps(result)])
+
+
+def test_correlation():
+    context, broker = fake_broker('correlation')
+    client = AsyncClient('inproc://test-client-correlation',
+                         context=context)
+    try:
+        first = client.count('a')
+        second = client.count('b', limit=1)
+        messages = [recv(broker), recv(broker)]
+        assert [codec.loads(m[-1]) for m in messages] == [
+            ('count', ('a',), {}), ('count', ('b',), {'limit': 1})]
+        # each request has its own id, and an envelope
+        assert messages[0][2] != messages[1][2]
+        priority, deadline = envelope.unpack(messages[0][3])
+        assert priority == envelope.NORMAL
+        assert deadline > time.time()
+
+        # replies are matched to requests whatever order they come in
+        answer(broker, messages[1], 2)
+        answer(broker, messages[0], 1)
+        assert second.result(1) == 2
+        assert first.result(1) == 1
+
+        failing = client.count('c')
+        answer(broker, recv(broker), ValueError('c'))
+        assert_raises(ValueError, failing.result, 1)
+        assert not client.pending
+    finally:
+        client.close()
+        broker.close()
+        context.term()
+
+
+def test_timeout():
+    context, broker = fake_broker('timeout')
+    client = AsyncClient('inproc://test-client-timeout', context=context,
+                         timeout=50)
+    try:
+        sent = time.time()
+        slow = client.count('slow')
+        message = recv(broker)
+        priority, deadline = envelope.unpack(message[3])
+        assert sent + 0.05 <= deadline < sent + 1
+        assert_raises(TimeoutError, slow.result, 1)
+
+        # a reply that comes too late is dropped
+        answer(broker, message, 1)
+        fast = client.request('count', ('fast',), timeout=1000,
+                              priority='high')
+        message = recv(broker)
+        assert envelope.unpack(message[3])[0] == envelope.HIGH
+        answer(broker, message, 2)
+        assert fast.result(1) == 2
+
+        # closing the client fails what it is still waiting for
+        unanswered = client.count('unanswered')
+        recv(broker)
+    finally:
+        client.close()
+        broker.close()
+        context.term()
+    assert_raises(TimeoutError, unanswered.result, 1)
+    assert_raises(RuntimeError, client.count, 'closed')
+
+
+def test_hedge_policy():
+    policy = HedgePolicy(methods=('count',), percentile=90, min_delay=5,
+                         samples=50, min_samples=10)
+    assert policy.hedges('count') and not policy.hedges('add')
+    for latency in range(1, 10):
+        policy.record('count', latency)
+    assert policy.delay('count') is None
+    policy.record('count', 10)
+    assert policy.delay('count') == 10
+
+    # the delay is only recomputed every min_samples replies
+    for i in range(9):
+        policy.record('count', 100)
+    assert policy.delay('count') == 10
+    policy.record('count', 100)
+    assert policy.delay('count') == 100
+
+    # over a window of the last *samples* replies
+    for i in range(50):
+        policy.record('count', 1)
+    assert len(policy.latencies['count']) == 50
+    assert policy.delay('count') == 5
+    assert policy.delay('query') is None
+
+
+def test_hedge():
+    context, broker = fake_broker('hedge')
+    policy = HedgePolicy(methods=('count',), percentile=50, min_delay=20,
+                         min_samples=1)
+    policy.record('count', 1)
+    client = AsyncClient('inproc://test-client-hedge', context=context,
+                         hedge=policy)
+    try:
+        # a request with no reply after the delay is sent again
+        future = client.count('x')
+        original = recv(broker)
+        assert not envelope.is_hedge(original[2:-1])
+        copy = recv(broker)
+        assert envelope.is_hedge(copy[2:-1])
+        assert copy[2] != original[2] and copy[-1] == original[-1]
+        assert policy.fired == 1
+
+        # the first copy answered wins, the other is cancelled
+        answer(broker, copy, 5)
+        assert future.result(1) == 5
+        cancel = recv(broker)
+        assert cancel[2:] == original[2:-1] + [envelope.CANCEL]
+        assert len(policy.latencies['count']) == 2
+        answer(broker, original, 6)
+        assert not client.copies
+
+        # requests answered in time are not hedged
+        future = client.count('y')
+        answer(broker, recv(broker), 7)
+        assert future.result(1) == 7
+        assert not broker.poll(50)
+        assert policy.fired == 1
+        assert not client.pending and not client.copies
+    finally:
+        client.close()
+        broker.close()
+        context.term()
@@ -0,0 +1,57 @@
+import datetime
+import cPickle
+from nose.tools import assert_raises
+
+from xodb.net.codec import (
+    BinaryCodec,
+    CodecError,
+    PickleCodec,
+    get_codec,
+    )
+
+
+rows = [(i, 100 - i, i, 1.5,
+         {u'name': u'joe %s' % i, u'tags': [u'a', u'b']})
+        for i in range(50)]
+
+
+def test_binary_roundtrip():
+    codec = BinaryCodec(compress_threshold=0)
+    data = codec.dumps(rows)
+    assert ord(data[0]) == BinaryCodec.version
+    assert codec.loads(data) == rows
+
+
+def test_binary_pickle_fallback():
+    codec = BinaryCodec()
+    value = [datetime.date(2011, 1, 1), ValueError('boom')]
+    data = codec.dumps(value)
+    assert ord(data[1]) & BinaryCodec.PICKLED
+    result = codec.loads(data)
+    assert result[0] == value[0]
+    assert isinstance(result[1], ValueError)
+
+
+def test_binary_compression():
+    codec = BinaryCodec(compress_threshold=1024)
+    small = codec.dumps(rows[:1])
+    large = codec.dumps(rows)
+    assert not ord(small[1]) & BinaryCodec.COMPRESSED
+    assert ord(large[1]) & BinaryCodec.COMPRESSED
+    assert codec.loads(large) == rows
+    assert len(large) < len(cPickle.dumps(rows))
+
+
+def test_legacy_frames():
+    codec = BinaryCodec()
+    assert codec.loads(PickleCodec().dumps(('count', (), {}))) == (
+        'count', (), {})
+    assert_raises(CodecError, codec.loads, '\x01\x02garbage')
+
+
+def test_get_codec():
+    assert isinstance(get_codec(), PickleCodec)
+    assert isinstance(get_codec('binary'), BinaryCodec)
+    codec = BinaryCodec()
+    assert get_codec(codec) is codec
+    assert_raises(ValueError, get_codec, 'json')
@@ -0,0 +1,35 @@
+from datetime import date, datetime
+from nose.tools import assert_raises
+
+from xodb.tools import dates
+
+
+def test_buckets():
+    assert (dates.buckets(date(2010, 11, 30), date(2012, 1, 2)) ==
+            ['20101130', '201012', '2011', '20120101', '20120102'])
+
+
+def test_whole_units():
+    assert dates.buckets(date(2011, 1, 1), date(2011, 12, 31)) == ['2011']
+    assert dates.buckets(date(2011, 2, 1), date(2011, 2, 28)) == ['201102']
+    assert dates.buckets(date(2011, 2, 3), date(2011, 2, 3)) == ['20110203']
+    assert dates.buckets(date(2011, 2, 3), date(2011, 2, 2)) == []
+
+
+def test_restricted_resolutions():
+    assert (dates.buckets(date(2010, 12, 30), date(2011, 2, 1),
+                          use=('month', 'day')) ==
+            ['20101230', '20101231', '201101', '20110201'])
+    assert (dates.buckets(date(2010, 12, 30), date(2011, 2, 1),
+                          use=('year', 'month')) ==
+            ['201012', '201101', '201102'])
+    assert_raises(ValueError, dates.buckets,
+                  date(2010, 1, 1), date(2011, 1, 1), use=('week',))
+
+
+def test_hours():
+    assert (dates.buckets(datetime(2011, 3, 4, 22, 15),
+                          datetime(2011, 3, 6, 1, 0),
+                          use=('day', 'hour')) ==
+            ['2011030422', '2011030423', '20110305',
+             '2011030600', '2011030601'])
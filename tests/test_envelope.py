@@ -0,0 +1,35 @@
+from nose.tools import assert_raises
+
+from xodb.net import envelope
+
+
+def test_roundtrip():
+    frame = envelope.pack('low', 1300000000.5)
+    assert envelope.unpack(frame) == (envelope.LOW, 1300000000.5)
+    assert envelope.unpack(envelope.pack()) == (envelope.NORMAL, None)
+
+
+def test_priority_level():
+    assert envelope.priority_level('high') == envelope.HIGH
+    assert envelope.priority_level(envelope.LOW) == envelope.LOW
+    assert_raises(ValueError, envelope.priority_level, 'urgent')
+    assert_raises(ValueError, envelope.priority_level, 7)
+
+
+def test_find():
+    rid = '\x00\x00\x00\x01'
+    frame = envelope.pack('high', 5.0)
+    assert envelope.find([rid, frame]) == (envelope.HIGH, 5.0)
+    assert envelope.find([rid]) == (envelope.NORMAL, None)
+    assert envelope.find([]) == (envelope.NORMAL, None)
+    # frames that merely look similar are not envelopes
+    assert envelope.unpack('XE1') is None
+    assert envelope.unpack('x' * envelope.envelope.size) is None
+
+
+def test_hedge():
+    frame = envelope.pack('low', 5.0, hedge=True)
+    assert envelope.unpack(frame) == (envelope.LOW, 5.0)
+    assert envelope.is_hedge(['\x00\x00\x00\x01', frame])
+    assert not envelope.is_hedge([envelope.pack('low', 5.0)])
+    assert not envelope.is_hedge([])
@@ -0,0 +1,57 @@
+from xodb.tools import LRUCache
+
+
+def test_limit():
+    cache = LRUCache(limit=3)
+    for i in range(4):
+        cache[i] = i
+    assert cache.keys() == [1, 2, 3]
+    assert cache[1] == 1
+    cache[4] = 4
+    assert cache.keys() == [3, 1, 4]
+    assert cache.evictions == 2
+    assert 2 not in cache
+    assert cache.get(2) is None
+    del cache[3]
+    assert list(cache) == [1, 4]
+
+
+def test_max_bytes():
+    cache = LRUCache(limit=None, max_bytes=10)
+    cache['a'] = 'xxxx'
+    cache['b'] = 'yyyy'
+    assert cache['a'] == 'xxxx'
+    cache['c'] = 'zzzz'
+    assert cache.items() == [('a', 'xxxx'), ('c', 'zzzz')]
+    assert cache.size == 8
+    cache.set('d', None, size=11)
+    assert 'd' not in cache
+    cache.set('a', 'x', size=2)
+    assert cache.size == 6
+
+
+def test_ttl():
+    now = [100.0]
+    cache = LRUCache(ttl=5)
+    cache.clock = lambda: now[0]
+    cache['a'] = 1
+    cache.set('b', 2, ttl=50)
+    cache['c'] = 3
+    now[0] = 106
+    assert 'a' not in cache
+    assert cache.get('a') is None
+    assert cache['b'] == 2
+    cache.purge_expired()
+    assert cache.keys() == ['b']
+    assert cache.expirations == 2
+
+
+def test_loader_and_stats():
+    cache = LRUCache(loader=lambda key: key * 2)
+    assert cache[4] == 8
+    assert cache.get(4) == 8
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['entries'] == 1
+    assert stats['hit_rate'] == 0.5
@@ -4,9 +4,11 @@ from nose.tools import assert_raises
 
 from xodb.elements import (
     Array,
+    Autocomplete,
     Date,
     DateTime,
     Dict,
+    Float,
     Integer,
     List,
     Location,
@@ -69,6 +71,26 @@ def test_string():
                              (u's7', u'WoZeRoD'), (u's8', 's8')])
 
 
+class Completer(Schema):
+    a1 = Autocomplete.using(min_length=2, max_length=4)
+
+
+def test_autocomplete():
+
+    s = Completer.from_defaults()
+    f = Object(a1=u'New York')
+
+    s.update_by_object(f)
+    d = s.__xodb_memo__.dict
+    assert (set(d['terms']) ==
+            set([(u'a1_ac:ne', 'b'), (u'a1_ac:new', 'b'),
+                 (u'a1_ac:new ', 'b'), (u'a1:new york', 'b', 1),
+                 ]
+                )
+            )
+    assert set(d['values']) == set([(u'a1', u'New York', 'string')])
+
+
 class Inter(Schema):
     i1 = Integer.named('i1')
     i2 = Integer.using(prefix=False)
@@ -111,6 +133,37 @@ def test_integer():
                              ('i7', '7')])
 
 
+class Floater(Schema):
+    f1 = Float.named('f1')
+    f2 = Float.using(prefix=False)
+    f3 = Float.using(sortable=True)
+    f4 = Float.using(default=4.25)
+    f5 = Float.using(default=5.0)
+
+
+def test_float():
+
+    s = Floater.from_defaults()
+    f = Object(f1=1.5,
+               f2=2.5,
+               f3=3.5,
+               )
+
+    s.update_by_object(f)
+    d = s.__xodb_memo__.dict
+    assert d['lang'] == None
+    assert (set(d['terms']) ==
+            set([(u'f1:1.5', 'b', 1), (u'2.5', 'b', 1),
+                 (u'f3:3.5', 'b', 1), (u'f4:4.25', 'b', 1),
+                 (u'f5:5', 'b', 1),
+                 ],
+                )
+            )
+    assert set(d['values']) == set([(u'f3', 3.5, 'float')])
+    assert d['texts'] == []
+    assert d['posts'] == []
+
+
 class Dater(Schema):
     d1 = Date.named('d1')
     d2 = Date.using(prefix=False)
@@ -156,6 +209,30 @@ def test_date():
                              ])
 
 
+class Bucketer(Schema):
+    d1 = Date.using(resolutions=('year', 'month', 'day'))
+    d2 = DateTime.using(resolutions=('month', 'hour'), prefix=False)
+
+
+def test_date_resolutions():
+
+    s = Bucketer.from_defaults()
+    f = Object(d1=datetime.date(2001, 2, 3),
+               d2=datetime.datetime(2002, 3, 4, 5, 6, 7),
+               )
+
+    s.update_by_object(f)
+    d = s.__xodb_memo__.dict
+    assert (set(d['terms']) ==
+            set([(u'd1:2001', 'b', 1), (u'd1:200102', 'b', 1),
+                 (u'd1:20010203', 'b', 1),
+                 ('200203', 'b', 1), ('2002030405', 'b', 1),
+                 ('20020304', 'b', 1),
+                 ]
+                )
+            )
+
+
 class DateTimer(Schema):
     dt1 = DateTime.named('dt1')
     dt2 = DateTime.using(prefix=False)
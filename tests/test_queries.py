@@ -430,3 +430,95 @@ def test_metadata():
     assert l[0]._xodb_rank == 0
     assert l[1]._xodb_rank == 1
     assert l[0]._xodb_weight > l[1]._xodb_weight
+
+
+def test_records_share_results():
+    l = list(db.query('friends_2:jesus'))
+    assert not hasattr(l[0], '__dict__')
+    assert l[0]._xodb_results is l[1]._xodb_results
+    assert l[0]._xodb_query == 'friends_2:jesus'
+    assert l[0]._xodb_db is db
+    assert l[0].name in (u'joe', u'jane')
+
+
+def test_record_pickle():
+    import cPickle
+    record = list(db.query('name:joe'))[0]
+    record._xodb_results.db = None
+    copy = cPickle.loads(cPickle.dumps(record))
+    assert copy._id == record._id
+    assert copy._xodb_rank == record._xodb_rank
+    assert copy._xodb_query == 'name:joe'
+    assert copy._xodb_document.get_data() == record._xodb_document.get_data()
+
+
+def test_record_view():
+    record = list(db.query('name:joe'))[0]
+    assert record.last == u'bob'
+    assert record.salary == 4500
+    assert record._xodb_view.full is None
+    assert record.friends == [u'rick', u'roll', u'jesus']
+    assert record._xodb_view.full is not None
+    assert record._xodb_schema['last'].value == u'bob'
+
+
+def test_record_cache():
+    db.flush()
+    reader = xodb.open(db.db_path, writable=False)
+    reader.record_cache = cache = xodb.RecordCache()
+    assert list(reader.query('name:joe'))[0].last == u'bob'
+    assert cache.stats()['misses'] == 1
+    assert list(reader.query('name:joe'))[0].last == u'bob'
+    assert list(reader.query('friends_2:rick'))[0].salary == 4500
+    stats = cache.stats()
+    assert stats['hits'] == 2 and stats['entries'] == 1
+    # writable databases skip the cache
+    db.record_cache = cache
+    try:
+        assert list(db.query('name:joe'))[0].last == u'bob'
+        assert cache.stats()['hits'] == 2
+    finally:
+        del db.record_cache
+    cache.set('big', None, cache.max_bytes + 1)
+    assert cache.stats()['entries'] == 1
+    cache.max_bytes = stats['bytes']
+    cache.set('other', None, 1)
+    assert cache.stats()['evictions'] == 1
+
+
+class OldXapianDatabase(xodb.Database):
+    """A database on a Xapian that does not expose revisions."""
+
+    revision = None
+
+
+def test_record_cache_no_revision():
+    reader = OldXapianDatabase(db.db_path, writable=False)
+    reader.record_cache = cache = xodb.RecordCache()
+    assert list(reader.query('name:joe'))[0].last == u'bob'
+    assert list(reader.query('name:joe'))[0].last == u'bob'
+    stats = cache.stats()
+    assert stats['entries'] == 0 and stats['hits'] == 0
+
+
+def test_xaql():
+    from xodb import xaql
+
+    def names(query):
+        return sorted(r.name for r in db.query(xaql.parse(query)))
+
+    assert names('name:joe') == [u'joe', u'joe']
+    assert names('name:(joe OR jane)') == [u'jane', u'joe', u'joe']
+    assert names('job:"cake inspector"') == [u'joe']
+    assert names('rank:1..10') == [u'joe']
+    assert names('rank:50..') == [u'jane']
+    assert names('hired-before:20000101') == [u'joe']
+    assert names('hired-after:20000101') == [u'jane']
+    assert names('name:joe OR name:jane -rank:50..') == [u'joe', u'joe']
+    assert names('$xp(name:jane)') == [u'jane']
+    assert names('clocked:..$now') == [u'jane', u'joe']
+
+    expression = xaql.parse('name:joe')
+    assert db.querify(expression) is db.querify(expression)
+    expression = xaql.parse('clocked:..$now')
+    assert db.querify(expression) is not db.querify(expression)
@@ -0,0 +1,111 @@
+import time
+
+from nose.tools import assert_raises
+
+from xodb.net.read_broker import ReadBroker
+from tests.nettools import (
+    answer,
+    called,
+    close,
+    codec,
+    fake_client,
+    fake_worker,
+    idle,
+    make_broker,
+    pump,
+    recv,
+    reply,
+    request,
+    )
+
+
+def test_routing():
+    assert_raises(ValueError, ReadBroker, 'inproc://a', 'inproc://b',
+                  'inproc://c', routing='random')
+
+
+def test_affinity():
+    broker = make_broker(ReadBroker, routing='affinity', affinity_wait=200)
+    try:
+        workers = dict((name, fake_worker(broker, name))
+                       for name in ('w1', 'w2'))
+        client = fake_client(broker)
+        key = broker.routing_key([codec.dumps(('count', ('apple',), {}))])
+        owner = broker.ring.get(key)
+        other = 'w2' if owner == 'w1' else 'w1'
+        preferred, fallback = workers[owner], workers[other]
+
+        # the query goes to the worker that owns it on the ring
+        request(client, '1', 'count', 'apple')
+        pump(broker)
+        first = recv(preferred)
+        assert called(first) == ('1', ('count', ('apple',), {}))
+        assert idle(fallback)
+
+        # and waits for it while it is busy
+        request(client, '2', 'count', 'apple')
+        pump(broker)
+        assert idle(preferred) and idle(fallback)
+        reply(preferred, owner, first, 1)
+        pump(broker)
+        assert answer(recv(client)) == ('1', 1)
+        second = recv(preferred)
+        assert called(second)[0] == '2'
+
+        # unless it stays busy for longer than affinity_wait
+        request(client, '3', 'count', 'apple')
+        pump(broker)
+        assert idle(fallback)
+        time.sleep(0.25)
+        pump(broker)
+        third = recv(fallback)
+        assert called(third)[0] == '3'
+
+        # only affinity_depth requests wait for a worker
+        reply(fallback, other, third, 3)
+        pump(broker)
+        assert answer(recv(client)) == ('3', 3)
+        request(client, '4', 'count', 'apple')
+        request(client, '5', 'count', 'apple')
+        pump(broker)
+        assert called(recv(fallback))[0] == '5'
+        reply(preferred, owner, second, 2)
+        pump(broker)
+        assert answer(recv(client)) == ('2', 2)
+        assert called(recv(preferred))[0] == '4'
+
+        stats = broker.affinity_stats()
+        assert (stats['hits'], stats['waits'], stats['misses']) == (1, 2, 2)
+        assert stats['hit_rate'] == 0.6
+    finally:
+        close(broker)
+
+
+def test_affinity_worker_exited():
+    broker = make_broker(ReadBroker, routing='affinity', affinity_wait=10000)
+    try:
+        workers = dict((name, fake_worker(broker, name))
+                       for name in ('w1', 'w2'))
+        client = fake_client(broker)
+        key = broker.routing_key([codec.dumps(('count', ('pear',), {}))])
+        owner = broker.ring.get(key)
+        other = 'w2' if owner == 'w1' else 'w1'
+
+        request(client, '1', 'count', 'pear')
+        request(client, '2', 'count', 'pear')
+        pump(broker)
+        assert called(recv(workers[owner]))[0] == '1'
+
+        # a request waiting for a worker that died goes to another,
+        # and so do the dead worker's own requests
+        broker.handle_process_state_exited(dict(processname=owner))
+        pump(broker)
+        assert owner not in broker.ring
+        second = recv(workers[other])
+        assert called(second)[0] == '2'
+        reply(workers[other], other, second, 2)
+        pump(broker)
+        assert answer(recv(client)) == ('2', 2)
+        assert called(recv(workers[other]))[0] == '1'
+    finally:
+        close(broker)
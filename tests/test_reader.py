@@ -0,0 +1,40 @@
+import threading
+from collections import OrderedDict
+
+from xodb.net.reader import Reader, plain_expansion
+
+
+def test_plain_expansion():
+    expansion = OrderedDict([
+        ('tag:python', (5, OrderedDict([('author:bob', 3)]))),
+        ('tag:xapian', (2, OrderedDict())),
+        ])
+    assert plain_expansion(expansion) == [
+        ('tag:python', 5, [('author:bob', 3)]),
+        ('tag:xapian', 2, []),
+        ]
+    assert plain_expansion(OrderedDict([('tag:python', 5)])) == [
+        ('tag:python', 5)]
+
+
+class CountingDB(object):
+
+    def count(self, query):
+        return len(query)
+
+    def spell(self, query):
+        raise ValueError(query)
+
+
+def test_multi():
+    reader = Reader.__new__(Reader)
+    reader.local = threading.local()
+    reader.main_db = CountingDB()
+    results = reader.handle_multi([
+        ('count', ('abc',), {}),
+        ('spell', ('abc',), {}),
+        ('multi', ([],), {}),
+        ])
+    assert results[0] == 3
+    assert isinstance(results[1], ValueError)
+    assert isinstance(results[2], ValueError)
@@ -0,0 +1,41 @@
+from xodb.net.ring import HashRing
+
+
+def owners(ring, keys=10000):
+    return dict(('key%s' % i, ring.get('key%s' % i)) for i in xrange(keys))
+
+
+def test_distribution():
+    ring = HashRing(['a', 'b', 'c', 'd'])
+    before = owners(ring)
+    for node in 'abcd':
+        assert 1500 < before.values().count(node) < 3500
+
+    # removing a node only moves its own keys
+    ring.remove('b')
+    after = owners(ring)
+    for key, node in before.items():
+        if node == 'b':
+            assert after[key] in 'acd'
+        else:
+            assert after[key] == node
+
+    # adding one only takes keys from the others
+    ring.add('e')
+    added = owners(ring)
+    for key, node in after.items():
+        assert added[key] in (node, 'e')
+    assert 1000 < added.values().count('e') < 3500
+
+
+def test_nodes():
+    ring = HashRing(replicas=8)
+    assert ring.get('key') is None
+    ring.add('a')
+    ring.add('a')
+    assert len(ring.points) == 8
+    assert len(ring) == 1 and 'a' in ring
+    assert ring.get('key') == 'a'
+    ring.remove('a')
+    ring.remove('a')
+    assert not ring.points and ring.get('key') is None
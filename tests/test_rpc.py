@@ -0,0 +1,141 @@
+import json
+import socket
+import threading
+
+from xodb.tools import rpc
+
+
+class FakeDB(object):
+
+    def count(self, query):
+        return len(query)
+
+    def estimate(self, query, limit=10):
+        return limit
+
+    def query(self, query, limit=3):
+        return iter(range(limit))
+
+    def suggest(self, query):
+        yield query
+        yield query.upper()
+        raise ValueError('broke after two')
+
+    def allterms(self, prefix=''):
+        raise KeyError(prefix)
+        yield
+
+    def close(self):
+        raise AssertionError('not an RPC method')
+
+
+class Server(object):
+    database = FakeDB()
+
+
+def post(request):
+    """POST *request* to an RPCHandler over a socketpair, return the
+    response's head and body."""
+    ours, theirs = socket.socketpair()
+
+    def handle():
+        try:
+            rpc.RPCHandler(theirs, ('test', 0), Server())
+        finally:
+            theirs.close()
+
+    thread = threading.Thread(target=handle)
+    thread.start()
+    body = json.dumps(request)
+    ours.sendall('POST / HTTP/1.1\r\nContent-Length: %s\r\n'
+                 'Connection: close\r\n\r\n%s' % (len(body), body))
+    data = []
+    while True:
+        piece = ours.recv(4096)
+        if not piece:
+            break
+        data.append(piece)
+    ours.close()
+    thread.join()
+    head, _, body = ''.join(data).partition('\r\n\r\n')
+    return head, body
+
+
+def dechunk(body):
+    """Return the chunks of a chunked body, and whether it ended with
+    the last, empty chunk."""
+    chunks = []
+    while body:
+        size, _, body = body.partition('\r\n')
+        size = int(size, 16)
+        if not size:
+            return chunks, body == '\r\n'
+        chunks.append(body[:size])
+        assert body[size:size + 2] == '\r\n'
+        body = body[size + 2:]
+    return chunks, False
+
+
+def test_iter_response():
+    assert ''.join(rpc.iter_response(7, [])) == (
+        '{"id":7,"error":null,"result":[]}')
+    assert json.loads(''.join(rpc.iter_response('a', [1, {'b': 2}]))) == {
+        'id': 'a', 'error': None, 'result': [1, {'b': 2}]}
+
+
+def test_call():
+    head, body = post(dict(id=1, method='count', params=['abc']))
+    assert 'Content-Length: %s' % len(body) in head
+    assert json.loads(body) == dict(id=1, error=None, result=3)
+    head, body = post(dict(id=2, method='estimate', params={'query': 'a',
+                                                          'limit': 5}))
+    assert json.loads(body)['result'] == 5
+
+
+def test_methods():
+    for method in ('close', 'nosuch', '__init__'):
+        head, body = post(dict(id=3, method=method, params=[]))
+        response = json.loads(body)
+        assert response['id'] == 3
+        assert response['result'] is None
+        assert response['error']['name'] == 'AttributeError'
+    head, body = post(dict(id=4, method='count', params=[1, 2]))
+    assert json.loads(body)['error']['name'] == 'TypeError'
+
+
+def test_stream():
+    chunk_size = rpc.CHUNK_SIZE
+    rpc.CHUNK_SIZE = 1
+    try:
+        head, body = post(dict(id=5, method='query', params=['a']))
+        assert 'Transfer-Encoding: chunked' in head
+        chunks, finished = dechunk(body)
+        assert finished
+        assert chunks == list(rpc.iter_response(5, range(3)))
+        assert json.loads(''.join(chunks))['result'] == [0, 1, 2]
+    finally:
+        rpc.CHUNK_SIZE = chunk_size
+
+    head, body = post(dict(id=6, method='query', params=['a', 1000]))
+    chunks, finished = dechunk(body)
+    assert finished
+    assert len(chunks) == 1
+    assert json.loads(chunks[0])['result'] == range(1000)
+
+
+def test_stream_errors():
+    # an error before the first item is an ordinary error response
+    head, body = post(dict(id=7, method='allterms', params=['x']))
+    assert 'chunked' not in head
+    assert json.loads(body)['error']['name'] == 'KeyError'
+
+    # one after the response has started cuts it short
+    chunk_size = rpc.CHUNK_SIZE
+    rpc.CHUNK_SIZE = 1
+    try:
+        head, body = post(dict(id=8, method='suggest', params=['a']))
+    finally:
+        rpc.CHUNK_SIZE = chunk_size
+    chunks, finished = dechunk(body)
+    assert not finished
+    assert chunks == ['{"id":8,"error":null,"result":[', '"a"', ',"A"']
@@ -0,0 +1,33 @@
+from nose.tools import assert_raises
+
+from xodb import snowball
+
+
+def test_lazy_stoppers():
+    stoppers = snowball.LazyRegistry(snowball._load_stopper)
+    assert 'de' in stoppers
+    assert 'xx' not in stoppers
+    assert 'de' not in stoppers.loaded
+    stopper = stoppers['de']
+    assert 'de' in stoppers.loaded
+    assert stoppers['de'] is stopper
+    assert stopper('und')
+    assert not stopper('hund')
+    assert_raises(KeyError, stoppers.__getitem__, 'xx')
+    assert stoppers.get('xx') is None
+
+
+def test_lazy_views():
+    stopwords = snowball.LazyRegistry(snowball._load_stopwords)
+    assert sorted(stopwords.keys()) == sorted(snowball.languages)
+    assert not stopwords.loaded
+    items = dict(stopwords.items())
+    assert sorted(items) == sorted(snowball.languages)
+    assert items['en'] is stopwords['en']
+    assert len(stopwords.values()) == len(snowball.languages)
+    assert dict(stopwords.iteritems()) == items
+
+
+def test_stopwords():
+    assert u'the' in snowball.stopwords['en']
+    assert set(snowball.stopwords) == set(snowball.languages)
@@ -0,0 +1,34 @@
+from xodb.net import stats
+
+
+def test_timing():
+    frame = stats.pack_timing('query', 0.25)
+    assert stats.unpack_timing(frame) == ('query', 250.0, False)
+    assert stats.unpack_timing(stats.pack_timing(None, 0)) == ('', 0.0, False)
+    frame = stats.pack_timing('count', 0.5, failed=True)
+    assert stats.unpack_timing(frame) == ('count', 500.0, True)
+    assert stats.unpack_timing('payload') is None
+
+
+def test_histogram():
+    histogram = stats.Histogram()
+    for elapsed in range(1, 101):
+        histogram.add(elapsed)
+    assert histogram.count == 100
+    assert histogram.percentile(50) == 50
+    assert histogram.percentile(99) == 100
+    assert histogram.as_dict()['mean'] == 50.5
+    histogram.add(100000)
+    assert histogram.percentile(100) == 100000
+
+
+def test_metrics():
+    metrics = stats.Metrics()
+    metrics.record('count', 5, 3)
+    metrics.record('count', 7)
+    methods = metrics.as_dict()
+    assert methods['count']['count'] == 2
+    assert methods['count']['latency']['count'] == 2
+    assert methods['count']['execution']['count'] == 1
+    metrics.roll()
+    assert metrics.rates()['count'] == 0
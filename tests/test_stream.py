@@ -0,0 +1,92 @@
+import time
+import threading
+
+import zmq
+
+from xodb.net import stream
+from xodb.net.broker import Broker
+from xodb.net.client import AsyncClient
+from xodb.net.reader import Reader
+from tests.nettools import close, make_broker, pump
+
+
+def test_open():
+    frame = stream.pack_open(3, 50)
+    assert stream.find_open(['\x00\x00\x00\x01', frame]) == (3, 50)
+    assert stream.find_open(['\x00\x00\x00\x01']) is None
+
+
+def test_chunk():
+    assert stream.unpack_chunk(stream.pack_chunk(7)) == (7, False)
+    assert stream.unpack_chunk(stream.pack_chunk(8, True)) == (8, True)
+    assert stream.unpack_chunk(stream.pack_credit(1)) is None
+
+
+def test_credit():
+    assert stream.unpack_credit(stream.pack_credit()) == 1
+    assert stream.unpack_credit(stream.pack_credit(5)) == 5
+    assert stream.unpack_credit('payload') is None
+
+
+class StreamDB(object):
+
+    def __init__(self, count):
+        self.count = count
+        self.produced = 0
+
+    def query(self, query):
+        for i in xrange(self.count):
+            self.produced += 1
+            yield i
+
+
+def test_credit_flow():
+    broker = make_broker(Broker, worker_url='tcp://127.0.0.1:*')
+    db = StreamDB(20)
+    reader = Reader('reader', broker.backend.getsockopt(zmq.LAST_ENDPOINT),
+                    db)
+    reader.socket.connect(reader.worker_url)
+    reader.send(['READY', 'reader', '1'])
+    client = AsyncClient(broker.client_url, context=broker.context)
+    stopped = threading.Event()
+
+    def run_broker():
+        while not stopped.is_set():
+            pump(broker, 10)
+
+    threads = [threading.Thread(target=run_broker),
+               threading.Thread(target=reader.handle_request)]
+    for thread in threads:
+        thread.start()
+    try:
+        items = client.request_stream('query', ('x',), credits=2,
+                                      chunk_size=3)
+
+        # the reader sends as many chunks as it has credits, and
+        # waits with the next one
+        deadline = time.time() + 1
+        while items.chunks.qsize() < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        assert items.chunks.qsize() == 2
+        assert db.produced == 9
+
+        # taking chunks grants credits for more, until the end
+        assert list(items) == range(20)
+        assert db.produced == 20
+        assert items.finished
+        threads[1].join(1)
+        assert not threads[1].is_alive()
+    finally:
+        client.close()
+        stopped.set()
+        for thread in threads:
+            thread.join(1)
+        reader.context.destroy(linger=0)
+    try:
+        pump(broker)
+        assert not broker.streaming
+        assert not broker.busy
+        assert 'reader' in broker.workers
+    finally:
+        close(broker)
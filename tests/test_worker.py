@@ -0,0 +1,107 @@
+import time
+import threading
+
+import zmq
+
+from xodb.net.codec import get_codec
+from xodb.net.reader import Reader
+
+codec = get_codec('pickle')
+
+
+class MainDB(object):
+    auto_reopen = False
+
+    def count(self, query):
+        raise AssertionError('Handler threads use their own databases')
+
+
+class ThreadDB(object):
+    auto_reopen = False
+    revision = 1
+
+    def __init__(self, name):
+        self.name = name
+        self.thread = threading.current_thread().name
+        self.reopened = 0
+
+    def count(self, query):
+        # long enough for every thread to take a request
+        time.sleep(0.1)
+        return self.name
+
+    def reopen(self, force=False):
+        self.reopened += 1
+
+
+class ThreadedReader(Reader):
+
+    def __init__(self, *args, **kwargs):
+        super(ThreadedReader, self).__init__(*args, **kwargs)
+        self.opened = []
+        self.lock = threading.Lock()
+
+    def open_database(self):
+        with self.lock:
+            db = ThreadDB('db%s' % len(self.opened))
+            self.opened.append(db)
+        return db
+
+
+def send(broker, *rids):
+    for rid in rids:
+        broker.send_multipart(['reader', '', 'client', rid,
+                               codec.dumps(('count', ('x',), {}))])
+
+
+def serve(reader, broker, count):
+    """Pass requests and replies between the broker and the handler
+    threads, the way the worker's main thread does, until *count*
+    replies came back.  Returns the replies by request id."""
+    replies = {}
+    deadline = time.time() + 2
+    while len(replies) < count and time.time() < deadline:
+        reader.socket.poll(10)
+        reader.queue_requests()
+        reader.forward_replies()
+        while broker.poll(0):
+            message = broker.recv_multipart()
+            replies[message[5]] = codec.loads(message[-1])
+    return replies
+
+
+def test_threads():
+    reader = ThreadedReader('reader', 'inproc://test-reader', MainDB(),
+                            threads=2)
+    broker = reader.context.socket(zmq.ROUTER)
+    broker.bind('inproc://test-reader')
+    reader.socket.setsockopt(zmq.IDENTITY, 'reader')
+    reader.socket.connect('inproc://test-reader')
+    try:
+        assert reader.capacity == 2
+        reader.start_threads()
+
+        # each thread answers with its own database
+        send(broker, '1', '2')
+        replies = serve(reader, broker, 2)
+        assert sorted(replies.values()) == ['db0', 'db1']
+        assert len(reader.opened) == 2
+        threads = set(db.thread for db in reader.opened)
+        assert len(threads) == 2
+        assert threading.current_thread().name not in threads
+
+        # and reopens it after a new revision
+        assert [db.reopened for db in reader.opened] == [0, 0]
+        reader.handle_revision(2)
+        send(broker, '3', '4')
+        replies = serve(reader, broker, 2)
+        assert sorted(replies.values()) == ['db0', 'db1']
+        assert [db.reopened for db in reader.opened] == [1, 1]
+        assert len(reader.opened) == 2
+    finally:
+        reader.running = False
+        for thread in reader.handlers:
+            reader.requests.put(None)
+        for thread in reader.handlers:
+            thread.join(1)
+        reader.context.destroy(linger=0)
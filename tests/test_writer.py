@@ -0,0 +1,216 @@
+import time
+from cPickle import loads
+
+import zmq
+
+from xodb.net import stats
+from xodb.net.codec import get_codec
+from xodb.net.worker import REVISION_EVENT
+from xodb.net.writer import Writer
+
+codec = get_codec('pickle')
+
+
+class FakeBackend(object):
+
+    def __init__(self, broken=False):
+        self.documents = {}
+        self.broken = broken
+        self.revision = 0
+        self.cancelled = 0
+
+    def add_document(self, document):
+        docid = len(self.documents) + 1
+        self.documents[docid] = document
+        return docid
+
+    def begin_transaction(self):
+        pass
+
+    def commit_transaction(self):
+        if self.broken:
+            raise IOError('Disk full')
+        self.revision += 1
+
+    def cancel_transaction(self):
+        self.cancelled += 1
+
+
+class FakeDB(object):
+
+    def __init__(self, broken=False):
+        self.backend = FakeBackend(broken)
+
+    @property
+    def revision(self):
+        return self.backend.revision
+
+    def begin(self):
+        raise AssertionError('Database.begin ignores backend errors')
+
+    def commit(self):
+        raise AssertionError('Database.commit ignores backend errors')
+
+    def flush(self):
+        pass
+
+    def doc_from_dict(self, obj):
+        return obj
+
+
+def make_writer(db, **options):
+    """Return a writer, the ROUTER socket it takes requests from and
+    the PULL socket its revisions are pushed to."""
+    writer = Writer('writer', 'inproc://test-writer', db,
+                    revisions_url='inproc://test-revisions', **options)
+    broker = writer.context.socket(zmq.ROUTER)
+    broker.bind('inproc://test-writer')
+    revisions = writer.context.socket(zmq.PULL)
+    revisions.bind('inproc://test-revisions')
+    writer.socket.setsockopt(zmq.IDENTITY, 'writer')
+    writer.socket.connect('inproc://test-writer')
+    return writer, broker, revisions
+
+
+def send(broker, rid, method, *args):
+    broker.send_multipart(['writer', '', 'client', rid,
+                           codec.dumps((method, args, {}))])
+
+
+def take(writer, count):
+    """Have the writer take requests until *count* are batched."""
+    deadline = time.time() + 1
+    while len(writer.batch) < count and time.time() < deadline:
+        writer.socket.poll(10)
+        writer.handle_request()
+    assert len(writer.batch) == count
+
+
+def fill(writer, broker):
+    """Have the writer take requests until it commits a full batch
+    and answers it."""
+    deadline = time.time() + 1
+    while not broker.poll(10) and time.time() < deadline:
+        writer.socket.poll(10)
+        writer.handle_request()
+
+
+def replies(broker, count):
+    """Return the timing and the reply of each of *count* replies, by
+    request id."""
+    replies = {}
+    for i in xrange(count):
+        assert broker.poll(1000), 'No reply'
+        message = broker.recv_multipart()
+        assert message[2:5] == ['writer', 'client', '']
+        replies[message[5]] = (stats.unpack_timing(message[6]),
+                               codec.loads(message[7]))
+    return replies
+
+
+def published(revisions):
+    assert revisions.poll(1000), 'No revision published'
+    headers, eventdata, payload = loads(revisions.recv())
+    assert headers['eventname'] == REVISION_EVENT
+    assert eventdata['processname'] == 'writer'
+    return eventdata['revision']
+
+
+def test_batch_size():
+    db = FakeDB()
+    writer, broker, revisions = make_writer(db, batch_size=3,
+                                            batch_wait=10000)
+    try:
+        assert writer.capacity == 3
+        send(broker, '1', 'add', {'n': 1})
+        send(broker, '2', 'add', {'n': 2})
+        take(writer, 2)
+        assert db.revision == 0
+        assert not broker.poll(50)
+
+        # a full batch is committed at once, and answered after
+        send(broker, '3', 'add', {'n': 3})
+        fill(writer, broker)
+        assert db.revision == 1 and not writer.batch
+        assert sorted(db.backend.documents.values()) == [
+            {'n': 1}, {'n': 2}, {'n': 3}]
+        answers = replies(broker, 3)
+        for rid, docid in (('1', 1), ('2', 2), ('3', 3)):
+            timing, result = answers[rid]
+            assert result == dict(result=docid, revision=1)
+            assert timing[0] == 'add' and not timing[2]
+        assert published(revisions) == 1
+    finally:
+        writer.context.destroy(linger=0)
+
+
+def test_batch_wait():
+    db = FakeDB()
+    writer, broker, revisions = make_writer(db, batch_size=100,
+                                            batch_wait=50)
+    try:
+        send(broker, '1', 'add', {'n': 1})
+        take(writer, 1)
+        writer.handle_timers()
+        assert db.revision == 0
+        assert 0 < writer.poll_timeout() <= 50
+        time.sleep(0.06)
+        assert writer.poll_timeout() == 0
+        writer.handle_timers()
+        assert db.revision == 1
+        assert replies(broker, 1)['1'][1] == dict(result=1, revision=1)
+        assert published(revisions) == 1
+    finally:
+        writer.context.destroy(linger=0)
+
+
+def test_errors():
+    db = FakeDB()
+    writer, broker, revisions = make_writer(db, batch_size=2)
+    try:
+        # a write that fails does not fail the rest of its batch
+        send(broker, '1', 'nosuch', {'n': 1})
+        send(broker, '2', 'add', {'n': 2})
+        fill(writer, broker)
+        answers = replies(broker, 2)
+        timing, result = answers['1']
+        assert isinstance(result, AttributeError)
+        assert timing == ('nosuch', timing[1], True)
+        assert answers['2'][1] == dict(result=1, revision=1)
+        assert published(revisions) == 1
+    finally:
+        writer.context.destroy(linger=0)
+
+    # a commit that fails fails every write of its batch
+    db = FakeDB(broken=True)
+    writer, broker, revisions = make_writer(db, batch_size=2)
+    try:
+        send(broker, '1', 'add', {'n': 1})
+        send(broker, '2', 'add', {'n': 2})
+        fill(writer, broker)
+        for timing, result in replies(broker, 2).values():
+            assert isinstance(result, IOError) and timing[2]
+        assert db.backend.cancelled == 1
+        assert db.revision == 0
+        assert not revisions.poll(50)
+    finally:
+        writer.context.destroy(linger=0)
+
+
+class OldFakeDB(FakeDB):
+    """A database on a Xapian that does not expose revisions."""
+
+    revision = None
+
+
+def test_no_revision():
+    db = OldFakeDB()
+    writer, broker, revisions = make_writer(db, batch_size=1)
+    try:
+        # commits are still announced, for readers to reopen
+        send(broker, '1', 'add', {'n': 1})
+        fill(writer, broker)
+        assert replies(broker, 1)['1'][1] == dict(result=1, revision=None)
+        assert published(revisions) is None
+    finally:
+        writer.context.destroy(linger=0)
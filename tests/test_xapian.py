@@ -4,7 +4,8 @@ import xodb
 import tempfile
 import xapian
 from xodb import MultipleValueRangeProcessor
-from xodb.exc import PrefixError
+from xodb.exc import PrefixError, SchemaConflictError
+from xodb.elements import lookup_schema, register_schema
 
 from nose.tools import assert_raises
 
@@ -208,3 +209,231 @@ def test_value_range_processor():
     assert str(query) == 'Xapian::Query(VALUE_RANGE 2 3 4)'
 
     assert_raises(xapian.QueryParserError, qp.parse_query, 'baz:abc..def')
+
+
+def test_float_values():
+
+    class Priced(xodb.Schema):
+        price = xodb.Float.named('price').using(sortable=True)
+
+    class Item(object):
+        def __init__(self, price):
+            self.price = price
+
+    db = xodb.temp()
+    db.map(Item, Priced)
+    db.add(Item(1.25), Item(9.5), Item(20.75))
+    db.flush()
+
+    assert db.value_sorts['price'] == 'float'
+    assert db.count('price:1..10') == 2
+    assert db.count('price:1.5..20.75') == 2
+    assert db.count('price:..1.25') == 1
+    assert [r.price for r in db.query('', order='price')] == [1.25, 9.5, 20.75]
+    shutil.rmtree(db.db_path)
+
+
+def test_float_terms():
+
+    class Weighed(xodb.Schema):
+        weight = xodb.Float.named('weight')
+
+    class Parcel(object):
+        def __init__(self, weight):
+            self.weight = weight
+
+    db = xodb.temp()
+    db.map(Parcel, Weighed)
+    db.add(Parcel(1.5), Parcel(2.0), Parcel(0.1))
+    db.flush()
+
+    # floats are found with plain term queries, and only sorted and
+    # ranged when sortable
+    assert 'weight' not in db.value_sorts
+    assert db.count('weight:1.5') == 1
+    assert db.count('weight:2') == 1
+    assert db.count('weight:0.1') == 1
+    assert db.count('weight:1') == 0
+    shutil.rmtree(db.db_path)
+
+
+def test_date_range_query():
+
+    class Dated(xodb.Schema):
+        day = xodb.Date.using(resolutions=('year', 'month', 'day'))
+
+    class Item(object):
+        def __init__(self, day):
+            self.day = day
+
+    db = xodb.temp()
+    db.map(Item, Dated)
+    db.add(Item(datetime.date(2010, 12, 31)),
+           Item(datetime.date(2011, 1, 1)),
+           Item(datetime.date(2011, 6, 15)),
+           Item(datetime.date(2012, 1, 1)))
+    db.flush()
+
+    q = db.date_range_query('day', datetime.date(2011, 1, 1),
+                            datetime.date(2011, 12, 31))
+    assert db.count(q) == 2
+    q = db.date_range_query('day', datetime.date(2010, 12, 31),
+                            datetime.date(2012, 1, 1))
+    assert db.count(q) == 4
+    assert db.count('day:2011') == 2
+    assert db.count('day:201106') == 1
+    shutil.rmtree(db.db_path)
+
+
+def test_date_range_query_without_prefix():
+
+    class Dated(xodb.Schema):
+        day = xodb.Date.using(resolutions=('year', 'month', 'day'),
+                              prefix=False)
+
+    class Item(object):
+        def __init__(self, day):
+            self.day = day
+
+    db = xodb.temp()
+    db.map(Item, Dated)
+    db.add(Item(datetime.date(2010, 12, 31)),
+           Item(datetime.date(2011, 6, 15)))
+    db.flush()
+
+    q = db.date_range_query('day', datetime.date(2011, 1, 1),
+                            datetime.date(2011, 12, 31))
+    assert db.count(q) == 1
+    shutil.rmtree(db.db_path)
+
+
+def test_complete():
+
+    class Placed(xodb.Schema):
+        city = xodb.Autocomplete.named('city')
+        population = xodb.Integer.using(sortable=True)
+
+    class Place(object):
+        def __init__(self, city, population):
+            self.city = city
+            self.population = population
+
+    db = xodb.temp()
+    db.map(Place, Placed)
+    db.add(Place(u'New York', 8),
+           Place(u'New York', 8),
+           Place(u'Newark', 1),
+           Place(u'New Orleans', 3),
+           Place(u'Boston', 4))
+    db.flush()
+
+    assert db.complete(u'new', 'city', limit=1) == [u'New York']
+    assert (set(db.complete(u'New', 'city')) ==
+            set([u'New York', u'Newark', u'New Orleans']))
+    assert (db.complete(u'new', 'city', weight='population') ==
+            [u'New York', u'New Orleans', u'Newark'])
+    assert db.complete(u'bos', 'city') == [u'Boston']
+    assert db.complete(u'chi', 'city') == []
+
+    assert db.complete(u'new', 'city', limit=1, cached=True) == [u'New York']
+    db.add(Place(u'Chicago', 3), Place(u'New York City Of Dreams', 1))
+    db.flush()
+    assert db.complete(u'chi', 'city', cached=True) == [u'Chicago']
+
+    # prefixes longer than max_length are looked up truncated
+    assert (db.complete(u'new york city of dreams', 'city') ==
+            [u'New York City Of Dreams'])
+    assert (db.complete(u'new york city of dreams', 'city',
+                        weight='population') == [u'New York City Of Dreams'])
+    assert db.complete(u'new york city of dreamz', 'city') == []
+    shutil.rmtree(db.db_path)
+
+
+def test_auto_reopen():
+    writer = xodb.temp()
+    writer.backend.add_document(xapian.Document())
+    writer.flush()
+
+    reader = xodb.open(writer.db_path, writable=False)
+    reader.auto_reopen = False
+    assert len(reader) == 1
+    revision = reader.revision
+
+    writer.backend.add_document(xapian.Document())
+    writer.flush()
+    assert len(reader) == 1
+    assert reader.revision == revision
+
+    reader.reopen(force=True)
+    assert len(reader) == 2
+    assert reader.revision != revision
+    shutil.rmtree(writer.db_path)
+
+
+class _OldBackend(object):
+    """A xapian database without get_revision."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def __getattr__(self, name):
+        if name == 'get_revision':
+            raise AttributeError(name)
+        return getattr(self.backend, name)
+
+
+def test_no_revision():
+    db = xodb.temp()
+    db.backend = _OldBackend(db.backend)
+    try:
+        assert db.revision is None
+    finally:
+        db.backend = db.backend.backend
+        shutil.rmtree(db.db_path)
+
+
+def test_schema_registry():
+
+    class Renamed(xodb.Schema):
+        schema_aliases = ('old.module.Original',)
+        name = xodb.String
+
+    class Thing(object):
+        def __init__(self, name):
+            self.name = name
+
+    assert lookup_schema(__name__ + '.Renamed') is Renamed
+    assert lookup_schema('old.module.Original') is Renamed
+
+    # schemas defined in a function can't be imported by name
+    db = xodb.temp()
+    db.map(Thing, Renamed)
+    db.add(Thing(u'bob'))
+    db.flush()
+    assert [r.name for r in db.query('name:bob')] == [u'bob']
+    shutil.rmtree(db.db_path)
+
+
+def test_schema_registry_conflict():
+
+    class Claimed(xodb.Schema):
+        schema_aliases = ('old.module.Claimed',)
+        name = xodb.String
+
+    class Other(xodb.Schema):
+        name = xodb.String
+
+    assert_raises(SchemaConflictError,
+                  register_schema, Other, 'old.module.Claimed')
+    assert lookup_schema('old.module.Claimed') is Claimed
+
+    # a class defined again under the same name replaces the old one
+    first = Claimed
+
+    class Claimed(xodb.Schema):
+        schema_aliases = ('old.module.Claimed',)
+        name = xodb.String
+
+    assert Claimed is not first
+    assert lookup_schema(__name__ + '.Claimed') is Claimed
+    assert lookup_schema('old.module.Claimed') is Claimed
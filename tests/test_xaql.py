@@ -0,0 +1,89 @@
+import shutil
+
+from nose.tools import assert_raises
+
+import xodb
+from xodb import xaql
+from xodb.exc import QuerySyntaxError
+from xodb.xaql import (
+    Compare,
+    Group,
+    Not,
+    Phrase,
+    Range,
+    Raw,
+    Rel,
+    Required,
+    Term,
+    )
+
+
+def test_terms():
+    assert xaql.parse('a').root == Term(None, u'a')
+    assert xaql.parse('A b').root == Group('default', (Term(None, u'a'),
+                                                       Term(None, u'b')))
+    assert xaql.parse('').root == Group('default', ())
+
+
+def test_operators():
+    assert xaql.parse('a AND b c').root == Group('default', (
+        Group('and', (Term(None, u'a'), Term(None, u'b'))),
+        Term(None, u'c')))
+    assert xaql.parse('a or b c').root == Group('or', (
+        Term(None, u'a'),
+        Group('default', (Term(None, u'b'), Term(None, u'c')))))
+    assert xaql.parse('NOT a -b +c').root == Group('default', (
+        Not(Term(None, u'a')), Not(Term(None, u'b')),
+        Required(Term(None, u'c'))))
+
+
+def test_prefixes():
+    assert xaql.parse('name:"My Lagoon"').root == Phrase(
+        u'name', (u'my', u'lagoon'))
+    assert xaql.parse('color:(red OR green)').root == Group('or', (
+        Term(u'color', u'red'), Term(u'color', u'green')))
+    assert xaql.parse('e-mail').root == Term(None, u'e-mail')
+
+
+def test_values():
+    assert xaql.parse('salary:1000..5000').root == Range(
+        u'salary', u'1000', u'5000')
+    assert xaql.parse('hired:2010..').root == Range(u'hired', u'2010', None)
+    expression = xaql.parse('published:..$now')
+    assert expression.root == Range(u'published', None, xaql.NOW)
+    assert expression.volatile
+    expression = xaql.parse('published-before:now')
+    assert expression.root == Compare(u'published', u'before', xaql.NOW)
+    assert expression.volatile
+    assert not xaql.parse('published-after:2010').volatile
+
+
+def test_functions():
+    assert xaql.parse('$xp(a (b) c:"d)")').root == Raw(u'a (b) c:"d)"')
+    assert xaql.parse('$rel(cheap) shoes').root == Group('default', (
+        Rel(Term(None, u'cheap')), Term(None, u'shoes')))
+
+
+def test_errors():
+    for query in ('(a', 'a)', 'a AND', '$foo', '$now', '$xp(a', '$rel a',
+                  'salary:..', 'salary:1..2..3'):
+        assert_raises(QuerySyntaxError, xaql.parse, query)
+
+
+def test_compile():
+    db = xodb.temp()
+    try:
+        db.add_value('salary', 'integer')
+        for query in ('', '()', '""', '(() "")'):
+            assert xaql.parse(query).compile(db).empty()
+        for query in ('a ()', '-a', '-a ()'):
+            assert not xaql.parse(query).compile(db).empty()
+        for query in ('salary:abc..', 'salary:..1x', 'salary-before:abc'):
+            assert_raises(QuerySyntaxError, xaql.parse(query).compile, db)
+        assert not xaql.parse('salary:1..').compile(db).empty()
+    finally:
+        shutil.rmtree(db.db_path)
+
+
+def test_cache():
+    assert xaql.parse('cached query') is xaql.parse('cached query')
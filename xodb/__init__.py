@@ -10,13 +10,16 @@ from . database import (
     JSONDatabase,
     LanguageDecider,
     MultipleValueRangeProcessor,
+    RecordCache,
     )
 
 from . elements import (
     Array,
+    Autocomplete,
     Date,
     DateTime,
     Dict,
+    Float,
     Integer,
     List,
     Location,
@@ -24,16 +27,19 @@ from . elements import (
     Schema,
     String,
     Text,
+    register_schema,
     )
 
 from . search import Search
 
 __all__ = [
     'Array',
+    'Autocomplete',
     'Database',
     'Date',
     'DateTime',
     'Dict',
+    'Float',
     'Integer',
     'JSONDatabase',
     'LanguageDecider',
@@ -41,6 +47,7 @@ __all__ = [
     'Location',
     'MultipleValueRangeProcessor',
     'NumericRange',
+    'RecordCache',
     'Schema',
     'Search',
     'String',
@@ -48,6 +55,7 @@ __all__ = [
     'geoprint',
     'inmemory',
     'open',
+    'register_schema',
     'temp',
     ]
 
@@ -1,24 +1,28 @@
 import time
 
+import heapq
 import string
 import logging
+from bisect import bisect_left
 from functools import wraps
 from collections import namedtuple, OrderedDict
 from contextlib import contextmanager
 
 import xapian
-import nilsimsa
+from flatland.schema import Container
 
 from operator import itemgetter
+from itertools import izip
 from functools import partial
 from json import loads
 
 from xapian import Query, QueryParser, DocNotFoundError
 
-from . import snowball
-from .elements import Schema
+from . import snowball, xaql
+from .elements import (
+    Schema, Autocomplete, _normalize, lookup_schema, register_schema)
 from .exc import ValidationError, PrefixError
-from .tools import LRUDict, lazy_property
+from .tools import LRUCache, lazy_property, dates
 
 
 RETRY_LIMIT = 5
@@ -48,11 +52,7 @@ def defaults(head, limit=0, mlimit=0, klimit=1.0, kmlimit=1.0):
     return (head, limit, mlimit, klimit, kmlimit)
 
 
-def _lookup_schema(name):
-    modname, expr = name.rsplit('.', 1)
-    local_name = modname.split('.')[-1]
-    mod = __import__(modname, {}, {}, local_name)
-    return eval(expr, mod.__dict__)
+_lookup_schema = lookup_schema
 
 
 def _prefix(name):
@@ -64,34 +64,160 @@ def to_term(value, prefix=None):
     return _prefix(prefix) + value if prefix else value
 
 
+_scalar_fields = {}
+
+
+def _scalar_field(schema_type, name):
+    """Return the element class of a scalar field of a schema, or None
+    for containers and unknown names."""
+    fields = _scalar_fields.get(schema_type)
+    if fields is None:
+        fields = _scalar_fields[schema_type] = dict(
+            (field.name, field) for field in schema_type.field_schema
+            if not issubclass(field, Container))
+    return fields.get(name)
+
+
+class RecordCache(LRUCache):
+    """A least recently used cache of decoded record data, bounded by
+    the size in bytes of the stored data it holds.
+
+    Entries are keyed by database, docid and the revision the data was
+    read at, so a new revision never sees data from an older one; stale
+    entries are simply never asked for again and age out.  One instance
+    can be shared by every database and thread in the process through
+    Database.record_cache.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        super(RecordCache, self).__init__(limit=None, max_bytes=max_bytes)
+
+
+class RecordView(object):
+    """A read-only view of the data stored with a document.
+
+    The stored (flattened name, value) pairs are kept as a dictionary,
+    which is never changed and may be shared with a RecordCache,
+    and the value of a scalar field is adapted from its pair the first
+    time it is asked for, without building the rest of the schema.
+    Everything else, and the full schema, comes from Schema.from_flat.
+    """
+
+    __slots__ = ('schema_type', 'flat', 'values', 'full')
+
+    def __init__(self, schema_type, flat):
+        self.schema_type = schema_type
+        self.flat = flat
+        self.values = {}
+        self.full = None
+
+    def __getitem__(self, name):
+        """Return the value of a field, raising KeyError if the schema
+        has no such field."""
+        try:
+            return self.values[name]
+        except KeyError:
+            pass
+        field = _scalar_field(self.schema_type, name)
+        if field is not None and name in self.flat:
+            value = field.from_flat([(name, self.flat[name])]).value
+        else:
+            schema = self.schema()
+            if name not in schema:
+                schema.setdefault(name)
+            value = schema[name].value
+        self.values[name] = value
+        return value
+
+    def schema(self):
+        """Return the full schema of the stored data."""
+        if self.full is None:
+            self.full = self.schema_type.from_flat(self.flat)
+        return self.full
+
+
+class ResultSet(object):
+    """The fields shared by all the records of one query."""
+
+    __slots__ = ('query', 'db')
+
+    def __init__(self, query, db):
+        self.query = query
+        self.db = db
+
+
 class Record(object):
-    """Nice attribute-accessable record for a search result."""
+    """Nice attribute-accessable record for a search result.
+
+    Records have no instance dictionary, the query and database they
+    came from are kept in a ResultSet shared by the records of a query.
+    Attributes are read through a RecordView of the stored data;
+    _xodb_schema builds the full schema.
+    """
+
+    __slots__ = ('_xodb_document', '_id', '_xodb_percent', '_xodb_rank',
+                 '_xodb_weight', '_xodb_results', '_loaded', '_xodb_cached')
 
-    def __init__(self, document, percent, rank, weight, query, db):
+    def __init__(self, document, percent, rank, weight, query=None, db=None,
+                 results=None):
         self._xodb_document = document
         self._id = document.get_docid()
         self._xodb_percent = percent
         self._xodb_rank = rank
         self._xodb_weight = weight
-        self._xodb_query = query
-        self._xodb_db = db
+        self._xodb_results = results or ResultSet(query, db)
         self._loaded = False
+        self._xodb_cached = None
 
-    @lazy_property
-    def _xodb_schema(self):
+    @property
+    def _xodb_query(self):
+        return self._xodb_results.query
 
-        def get_schema():
+    @property
+    def _xodb_db(self):
+        return self._xodb_results.db
+
+    @property
+    def _xodb_view(self):
+        if self._xodb_cached is None:
+            self._xodb_cached = self._load_view()
+        return self._xodb_cached
+
+    @property
+    def _xodb_schema(self):
+        return self._xodb_view.schema()
+
+    def _load_view(self):
+        db = self._xodb_db
+        cache = db.record_cache
+        # writable databases can replace documents without a new
+        # revision until they commit, and without a revision stale
+        # data can't be told apart, so neither is cached
+        if db._writable or db.revision is None:
+            cache = None
+
+        def get_view():
+            if cache is not None:
+                key = (db.db_path, self._id, db.revision)
+                cached = cache.get(key)
+                if cached is not None:
+                    self._loaded = True
+                    return RecordView(*cached)
             try:
                 json = self._xodb_document.get_data()
             except xapian.DatabaseError:
                 # _xodb_document has a pointer to a closed database
-                self._xodb_document = self._xodb_db.backend.get_document(self._id)
+                self._xodb_document = db.backend.get_document(self._id)
                 json = self._xodb_document.get_data()
             typ, data = loads(json)
+            schema_type = _lookup_schema(typ)
+            flat = dict(data)
+            if cache is not None:
+                cache.set(key, (schema_type, flat), len(json))
             self._loaded = True
-            return _lookup_schema(typ).from_flat(data)
+            return RecordView(schema_type, flat)
 
-        return self._xodb_db.retry_if_modified(get_schema, RETRY_LIMIT)
+        return db.retry_if_modified(get_view, RETRY_LIMIT)
 
     def __getattr__(self, name):
         if self._xodb_db.use_values and not self._loaded:
@@ -99,40 +225,64 @@ class Record(object):
             # if value is available
             sort = self._xodb_db.value_sorts.get(name)
             # TODO: date, datetime
-            if sort and sort in ('integer', 'string'):
+            if sort and sort in ('integer', 'float', 'string'):
                 num = self._xodb_db.values[name]
                 def get_val():
                     return self._xodb_document.get_value(num)
                 val = self._xodb_db.retry_if_modified(get_val, 3)
-                if sort == 'integer':
+                if sort in ('integer', 'float'):
                     val = xapian.sortable_unserialise(val)
                 return val
         try:
-            if name not in self._xodb_schema:
-                self._xodb_schema.setdefault(name)
-            return self._xodb_schema[name].value
+            return self._xodb_view[name]
         except (KeyError, TypeError):
             raise AttributeError(name)
 
     def __repr__(self):
         return repr(self._xodb_schema)
 
+    # the state is the instance dictionary records had before they
+    # had slots, so either kind can read the other's pickles
     def __getstate__(self):
-        state = self.__dict__.copy()
-        if '_xodb_schema' in state:
-            del state['_xodb_schema']
-        state['_xodb_document'] = self._xodb_document.serialise()
-        return state
+        return dict(_xodb_document=self._xodb_document.serialise(),
+                    _id=self._id,
+                    _xodb_percent=self._xodb_percent,
+                    _xodb_rank=self._xodb_rank,
+                    _xodb_weight=self._xodb_weight,
+                    _xodb_query=self._xodb_query,
+                    _xodb_db=self._xodb_db,
+                    _loaded=self._loaded)
 
     def __setstate__(self, state):
-        self.__dict__.update(state)
-        self._xodb_document = xapian.Document.unserialise(self._xodb_document)
+        self._xodb_document = xapian.Document.unserialise(
+            state['_xodb_document'])
+        self._id = state['_id']
+        self._xodb_percent = state['_xodb_percent']
+        self._xodb_rank = state['_xodb_rank']
+        self._xodb_weight = state['_xodb_weight']
+        self._xodb_results = ResultSet(state['_xodb_query'],
+                                       state['_xodb_db'])
+        self._loaded = False
+        self._xodb_cached = None
 
 
 def record_factory(database, doc, percent, rank, weight, query, db):
     return Record(doc, percent, rank, weight, query, db)
 
 
+def bulk_record_factory(database, items, query):
+    """Return the records of a list of mset items at once.  Records
+    made by the default record_factory share one ResultSet."""
+    factory = database.record_factory
+    if getattr(factory, '__func__', None) is not record_factory:
+        # a custom factory makes every record itself
+        return [factory(item.document, item.percent, item.rank,
+                        item.weight, query, database) for item in items]
+    results = ResultSet(query, database)
+    return [Record(item.document, item.percent, item.rank, item.weight,
+                   results=results) for item in items]
+
+
 class LanguageDecider(xapian.ExpandDecider):
     """
     A Xapian ExpandDecider that decide which terms to keep and which
@@ -266,6 +416,7 @@ class Database(object):
     """
 
     record_factory = record_factory
+    bulk_record_factory = bulk_record_factory
 
     relevance_prefix = "_XODB_RP_"
     boolean_prefix = "_XODB_BP_"
@@ -275,8 +426,28 @@ class Database(object):
     backend = None
     _metadata_keyset = None
     query_cache_limit = 1024
+    query_cache_bytes = None
+    """Bound the query cache by the length of the descriptions of the
+    queries it holds, as well as by query_cache_limit."""
+    completion_index_limit = 64
+    """How many fields complete() keeps term indexes for."""
     use_values = True
 
+    record_cache = None
+    """A RecordCache records look their decoded data up in before
+    reading it from the document.  Set it on Database to share one
+    cache between every read-only database in the process."""
+
+    complete_reopen_interval = 1.0
+    """Seconds between the reopens of complete(), which is called on
+    every keystroke."""
+    _completed_at = 0
+
+    auto_reopen = True
+    """Reopen the database before most query methods.  Set to False
+    when something else reopens the database as it changes, like a
+    network worker listening for revision events."""
+
     @contextmanager
     def transaction(self):
         self.begin()
@@ -299,7 +470,7 @@ class Database(object):
                     raise
                 logger.info('%s: after %s retries, retrying', e, tries)
                 time.sleep(tries * RETRY_BACKOFF_FACTOR)
-                self.reopen(refresh_if_needed=refresh)
+                self.reopen(refresh_if_needed=refresh, force=True)
                 tries += 1
 
     def __init__(self, path,
@@ -319,7 +490,9 @@ class Database(object):
         self.boolean_prefixes = {}
         self.values = {}
         self.value_sorts = {}
-        self.query_cache = LRUDict(limit=self.query_cache_limit)
+        self.query_cache = self._query_cache()
+        self.completion_indexes = LRUCache(
+            limit=self.completion_index_limit)
         self.inmem = inmem
         self._value_count = 0
         self._timeout = 10000
@@ -346,7 +519,12 @@ class Database(object):
                 raise TypeError("replication can only be used "
                                 "if a database path is provided.")
             self.reconnect()
-        self.reopen()
+        self.reopen(force=True)
+
+    def _query_cache(self):
+        return LRUCache(limit=self.query_cache_limit,
+                        max_bytes=self.query_cache_bytes,
+                        sizeof=lambda query: len(str(query)))
 
     def get_query_parser(self, language, default_op, check_cache=True,
                          retry_limit=RETRY_LIMIT):
@@ -380,8 +558,10 @@ class Database(object):
         self.backend.flush()
 
     def map(self, otype, schema):
-        """Map a type to a schema."""
+        """Map a type to a schema, and make it the schema its
+        documents are decoded with."""
         self.type_map[otype] = schema
+        register_schema(schema)
 
     def schema_for(self, otype):
         """Get the schema for a given type, or one of its
@@ -459,6 +639,19 @@ class Database(object):
             self.backend.set_metadata(self.value_sort_prefix + name, sort)
         return value_index
 
+    @property
+    def revision(self):
+        """The revision of the backend database, or None with Xapian
+        versions that do not expose it.
+
+        Nothing is cached by revision when it is None, since there is
+        no telling when the contents changed.
+        """
+        try:
+            return self.backend.get_revision()
+        except AttributeError:
+            return None
+
     def __nonzero__(self):
         return True
 
@@ -686,7 +879,7 @@ class Database(object):
                 valno = self.values[name]
             else:
                 valno = self.add_value(name, typ)
-            if typ in ('integer',):
+            if typ in ('integer', 'float'):
                 value = xapian.sortable_serialise(value)
             doc.add_value(valno, value)
 
@@ -695,11 +888,16 @@ class Database(object):
             doc.set_data(data)
         return doc
 
-    def reopen(self, retry_limit=RETRY_LIMIT, refresh_if_needed=True):
+    def reopen(self, retry_limit=RETRY_LIMIT, refresh_if_needed=True,
+               force=False):
         """
         Reopen the database.  Called before most query methods.  If
         replication is used, the db is closed and reopened.
+
+        Does nothing if auto_reopen is False, unless *force* is True.
         """
+        if not (self.auto_reopen or force):
+            return
         if not self.replicated:
             self.backend.reopen()
         else:
@@ -762,7 +960,8 @@ class Database(object):
             # First add numeric values ranges
             qp.add_valuerangeprocessor(MultipleValueRangeProcessor(
                 dict(((k, self.values[k])
-                      for k, v in self.value_sorts.items() if v == 'integer')),
+                      for k, v in self.value_sorts.items()
+                      if v in ('integer', 'float'))),
                 serializer=lambda s: xapian.sortable_serialise(
                     float(s) if s else float('-inf')),
                 end_serializer=lambda s: xapian.sortable_serialise(
@@ -809,7 +1008,7 @@ class Database(object):
             self.boolean_prefixes = {}
             self.values = {}
             self.value_sorts = {}
-            self.query_cache = LRUDict(limit=self.query_cache_limit)
+            self.query_cache = self._query_cache()
 
             self._metadata_keyset = self._get_metadata_keyset()
             for k in self._metadata_keyset:
@@ -848,22 +1047,34 @@ class Database(object):
 
         If 'query' is a xapian query object, it is returned unchanged.
         If it's a string, it is parsed with xapian's query parser and
-        returned.  If it is a sequence, a new query is constructed
+        returned.  If it is a parsed xaql expression, it is compiled.
+        If it is a sequence, a new query is constructed
         with the 'default_op' operator and the sequence is iterated
         into the new query, recursively querify on each item of the
         sequence.
         """
         if isinstance(query, Query):
             return query
+        if isinstance(query, xaql.Expression):
+            if query.volatile or self.inmem:
+                return query.compile(self, language, default_op)
+            cache_key = (query, language, default_op)
+            result = self.query_cache.get(cache_key)
+            if result is None:
+                result = self.query_cache[cache_key] = query.compile(
+                    self, language, default_op)
+            return result
         if isinstance(query, basestring):
             if query == "":
                 return Query("")
             else:
                 cache_key = (query, language, translit, default_op, parser_flags)
-                if cache_key in self.query_cache:
-                    return self.query_cache[cache_key]
+                result = self.query_cache.get(cache_key)
+                if result is not None:
+                    return result
                 query = query.lower()
                 if translit:
+                    import translitcodec  # registers the translit codecs
                     query = query.encode(translit)
 
                 qp = self.get_query_parser(language, default_op,
@@ -942,8 +1153,9 @@ class Database(object):
 
         tries = 0
         seen = set()
-        disimilator = LRUDict(limit=disimilate_window)
+        disimilator = LRUCache(limit=disimilate_window)
         def _simhash_distance(hash1, hash2):
+            import nilsimsa  # only needed when disimilating
             return 128 - nilsimsa.compare_hexdigests(hash1, hash2)
 
         while True:
@@ -955,23 +1167,19 @@ class Database(object):
                 if echo:
                     print "Fetched mset in %s" % str(time.time() - start)
 
-                for record in mset:
-                    doc = record.document
-                    docid = doc.get_docid()
-                    if docid in seen:
+                items = list(mset)
+                if document:
+                    records = [item.document for item in items]
+                else:
+                    records = self.bulk_record_factory(items, query)
+
+                for item, record in izip(items, records):
+                    if item.docid in seen:
                         continue
+                    seen.add(item.docid)
                     if document:
-                        seen.add(docid)
-                        yield doc
+                        yield record
                     else:
-                        seen.add(docid)
-                        record = self.record_factory(doc,
-                                                     record.percent,
-                                                     record.rank,
-                                                     record.weight,
-                                                     query,
-                                                     self,
-                                                     )
                         if disimilate:
                             yield_it = True
                             rhash = getattr(record, disimilate_field, None)
@@ -1151,6 +1359,28 @@ class Database(object):
 
         return mset.get_matches_estimated()
 
+    def date_range_query(self, name, begin, end,
+                         resolutions=('year', 'month', 'day')):
+        """Return a boolean query that matches the Date or DateTime
+        element *name* between *begin* and *end*, inclusive.
+
+        The range is broken into the fewest year, month, day or hour
+        bucket terms drawn from *resolutions*, which must be indexed
+        by the element (see Date.resolutions), and OR'ed together.
+        Day terms are always indexed with the default term format.
+
+        Like the element's own terms, the bucket terms are prefixed
+        with *name* only if the database knows it as a prefix, elements
+        declared with prefix=False index them bare.
+        """
+        if name in self.boolean_prefixes or name in self.relevance_prefixes:
+            prefix = name
+        else:
+            prefix = None
+        terms = [to_term(value, prefix)
+                 for value in dates.buckets(begin, end, resolutions)]
+        return Query(Query.OP_SCALE_WEIGHT, Query(Query.OP_OR, terms), 0)
+
     @reconnector
     def term_freq(self, term):
         """
@@ -1278,6 +1508,127 @@ class Database(object):
             else:
                 yield val
 
+    @reconnector
+    def complete(self, prefix, field,
+                 limit=10,
+                 weight=None,
+                 mlimit=100,
+                 cached=False,
+                 max_length=Autocomplete.max_length,
+                 retry_limit=RETRY_LIMIT):
+        """
+        Return up to *limit* completions of *prefix* for the
+        Autocomplete element *field*, as the values they were stored
+        with.
+
+        Completions are ranked by the number of documents that have
+        them, or if *weight* names a sortable value, by the highest
+        weight of any document with that completion.  Termfreq ranking
+        considers at most *mlimit* distinct completions (0 for all).
+
+        Prefixes longer than the element's *max_length* are looked up
+        by their first *max_length* characters, and the completions
+        that don't start with the whole prefix are dropped.
+
+        If *cached* is True, completions are looked up in an
+        in-memory sorted index of the field's terms that is rebuilt
+        whenever the database revision changes, or on every call when
+        the revision is unknown.  Cached completions can only be
+        ranked by termfreq.
+
+        The database is reopened at most every
+        complete_reopen_interval seconds.
+        """
+        now = time.time()
+        if now - self._completed_at >= self.complete_reopen_interval:
+            self.reopen()
+            self._completed_at = now
+        try:
+            valno = self.values[field]
+        except KeyError:
+            raise ValueError("There is no completion field %s" % field)
+        prefix = _normalize(prefix)
+        if cached:
+            if weight is not None:
+                raise ValueError("Cached completions cannot be weighted")
+            index = self._completion_index(field, retry_limit)
+            terms, freqs = index[1], index[2]
+            lo = bisect_left(terms, prefix)
+            hi = bisect_left(terms, prefix + '\xff', lo)
+            top = heapq.nlargest(limit, xrange(lo, hi), key=freqs.__getitem__)
+            return [self._completion_value(index, field, valno, terms[i],
+                                           retry_limit)
+                    for i in top]
+
+        truncated = prefix.decode('utf8')[:max_length].encode('utf8')
+        enq = xapian.Enquire(self.backend)
+        enq.set_query(Query(_prefix(field + Autocomplete.suffix) + truncated))
+        enq.set_collapse_key(valno)
+
+        def matches(value):
+            return (truncated == prefix or
+                    _normalize(value.decode('utf8')).startswith(prefix))
+
+        if weight is not None:
+            mset = self._build_mset(enq,
+                                    limit=limit if truncated == prefix
+                                    else mlimit or None,
+                                    order=weight, reverse=True,
+                                    retry_limit=retry_limit)
+            values = (m.document.get_value(valno) for m in mset)
+            return [value.decode('utf8') for value in values
+                    if matches(value)][:limit]
+
+        mset = self._build_mset(enq, limit=mlimit or None,
+                                retry_limit=retry_limit)
+        term_prefix = _prefix(field)
+        completions = []
+        for m in mset:
+            value = m.document.get_value(valno)
+            if not matches(value):
+                continue
+            freq = self.backend.get_termfreq(term_prefix + _normalize(value))
+            completions.append((freq, value.decode('utf8')))
+        return [value for freq, value in heapq.nlargest(limit, completions)]
+
+    def _completion_index(self, field, retry_limit=RETRY_LIMIT):
+        """Return the (revision, terms, freqs, values) completion index
+        of a field, with its sorted terms and their termfreqs, rebuilt
+        if the database has changed.  *values* holds the stored values
+        of the terms looked up so far.
+        """
+        revision = self.revision
+        index = self.completion_indexes.get(field)
+        if index is None or revision is None or index[0] != revision:
+            prefix = _prefix(field)
+            def op():
+                terms = []
+                freqs = []
+                for t in self.backend.allterms(prefix):
+                    terms.append(t.term[len(prefix):])
+                    freqs.append(t.termfreq)
+                return terms, freqs
+            terms, freqs = self.retry_if_modified(op, retry_limit)
+            index = (revision, terms, freqs, {})
+            if revision is not None:
+                self.completion_indexes.set(field, index)
+        return index
+
+    def _completion_value(self, index, field, valno, term,
+                          retry_limit=RETRY_LIMIT):
+        """Return the stored value of a completion term, read from the
+        first document that has it."""
+        values = index[3]
+        value = values.get(term)
+        if value is None:
+            def op():
+                for posting in self.backend.postlist(_prefix(field) + term):
+                    document = self.backend.get_document(posting.docid)
+                    return document.get_value(valno).decode('utf8')
+                return term.decode('utf8')
+            value = values[term] = self.retry_if_modified(op, retry_limit)
+        return value
+
     def _build_mset(self, enq,
                     offset=0,
                     limit=None,
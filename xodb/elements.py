@@ -1,19 +1,17 @@
 import logging
 import unicodedata
-import translitcodec
-import cPickle
 
-import nilsimsa
 from flatland import schema
 from flatland.schema.forms import _MetaForm
 from flatland.exc import AdaptationError
 from json import dumps
 
 from . memo import Memo
-from . tools import geoprint
+from . tools import geoprint, dates
 
 from .exc import (
     InvalidTermError,
+    SchemaConflictError,
     )
 
 logger = logging.getLogger(__name__)
@@ -22,6 +20,47 @@ def _schema_name(schema):
     return "%s.%s" % (schema.__module__, schema.__class__.__name__)
 
 
+_schemas = {}
+"""Schema classes by the names their documents are stored under."""
+
+
+def register_schema(schema, *names):
+    """Decode documents stored under each of *names* with *schema*.
+    With no names, registers the schema under its own name.  Schema
+    classes register themselves when they are defined.
+
+    Registering a name that already belongs to a different schema
+    raises :class:`SchemaConflictError`, unless the registered class
+    has the same module and name, as when a class is redefined or its
+    module reloaded; that replaces it with a warning.
+    """
+    own_name = "%s.%s" % (schema.__module__, schema.__name__)
+    for name in names or (own_name,):
+        registered = _schemas.get(name)
+        if registered is not None and registered is not schema:
+            registered_name = "%s.%s" % (registered.__module__,
+                                         registered.__name__)
+            if registered_name != own_name:
+                raise SchemaConflictError(
+                    "%s is already registered to %s, not %s" % (
+                        name, registered_name, own_name))
+            logger.warning("Schema %s redefined, %s now decodes with "
+                           "the new class", own_name, name)
+        _schemas[name] = schema
+
+
+def lookup_schema(name):
+    """Return the schema class for a stored schema name.  Names of
+    schemas that were never registered are imported."""
+    schema = _schemas.get(name)
+    if schema is None:
+        modname, expr = name.rsplit('.', 1)
+        local_name = modname.split('.')[-1]
+        mod = __import__(modname, {}, {}, local_name)
+        schema = _schemas[name] = eval(expr, mod.__dict__)
+    return schema
+
+
 def _prefix(prefix, value=None):
     if prefix is None:
         return
@@ -45,7 +84,16 @@ class SparseForm(schema.SparseDict):
     minimum_fields = 'required'
 
 
+class _MetaSchema(_MetaForm):
+
+    def __init__(cls, name, bases, members):
+        super(_MetaSchema, cls).__init__(name, bases, members)
+        register_schema(cls)
+        register_schema(cls, *members.get('schema_aliases', ()))
+
+
 class Schema(SparseForm):
+    __metaclass__ = _MetaSchema
 
     language = None
     """The overarching language for this schema.
@@ -68,6 +116,11 @@ class Schema(SparseForm):
     When False (default) an invalid term in a document raises InvalidTermError.
     """
 
+    schema_aliases = ()
+    """Other names documents of this schema are stored under, like the
+    names of the schema before it was renamed or moved.
+    """
+
     __xodb_db__ = None
 
     def update_by_object(self, obj):
@@ -116,7 +169,9 @@ class Schema(SparseForm):
     def _handle_children(self, parent, grandparent):
         for el in parent.children:
             if el.index:
-                if isinstance(el, String):
+                if isinstance(el, Autocomplete):
+                    handler = self._handle_autocomplete
+                elif isinstance(el, String):
                     handler = self._handle_string
                 elif isinstance(el, Integer):
                     handler = self._handle_integer
@@ -183,6 +238,19 @@ class Schema(SparseForm):
         if value:
             return self._handle_scalar(term, value, element, 'string')
 
+    def _handle_autocomplete(self, element, parent):
+        value = element.value
+        if not value:
+            return
+        memo = self._memo
+        prefix = element.flattened_name() + element.suffix
+        normal = _normalize(value, lower=element.lower).decode('utf-8')
+        for i in xrange(element.min_length,
+                        min(len(normal), element.max_length) + 1):
+            memo.add_term(_normalize(_prefix(prefix, normal[:i]),
+                                     lower=element.lower), True)
+        return self._handle_scalar(element.u, value, element, 'string')
+
     def _handle_integer(self, element, parent):
         term = element.u
         value = element.value
@@ -190,8 +258,14 @@ class Schema(SparseForm):
             return self._handle_scalar(term, value, element, 'integer')
 
     def _handle_float(self, element, parent):
-        # TODO:mp floats are currently storage only
-        pass
+        value = element.value
+        if value is not None:
+            # the shortest repr, so that 'price:1.5' and 'price:2'
+            # find 1.5 and 2.0 whatever format the element renders
+            term = unicode(repr(float(value)))
+            if term.endswith(u'.0'):
+                term = term[:-2]
+            return self._handle_scalar(term, value, element, 'float')
 
     def _handle_boolean(self, element, parent):
         value = 'true' if element.value else 'false'
@@ -202,14 +276,28 @@ class Schema(SparseForm):
         if element.value:
             term = element.value.strftime(element.term_format)
             value = element.value.strftime(element.value_format)
+            self._handle_resolutions(element)
             return self._handle_scalar(term, value, element, 'date')
 
     def _handle_datetime(self, element, parent):
         if element.value:
             term = element.value.strftime(element.term_format)
             value = element.value.strftime(element.value_format)
+            self._handle_resolutions(element)
             return self._handle_scalar(term, value, element, 'datetime')
 
+    def _handle_resolutions(self, element):
+        name = element.flattened_name()
+        for resolution in element.resolutions:
+            fmt = dates.resolutions[resolution]
+            if fmt == element.term_format:
+                continue
+            term = element.value.strftime(fmt)
+            if element.prefix:
+                term = _prefix(name, term)
+            self._memo.add_term(_normalize(term), element.boolean,
+                                element.wdf_inc)
+
     def _handle_text(self, element, parent):
         value = element.value
         if value is None:
@@ -223,6 +311,7 @@ class Schema(SparseForm):
             lang = element.language
 
         if element.translit:
+            import translitcodec  # registers the translit codecs on first use
             value = value.encode(element.translit)
 
         if element.string:
@@ -379,11 +468,38 @@ class String(schema.String, _BaseElement):
     pass
 
 
+class Autocomplete(String):
+    """A string that can be completed from a prefix.
+
+    In addition to the usual string term, every leading edge n-gram of
+    the value is indexed under the element's name plus *suffix*, so
+    that Database.complete() can look up a prefix as a single term
+    instead of expanding a wildcard over the term list.
+    """
+
+    sortable = True
+    """Completions are read back out of the value slot, so
+    autocomplete elements are always sortable.
+    """
+
+    suffix = '_ac'
+    """Suffix appended to the flattened name to make the n-gram
+    term prefix, i.e. 'city_ac:new'.
+    """
+
+    min_length = 1
+    """Shortest prefix that will be indexed."""
+
+    max_length = 20
+    """Longest prefix that will be indexed.  Longer prefixes will
+    not match anything.
+    """
+
+
 class Integer(schema.Integer, _BaseElement):
     pass
 
 
-# TODO:mp, float are currently storage only
 class Float(schema.Float, _BaseElement):
     pass
 
@@ -394,6 +510,15 @@ class Date(schema.Date, _BaseElement):
     """Format for rendering terms for this date.
     """
 
+    resolutions = ()
+    """Extra resolutions to index bucket terms at.
+
+    Any of 'year', 'month', 'day' and 'hour'.  Each resolution adds
+    one more term for the element, i.e. 'year' adds 'name:2011' and
+    'month' adds 'name:201103'.  Database.date_range_query() can then
+    cover a range of dates with a few bucket terms.
+    """
+
     value_format = '%Y%m%d'
     """Format for rendering value for this date.
     """
@@ -405,6 +530,12 @@ class DateTime(schema.DateTime, _BaseElement):
     """Format for rendering terms for this date.
     """
 
+    resolutions = ()
+    """Extra resolutions to index bucket terms at.
+
+    Any of 'year', 'month', 'day' and 'hour'.  See Date.resolutions.
+    """
+
     value_format = '%Y%m%d%H%M%S'
     """Format for rendering value for this date.
     """
@@ -22,3 +22,11 @@ class ValidationError(XODBError):
 
 class PrefixError(XODBError):
     pass
+
+
+class SchemaConflictError(XODBError):
+    pass
+
+
+class QuerySyntaxError(XODBError):
+    pass
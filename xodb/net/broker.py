@@ -1,31 +1,138 @@
 import zmq
 import time
 import logging
-from cPickle import loads, dumps
+from cPickle import loads
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
+
+from xodb.tools import LRUCache
+from xodb.net import envelope, stream, stats
+from xodb.net.codec import get_codec, from_config
+from xodb.net.worker import REVISION_EVENT, HEARTBEAT, HEARTBEAT_INTERVAL
+
+
+FRONTEND_BATCH = 100
+"""The most requests taken off the front end socket at once."""
+
+ZERO_COPY_THRESHOLD = 65536
+"""Payload frames at least this many bytes long are forwarded without
+being copied.  Smaller frames are cheaper to copy than to track."""
+
+
+def payload_bytes(frame):
+    """Return the bytes of a payload that may be a zmq.Frame."""
+    if isinstance(frame, zmq.Frame):
+        return frame.bytes
+    return frame
 
 
 class RetryError(Exception):
     """A client request was tried too many times. """
 
 
-class Broker(object):
+class OverloadError(Exception):
+    """Too many requests were queued, the request was rejected. """
 
-    def __init__(self, worker_url, client_url, events_url, retry_limit=3):
+
+class RequestTimeoutError(Exception):
+    """A worker ran the request for longer than the request timeout. """
+
+
+class Broker(object):
+    """Routes client requests to workers.
+
+    With *coalesce*, a request that is byte for byte the same as one
+    already being handled by a worker is not sent to a worker of its
+    own; it gets a copy of the first request's reply.  With a
+    *cache_size*, up to that many replies, and at most *cache_bytes* of
+    them if given, are kept for *cache_ttl* seconds and returned for
+    identical requests, as long as no writer announced a new revision
+    since the reply's request was sent.  Only use these for idempotent
+    (read) requests.
+
+    Requests are queued by the priority in their envelope (see
+    xodb.net.envelope) and sent to workers most urgent first.  Requests
+    whose deadline passes while they are queued are dropped, the client
+    has given up on them.  If *max_queue* requests are already queued,
+    new ones are rejected with an OverloadError right away.
+
+    Workers that send heartbeats are evicted if they are idle and go
+    *heartbeat_timeout* milliseconds without one.  With a
+    *request_timeout*, a worker that has been running a request for
+    longer than that many milliseconds is considered hung; it is
+    evicted, the requests that timed out fail with a RequestTimeoutError
+    so one bad query can't hang worker after worker, and its other
+    requests are retried on other workers.  Evicted
+    workers that come back are registered again by their next
+    heartbeat.
+
+    The broker keeps metrics of its queues, workers and the requests
+    to each method (see xodb.net.stats), which it logs every minute
+    and returns to clients that ask for them.
+    """
+
+    def __init__(self, worker_url, client_url, events_url, retry_limit=3,
+                 codec='pickle', coalesce=False, cache_size=0, cache_ttl=60,
+                 cache_bytes=None, max_queue=0, heartbeat_timeout=5000,
+                 request_timeout=0):
         self.worker_url = worker_url
         self.client_url = client_url
         self.events_url = events_url
         self.retry_limit = retry_limit
+        self.codec = get_codec(codec)
+
+        self.coalesce = coalesce
+        self.cache_ttl = cache_ttl
+        self.cache = (LRUCache(limit=cache_size, max_bytes=cache_bytes,
+                               ttl=cache_ttl, sizeof=len)
+                      if cache_size else None)
+
+        # the last revision announced by a writer
+        self.revision = None
+
+        # requests being handled by a worker, keyed by payload, with
+        # the revision they were sent at and the clients waiting on
+        # copies of them
+        self.inflight = {}
+        self.coalesce_counts = dict(coalesced=0, cache_hits=0)
 
-        # the lru of available workers
+        # requests cancelled by their clients while copies of them
+        # were waiting on their replies, keyed like busy requests.
+        # they run for the copies, their own clients get nothing
+        self.dropped = set()
+
+        # the lru of workers with capacity for another request
         self.workers = OrderedDict()
 
-        # busy workers
+        # how many requests each worker can handle at once
+        self.capacity = {}
+
+        # the address of every known worker
+        self.worker_addrs = {}
+
+        # outstanding requests of busy workers, keyed by the client
+        # address and request headers that identify their replies.
+        # entries are (client_addr, request, tries, dispatched_at)
         self.busy = {}
 
-        # requests whose workers died and need to be retried
-        self.retry_list = []
+        # when workers that send heartbeats were last heard from
+        self.last_seen = {}
+        self.heartbeat_timeout = heartbeat_timeout / 1000.0
+        self.request_timeout = request_timeout / 1000.0
+        self.housekeeping_at = 0
+        self.worker_counts = dict(evicted=0, stale_replies=0, timed_out=0,
+                                  retried=0, failed=0)
+        self.metrics = stats.Metrics()
+
+        # the addresses of workers sending streams, keyed like busy
+        # requests
+        self.streaming = {}
+
+        # requests waiting for a worker, one queue per priority.
+        # entries are (client_addr, request, tries, deadline)
+        self.queues = [deque() for p in envelope.PRIORITIES]
+        self.max_queue = max_queue
+        self.queue_counts = dict(expired=0, rejected=0, cancelled=0)
 
         # Prepare our context and sockets
         self.context = zmq.Context(2)
@@ -42,6 +149,24 @@ class Broker(object):
 
         self.poller = zmq.Poller()
 
+    zero_copy = True
+    """Pass large payload frames from socket to socket as zmq.Frame
+    objects, see recv_frames."""
+
+    def recv_frames(self, socket, flags=0):
+        """Receive a multipart message.  With zero_copy, payloads of at
+        least ZERO_COPY_THRESHOLD bytes are left in the zmq.Frame they
+        arrived in, all the other frames are bytes.  The broker only
+        looks at the bytes of payloads to coalesce and cache them."""
+        if not self.zero_copy:
+            return socket.recv_multipart(flags)
+        return [frame if len(frame) >= ZERO_COPY_THRESHOLD else frame.bytes
+                for frame in socket.recv_multipart(flags, copy=False)]
+
+    def send_frames(self, socket, frames):
+        """Send a multipart message, without copying large frames."""
+        socket.send_multipart(frames, copy=not self.zero_copy)
+
     def run(self):
         """Run forever, polling the sockets. """
         # setup the poller
@@ -52,7 +177,10 @@ class Broker(object):
         try:
             while True:
                 try:
-                    socks = dict(self.poller.poll())
+                    timeout = self.poll_timeout()
+                    if timeout is None or timeout > HEARTBEAT_INTERVAL:
+                        timeout = HEARTBEAT_INTERVAL
+                    socks = dict(self.poller.poll(timeout))
 
                     # any supervisor events?
                     if socks.get(self.events) == zmq.POLLIN:
@@ -62,19 +190,16 @@ class Broker(object):
                     if socks.get(self.backend) == zmq.POLLIN:
                         self.handle_backend()
 
-                    # only do something if there is an available
-                    # worker to handle it
-                    if len(self.workers) > 0:
-                        # first see if there are requests that need
-                        # retrying because their worker died
-                        if self.retry_list:
-                            self.handle_retry(self.retry_list.pop())
-
-                        # otherwise check for new requests
-                        elif socks.get(self.frontend) == zmq.POLLIN:
-                            # dispatch a a request to the oldest
-                            # available worker
-                            self.handle_worker()
+                    # any new requests?
+                    if socks.get(self.frontend) == zmq.POLLIN:
+                        self.handle_frontend()
+
+                    # anything waiting on a timer?
+                    self.handle_timers()
+                    self.housekeeping()
+
+                    # hand queued requests to the available workers
+                    self.dispatch_queued()
                 except Exception:
                     logging.exception('Error in reader loop')
         finally:
@@ -98,31 +223,98 @@ class Broker(object):
             self.handle_tick_60(eventdata)
         elif headers.get('eventname') == 'TICK_3600':
             self.handle_tick_3600(eventdata)
+        elif headers.get('eventname') == REVISION_EVENT:
+            self.handle_revision(eventdata.get('revision'))
+
+    def handle_revision(self, revision):
+        """A writer committed a new revision, cached replies from
+        earlier revisions are stale."""
+        if revision is None:
+            # the writer's database has no revision numbers, every
+            # commit it announces is a revision of its own
+            revision = object()
+        self.revision = revision
 
     def handle_process_state_exited(self, eventdata):
         pname = eventdata.get('processname')
         if pname:
-            if pname in self.workers:
-                # an available worker died, get rid of it
-                logging.debug('Removing dead available worker %s' % pname)
-                self.workers.pop(pname)
-            elif pname in self.busy:
-                # a busy worker died, schedule its request for retry
-                logging.debug('Removing dead busy %s to retry' % pname)
-                self.retry_list.append(self.busy.pop(pname))
+            logging.debug('Removing dead worker %s' % pname)
+            self.remove_worker(pname)
+
+    def remove_worker(self, worker_name):
+        """Forget a worker, retrying any requests it was busy with. """
+        # an available worker died, get rid of it
+        self.workers.pop(worker_name, None)
+        if worker_name in self.busy:
+            # a busy worker died, schedule its requests for retry
+            for key, data in self.busy.pop(worker_name).items():
+                if key not in self.streaming:
+                    self.handle_retry(data)
+                    continue
+                # a stream that already started can't be replayed
+                self.fail(key, data, stream.StreamError(
+                    'Worker %s died mid stream' % worker_name))
+        self.capacity.pop(worker_name, None)
+        self.worker_addrs.pop(worker_name, None)
+        self.last_seen.pop(worker_name, None)
+        self.handle_worker_exited(worker_name)
+
+    def evict(self, worker_name, reason):
+        """Remove a worker that seems to be dead or hung. """
+        logging.warning('Evicting worker %s: %s' % (worker_name, reason))
+        self.worker_counts['evicted'] += 1
+        self.remove_worker(worker_name)
+
+    def housekeeping(self):
+        """Evict hung and silent workers.  Runs at most once per
+        heartbeat interval."""
+        now = time.time()
+        if now < self.housekeeping_at:
+            return
+        self.housekeeping_at = now + HEARTBEAT_INTERVAL / 1000.0
+
+        if self.request_timeout:
+            cutoff = now - self.request_timeout
+            for worker_name, outstanding in self.busy.items():
+                hung = [key for key, data in outstanding.items()
+                        if data[3] < cutoff]
+                if not hung:
+                    continue
+                # the requests that hung this worker fail instead of
+                # being retried on the next one
+                for key in hung:
+                    self.worker_counts['timed_out'] += 1
+                    self.fail(key, outstanding.pop(key), RequestTimeoutError(
+                        'Request ran for more than %sms.' %
+                        int(self.request_timeout * 1000)))
+                if not outstanding:
+                    del self.busy[worker_name]
+                self.evict(worker_name, 'request timed out')
+
+        if self.heartbeat_timeout:
+            cutoff = now - self.heartbeat_timeout
+            for worker_name, seen in self.last_seen.items():
+                if seen < cutoff and worker_name not in self.busy:
+                    self.evict(worker_name, 'no heartbeat')
 
     def handle_tick_5(self, eventdata):
-        return
+        self.purge_expired()
 
     def handle_tick_60(self, eventdata):
-        return
+        logging.info('Broker stats: %r' % self.stats())
+        self.metrics.roll()
 
     def handle_tick_3600(self, eventdata):
-        return
+        # drop expired replies that were never asked for again
+        if self.cache is not None:
+            self.cache.purge_expired()
+            for payload, (revision, reply) in self.cache.items():
+                if revision != self.revision:
+                    del self.cache[payload]
 
     def handle_backend(self):
         # Get a message from a worker
-        message = self.backend.recv_multipart()
+        message = self.recv_frames(self.backend)
         worker_addr = message[0]
 
         assert message[1] == ''
@@ -131,54 +323,398 @@ class Broker(object):
         # if it's a new worker telling us ready...
         if client_addr == 'READY':
             worker_name = message[3]
-            # push the new worker into the available queue
-            # give it avague allotment of requests to handle
-            self.workers[worker_name] = worker_addr
-            logging.debug("New worker %s connected from %s" % 
-                          (worker_name, worker_addr.encode('hex')))
+            capacity = int(message[4]) if len(message) > 4 else 1
+            self.register_worker(worker_name, worker_addr, capacity)
+            return
+
+        # or a worker saying it's alive
+        if client_addr == HEARTBEAT:
+            worker_name = message[3]
+            self.last_seen[worker_name] = time.time()
+            if worker_name not in self.capacity:
+                # a worker we lost track of or evicted is back
+                self.register_worker(worker_name, worker_addr,
+                                     int(message[4]))
             return
 
         # otherwise it's a data reply from a worker
         worker_name = message[2]
         client_addr = message[3]
 
-        # mark the replying worker as available
-        self.busy.pop(worker_name, None)
-        self.workers[worker_name] = worker_addr
-        # process the response from the worker
+        # process the response from the worker, the reply frames are
+        # any request headers echoed back by the worker, then the
+        # reply itself
         assert message[4] == ''
-        reply = message[5]
+        reply = message[5:]
+
+        # the worker's timing frame is for us, not the client
+        timing = stats.unpack_timing(reply[-2]) if len(reply) > 1 else None
+        if timing is not None:
+            del reply[-2]
+
+        if worker_name in self.last_seen:
+            self.last_seen[worker_name] = time.time()
+
+        # streamed replies have a chunk frame before the reply, the
+        # worker stays busy until the final chunk
+        chunk = stream.unpack_chunk(reply[-2]) if len(reply) > 1 else None
+        key = (client_addr, tuple(reply[:-2] if chunk else reply[:-1]))
+        if chunk is not None and not chunk[1]:
+            outstanding = self.busy.get(worker_name, {})
+            if key in outstanding:
+                # an active stream is not a hung request
+                outstanding[key] = outstanding[key][:3] + (time.time(),)
+                self.streaming[key] = worker_addr
+                self.send_frames(self.frontend, [client_addr, ''] + reply)
+            else:
+                self.worker_counts['stale_replies'] += 1
+            return
+        self.streaming.pop(key, None)
+
+        # mark the replying worker as available
+        entry = None
+        outstanding = self.busy.get(worker_name)
+        if outstanding is not None:
+            entry = outstanding.pop(key, None)
+            if not outstanding:
+                del self.busy[worker_name]
+        if worker_name in self.capacity and worker_name not in self.workers:
+            self.workers[worker_name] = worker_addr
+
+        if entry is None:
+            # the request was given to another worker after this one
+            # was evicted, the client gets that worker's reply
+            self.worker_counts['stale_replies'] += 1
+            return
 
-        self.frontend.send_multipart([client_addr, '', reply])
+        if key in self.dropped:
+            self.dropped.discard(key)
+        else:
+            self.send_frames(self.frontend, [client_addr, ''] + reply)
+        if chunk is None:
+            # only replies known to be results are cached, errors and
+            # replies without a timing frame are just fanned out
+            method, execution, failed = timing or ('', None, True)
+            self.metrics.record(method or 'unknown',
+                                (time.time() - entry[3]) * 1000, execution)
+            self.complete(entry[1][-1], reply[-1], cache=not failed)
+        self.handle_worker_idle(worker_name)
+
+    def register_worker(self, worker_name, worker_addr, capacity):
+        """Push a new worker into the available queue, with the
+        number of requests it says it can handle at once. """
+        self.capacity[worker_name] = capacity
+        self.worker_addrs[worker_name] = worker_addr
+        self.workers[worker_name] = worker_addr
+        logging.debug("New worker %s connected from %s" %
+                      (worker_name, worker_addr.encode('hex')))
+        self.handle_worker_ready(worker_name)
 
     def handle_retry(self, data):
         """Retry a request given to a busy worker that died mid-request. """
 
         # pop the request for the worker that died
-        client_addr, request, tries = data
+        client_addr, request, tries = data[:3]
 
         # if it happened too many times, send the client an error
+        # along with the request headers so it can be correlated
         tries += 1
         if tries >= self.retry_limit:
-            self.frontend.send_multipart(
-                [client_addr, '', 
-                 dumps(RetryError('Error after %s tries.' % tries))]
-                )
+            self.worker_counts['failed'] += 1
+            self.fail(None, data,
+                      RetryError('Error after %s tries.' % tries))
             return
 
-        # pop a new worker, mark it busy
+        logging.debug('Retrying request from %s' %
+                      client_addr.encode('hex'))
+
+        # resend the request to a new worker before any new requests
+        self.worker_counts['retried'] += 1
+        self.enqueue(client_addr, request, tries)
+
+    def fail(self, key, data, error):
+        """Answer an outstanding request, and the copies waiting on it,
+        with an error.  A stream that started gets it as its final
+        chunk."""
+        client_addr, request = data[:2]
+        error = self.codec.dumps(error)
+        if key is not None and self.streaming.pop(key, None) is not None:
+            self.send_frames(self.frontend,
+                [client_addr, ''] + request[:-1] +
+                [stream.pack_chunk(0, True), error])
+            return
+        dropped = (client_addr, tuple(request[:-1]))
+        if dropped in self.dropped:
+            self.dropped.discard(dropped)
+        else:
+            self.send_frames(self.frontend,
+                [client_addr, ''] + request[:-1] + [error])
+        self.complete(request[-1], error, cache=False)
+
+    def handle_frontend(self):
+        """Queue the requests waiting on the front end. """
+        # REQ clients send just the request, DEALER clients send
+        # header frames (a request id, an envelope) before it.
+        for i in xrange(FRONTEND_BATCH):
+            try:
+                message = self.recv_frames(self.frontend, zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            client_addr = message[0]
+            assert message[1] == ''
+            self.enqueue(client_addr, message[2:])
+
+    def enqueue(self, client_addr, request, tries=0):
+        """Queue a request by its priority.  Retried requests go to
+        the front of their queue, new requests may be answered from
+        the cache, dropped if they already expired or rejected if too
+        many requests are queued.
+        """
+        if stream.unpack_credit(request[-1]) is not None:
+            self.forward_credit(client_addr, request)
+            return
+        if request[-1] == envelope.CANCEL:
+            self.cancel(client_addr, request[:-1])
+            return
+        if request[-1] == stats.STATS:
+            self.send_frames(self.frontend,
+                [client_addr, ''] + request[:-1] +
+                [self.codec.dumps(self.stats())])
+            return
+        priority, deadline = envelope.find(request[:-1])
+        entry = (client_addr, request, tries, deadline)
+        if tries:
+            self.queues[priority].appendleft(entry)
+            return
+        if deadline is not None and deadline < time.time():
+            self.queue_counts['expired'] += 1
+            return
+        if self.lookup_cache(client_addr, request):
+            return
+        if self.max_queue and self.queue_depth() >= self.max_queue:
+            self.purge_expired()
+            if self.queue_depth() >= self.max_queue:
+                self.queue_counts['rejected'] += 1
+                self.send_frames(self.frontend,
+                    [client_addr, ''] + request[:-1] +
+                    [self.codec.dumps(OverloadError(
+                         '%s requests queued.' % self.queue_depth()))])
+                return
+        self.queues[priority].append(entry)
+
+    def forward_credit(self, client_addr, request):
+        """Pass the credits a client granted to the worker sending
+        it a stream.  Credits for finished streams are dropped."""
+        worker_addr = self.streaming.get((client_addr, tuple(request[:-1])))
+        if worker_addr is not None:
+            self.send_frames(self.backend,
+                [worker_addr, '', client_addr] + request)
+
+    def cancel(self, client_addr, headers):
+        """Drop a queued request its client no longer wants, or tell
+        the worker that has it.  A request that coalesced requests are
+        waiting on keeps running, only its own reply is dropped.
+        Cancelling a request that is already answered does nothing."""
+        key = (client_addr, tuple(headers))
+        for queue in self.queues:
+            for entry in queue:
+                if entry[0] == client_addr and tuple(entry[1][:-1]) == key[1]:
+                    if entry[2]:
+                        # retried requests may have coalesced requests
+                        # waiting for them, let them run
+                        return
+                    queue.remove(entry)
+                    self.queue_counts['cancelled'] += 1
+                    return
+        for worker_name, outstanding in self.busy.iteritems():
+            if key in outstanding:
+                flight = self.inflight.get(
+                    payload_bytes(outstanding[key][1][-1]))
+                if flight is not None and flight[1]:
+                    # coalesced requests are waiting for the reply
+                    self.dropped.add(key)
+                    return
+                self.send_frames(self.backend,
+                    [self.worker_addrs[worker_name], '', client_addr] +
+                    list(headers) + [envelope.CANCEL])
+                return
+
+    def stats(self):
+        """Return the broker's metrics as a dictionary of plain
+        values."""
+        return dict(
+            time=time.time(),
+            workers=dict(total=len(self.capacity),
+                         idle=len(self.capacity) - len(self.busy),
+                         busy=len(self.busy),
+                         available=len(self.workers),
+                         outstanding=sum(len(outstanding) for outstanding
+                                         in self.busy.itervalues())),
+            queues=dict(zip(envelope.PRIORITIES,
+                            [len(queue) for queue in self.queues]),
+                        depth=self.queue_depth(), **self.queue_counts),
+            worker_counts=dict(self.worker_counts),
+            coalesce_counts=dict(self.coalesce_counts),
+            cache=self.cache.stats() if self.cache is not None else None,
+            methods=self.metrics.as_dict())
+
+    def queue_depth(self):
+        """The number of requests waiting for a worker. """
+        return sum(len(queue) for queue in self.queues)
+
+    def purge_expired(self):
+        """Drop all the queued requests whose deadline passed. """
+        now = time.time()
+        for i, queue in enumerate(self.queues):
+            self.queues[i] = deque(entry for entry in queue
+                                   if not self.expire(entry, now))
+
+    def expire(self, entry, now):
+        """Return True if a queued request expired and is dropped. """
+        client_addr, request, tries, deadline = entry
+        if deadline is None or deadline >= now:
+            return False
+        if tries:
+            # a retried request may have coalesced requests waiting
+            # for its reply, only drop it if it has none
+            payload = payload_bytes(request[-1])
+            flight = self.inflight.get(payload)
+            if flight is not None:
+                if flight[1]:
+                    return False
+                del self.inflight[payload]
+        self.queue_counts['expired'] += 1
+        return True
+
+    def dispatch_queued(self):
+        """Route queued requests, most urgent first, while there are
+        workers available. """
+        now = time.time()
+        for queue in self.queues:
+            while queue and self.workers:
+                entry = queue.popleft()
+                if self.expire(entry, now):
+                    continue
+                client_addr, request, tries, deadline = entry
+                if not tries and self.coalesce_request(client_addr, request):
+                    continue
+                self.route(client_addr, request, tries)
+            if not self.workers:
+                return
+
+    def route(self, client_addr, request, tries=0):
+        """Send a request to a worker.  Only called while a worker is
+        available.  The default sends it to the least recently used
+        worker.
+        """
         worker_name, worker_addr = self.workers.popitem(last=False)
-        self.busy[worker_name] = client_addr, request, tries
+        self.dispatch(worker_name, worker_addr, client_addr, request, tries)
+
+    def dispatch(self, worker_name, worker_addr, client_addr, request,
+                 tries=0):
+        """Mark a worker busy with a request and send it.  The worker
+        must already have been taken out of the available workers, it
+        is put back at the end if it has capacity to spare.
+        """
+        outstanding = self.busy.setdefault(worker_name, {})
+        outstanding[(client_addr, tuple(request[:-1]))] = (
+            client_addr, request, tries, time.time())
+        if len(outstanding) < self.capacity.get(worker_name, 1):
+            self.workers[worker_name] = worker_addr
+        self.send_frames(self.backend,
+                         [worker_addr, "", client_addr] + request)
+
+    def lookup_cache(self, client_addr, request):
+        """Answer a request from the cache.  Returns True if it was
+        answered."""
+        if self.cache is None or stream.find_open(request[:-1]):
+            return False
+        payload = payload_bytes(request[-1])
+        cached = self.cache.get(payload)
+        if cached is None:
+            return False
+        revision, reply = cached
+        if revision == self.revision:
+            self.coalesce_counts['cache_hits'] += 1
+            self.send_frames(self.frontend,
+                [client_addr, ''] + request[:-1] + [reply])
+            return True
+        del self.cache[payload]
+        return False
+
+    def coalesce_request(self, client_addr, request):
+        """Attach a request to an identical one in flight.  Returns
+        True if the request was attached and must not be sent to a
+        worker.
+        """
+        if not (self.coalesce or self.cache is not None):
+            return False
+        if stream.find_open(request[:-1]):
+            # streams have their own flow control, never share them
+            return False
+        if envelope.is_hedge(request[:-1]):
+            # a hedged copy would only wait for its own original
+            return False
+        payload = payload_bytes(request[-1])
+        flight = self.inflight.get(payload)
+        if flight is None:
+            self.inflight[payload] = (self.revision, [])
+            return False
+        if self.coalesce:
+            self.coalesce_counts['coalesced'] += 1
+            flight[1].append((client_addr, request[:-1]))
+            return True
+        return False
+
+    def complete(self, payload, reply, cache=True):
+        """Fan a reply out to the clients waiting on copies of its
+        request, and cache it."""
+        if not self.inflight:
+            return
+        # large payloads arrive as zmq.Frames, key on their bytes
+        payload = payload_bytes(payload)
+        flight = self.inflight.pop(payload, None)
+        if flight is None:
+            return
+        revision, waiters = flight
+        for client_addr, headers in waiters:
+            self.send_frames(self.frontend,
+                             [client_addr, ''] + headers + [reply])
+        if cache and self.cache is not None and revision == self.revision:
+            reply = payload_bytes(reply)
+            self.cache.set(payload, (revision, reply), len(reply))
+
+    def handle_worker_ready(self, worker_name):
+        """A new worker connected."""
+        return
 
-        logging.debug('Retrying request from %s to %s' % 
-                      (client_addr.encode('hex'), worker_name))
+    def handle_worker_idle(self, worker_name):
+        """A worker replied and is available again."""
+        return
 
-        # resend the request to a new worker
-        self.backend.send_multipart([worker_addr, "", client_addr, request])
+    def handle_worker_exited(self, worker_name):
+        """A worker process died."""
+        return
 
-    def handle_worker(self):
+    def handle_timers(self):
+        """Called on every pass through the run loop."""
         return
 
+    def poll_timeout(self):
+        """Milliseconds until handle_timers next needs to run, or
+        None to wait for socket activity."""
+        return None
+
+    @classmethod
+    def config_options(cls, config, name):
+        """Extra constructor arguments read from the broker's config
+        section."""
+        options = {}
+        for option in ('max_queue', 'heartbeat_timeout', 'request_timeout'):
+            if config.has_option(name, option):
+                options[option] = config.getint(name, option)
+        return options
+
 
 def run(name, broker_cls):
     import sys
@@ -193,10 +729,14 @@ def run(name, broker_cls):
     worker_url = config.get(name, 'worker_url')
     events_url = config.get(name, 'events_url')
     log_file = config.get(name, 'log_file')
+    codec = from_config(config, name)
 
     logging.basicConfig(filename=log_file, level=logging.DEBUG)
 
-    s = broker_cls(worker_url, client_url, events_url)
+    options = broker_cls.config_options(config, name)
+
+    s = broker_cls(worker_url, client_url, events_url, codec=codec,
+                   **options)
     logging.info('Running %s broker on %s' % (repr(broker_cls), client_url))
     s.run()
 
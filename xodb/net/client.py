@@ -1,8 +1,20 @@
+import os
 import time
+import heapq
+import Queue
+import struct
+import logging
+import threading
+import itertools
+from collections import deque
+from functools import partial
+
 import zmq
+from concurrent.futures import Future
 
 from xodb.tools import lazy_property
-from cPickle import dumps, loads
+from xodb.net import envelope, stream, stats
+from xodb.net.codec import get_codec
 
 
 class TimeoutError(Exception):
@@ -37,13 +49,14 @@ class Method(object):
         This loosly based on the 'Lazy Pirate Pattern' in the 0mq
         guide.
         """
-        self.socket.send(dumps((self.name, args, kwargs)))
+        self.socket.send_multipart(self.client.frames(self.name, args, kwargs))
         tries = 0
         try:
             while tries < self.client.retry_limit:
                 socks = dict(self.client.poller.poll(self.client.timeout))
                 if socks.get(self.socket) == zmq.POLLIN:
-                    return loads(self.socket.recv())
+                    return self.client.codec.loads(
+                        self.socket.recv_multipart()[-1])
                 tries += 1
                 time.sleep(.01 * tries)
             else:
@@ -63,7 +76,7 @@ class Promise(Method):
 
     def __call__(self, *args, **kwargs):
         """Send the request but do not block."""
-        self.socket.send(dumps((self.name, args, kwargs)))
+        self.socket.send_multipart(self.client.frames(self.name, args, kwargs))
         return self
 
     @property
@@ -91,7 +104,8 @@ class Promise(Method):
             while tries < self.client.retry_limit:
                 socks = dict(self.client.poller.poll(self.client.timeout))
                 if socks.get(self.socket) == zmq.POLLIN:
-                    return loads(self.socket.recv())
+                    return self.client.codec.loads(
+                        self.socket.recv_multipart()[-1])
                 tries += 1
                 time.sleep(.01 * tries)
             else:
@@ -102,24 +116,78 @@ class Promise(Method):
 
 class Client(object):
     """RPC client to an xodb database.
+
+    Requests are sent in an envelope with the client's *priority* and
+    a deadline of *timeout* times *retry_limit* milliseconds, after
+    which the broker drops them.
+
+    Given a HedgePolicy as *hedge*, calls to the policy's methods are
+    sent over an AsyncClient that hedges them instead of retrying.
     """
 
-    def __init__(self, client_url, timeout=10000, retry_limit=3):
+    def __init__(self, client_url, timeout=10000, retry_limit=3,
+                 codec='pickle', priority='normal', hedge=None):
         self.client_url = client_url
         self.timeout = timeout
         self.retry_limit = retry_limit
+        self.codec = get_codec(codec)
+        self.priority = envelope.priority_level(priority)
+        self.hedge = hedge
         self.connect()
 
+    def frames(self, name, args, kwargs):
+        """Return the envelope and payload frames of a request."""
+        deadline = time.time() + self.timeout * self.retry_limit / 1000.0
+        return [envelope.pack(self.priority, deadline),
+                self.codec.dumps((name, args, kwargs))]
+
     def connect(self):
         self.context = zmq.Context(1)
         self.poller = zmq.Poller()
 
     def close(self):
+        if 'hedged_client' in self.__dict__:
+            self.hedged_client.close()
         self.context.term()
 
     def __getattr__(self, name):
+        if self.hedge is not None and self.hedge.hedges(name):
+            return partial(self.hedged, name)
         return Method(name, self)
 
+    @lazy_property
+    def hedged_client(self):
+        return AsyncClient(self.client_url,
+                           timeout=self.timeout * self.retry_limit,
+                           codec=self.codec, priority=self.priority,
+                           hedge=self.hedge)
+
+    def stats(self):
+        """Return the broker's metrics, see Broker.stats."""
+        socket = self.context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.client_url)
+        try:
+            socket.send(stats.STATS)
+            if socket.poll(self.timeout):
+                return self.codec.loads(socket.recv_multipart()[-1])
+            raise TimeoutError('Timeout for broker stats')
+        finally:
+            socket.close()
+
+    def hedged(self, name, *args, **kwargs):
+        """Call a remote method, hedging the request if it is slow."""
+        return self.hedged_client.request(name, args, kwargs).result()
+
+    def stream(self, name, *args, **kwargs):
+        """Call a remote method and return a generator of the items
+        of its streamed reply.  Streams are sent over the process's
+        AsyncClient for this client's url."""
+        client = AsyncClient.instance(self.client_url, timeout=self.timeout,
+                                      codec=self.codec)
+        return iter(client.request_stream(name, args, kwargs,
+                                          priority=self.priority))
+
 
 class PromiseClient(Client):
 
@@ -127,12 +195,448 @@ class PromiseClient(Client):
         return Promise(name, self)
 
 
+request_id = struct.Struct('!I')
+
+
+class Stream(object):
+    """The items of a streamed reply, as they arrive.
+
+    Iterating blocks until the next chunk of items arrives.  Taking a
+    chunk grants the worker the credit to send another, so at most
+    the stream's credits worth of chunks are ever waiting here.
+    """
+
+    def __init__(self, client, rid, headers, timeout):
+        self.client = client
+        self.rid = rid
+        self.headers = headers
+        self.timeout = timeout
+        self.chunks = Queue.Queue()
+        self.seq = 0
+        self.finished = False
+
+    # the client's I/O thread fails streams like futures
+    def done(self):
+        return self.finished
+
+    def set_exception(self, exception):
+        self.finished = True
+        self.chunks.put((None, True, exception))
+
+    def feed(self, seq, final, payload):
+        if final:
+            self.finished = True
+        self.chunks.put((seq, final, payload))
+
+    def __iter__(self):
+        while True:
+            seq, final, payload = self.chunks.get()
+            if seq is None:
+                raise payload
+            if seq != self.seq:
+                raise stream.StreamError('Got chunk %s, expected %s' %
+                                         (seq, self.seq))
+            self.seq += 1
+            items = self.client.codec.loads(payload)
+            if isinstance(items, Exception):
+                raise items
+            if not final:
+                self.client._grant(self)
+            for item in items:
+                yield item
+            if final:
+                return
+
+
+class HedgePolicy(object):
+    """When to send a hedged copy of a slow request.
+
+    A request for one of *methods* that has no reply after the
+    *percentile* latency of that method's last *samples* replies is
+    sent again, and whichever copy is answered first wins.  The other
+    copy is cancelled.  Only idempotent reads should be hedged.
+
+    No request is hedged before a method has *min_samples* latencies,
+    or sooner than *min_delay* milliseconds after it was sent.
+    """
+
+    def __init__(self, methods=('query', 'count', 'facet', 'suggest'),
+                 percentile=95, min_delay=5, samples=200, min_samples=20):
+        self.methods = frozenset(methods)
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.samples = samples
+        self.min_samples = min_samples
+        self.latencies = {}
+        self.delays = {}
+        self.fired = 0
+
+    def hedges(self, name):
+        return name in self.methods
+
+    def delay(self, name):
+        """Return the milliseconds to wait before hedging a request,
+        or None if it should not be hedged yet."""
+        return self.delays.get(name)
+
+    def record(self, name, latency):
+        """Record the milliseconds it took to answer a request."""
+        latencies = self.latencies.get(name)
+        if latencies is None:
+            latencies = self.latencies[name] = deque(maxlen=self.samples)
+        latencies.append(latency)
+        # recomputing on every reply would sort the window each time
+        if (len(latencies) >= self.min_samples and
+            (name not in self.delays or
+             len(latencies) % self.min_samples == 0)):
+            ordered = sorted(latencies)
+            index = min(len(ordered) - 1,
+                        len(ordered) * self.percentile // 100)
+            self.delays[name] = max(self.min_delay, ordered[index])
+
+
+class Hedged(object):
+    """The copies of a request that may be hedged."""
+
+    def __init__(self, name, payload, priority, deadline):
+        self.name = name
+        self.payload = payload
+        self.priority = priority
+        self.deadline = deadline
+        self.sent_at = time.time()
+        self.headers = {}
+
+
+class AsyncClient(object):
+    """RPC client that multiplexes any number of in-flight requests
+    over one persistent DEALER socket.
+
+    Each request is tagged with a request id header frame that the
+    broker and worker echo back with the reply.  Calls return a
+    concurrent.futures.Future (or an asyncio future from call_async),
+    which fails with TimeoutError if no reply arrives within the
+    request's timeout.
+
+    The socket is owned by a background I/O thread; requests are
+    handed to it over an inproc pipe, so the client can be shared by
+    any number of threads.  Use AsyncClient.instance() to get one
+    client per process and broker url.
+
+    Given a HedgePolicy as *hedge*, slow requests for the policy's
+    methods are sent twice, see HedgePolicy.
+    """
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, client_url, timeout=10000, codec='pickle',
+                 context=None, priority='normal', hedge=None):
+        self.client_url = client_url
+        self.timeout = timeout
+        self.codec = get_codec(codec)
+        self.priority = envelope.priority_level(priority)
+        self.context = context or zmq.Context.instance()
+        self.hedge = hedge
+        self.pending = {}
+        self.copies = {}
+        self.ids = itertools.count(1)
+        self.closed = False
+
+        # inproc endpoints must be bound before they are connected to
+        self.pipe_url = 'inproc://xodb-client-%x' % id(self)
+        self.inbox = self.context.socket(zmq.PULL)
+        self.inbox.bind(self.pipe_url)
+        self.pipe = self.context.socket(zmq.PUSH)
+        self.pipe.connect(self.pipe_url)
+        self.pipe_lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self._run,
+                                       name='xodb-client-io')
+        self.thread.daemon = True
+        self.thread.start()
+
+    @classmethod
+    def instance(cls, client_url, **kwargs):
+        """Return the client for *client_url* in this process,
+        creating it if needed.  A forked child gets its own client.
+        """
+        key = (os.getpid(), client_url)
+        with cls._instances_lock:
+            client = cls._instances.get(key)
+            if client is None or client.closed:
+                client = cls._instances[key] = cls(client_url, **kwargs)
+            return client
+
+    def request(self, name, args=(), kwargs=None, timeout=None,
+                priority=None):
+        """Send a request and return a future for its reply.  A
+        *name* of None asks the broker for its stats.
+
+        :param timeout: milliseconds to wait for the reply, defaults
+        to the client's timeout.  The broker drops the request if it
+        is still queued by then.
+
+        :param priority: the request's priority name or level,
+        defaults to the client's priority.
+        """
+        if self.closed:
+            raise RuntimeError('Client is closed')
+        rid = request_id.pack(self.ids.next() & 0xffffffff)
+        future = Future()
+        future.set_running_or_notify_cancel()
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.time() + timeout / 1000.0
+        if priority is None:
+            priority = self.priority
+        if name is None:
+            payload = stats.STATS
+        else:
+            payload = self.codec.dumps((name, args, kwargs or {}))
+        frames = [rid, envelope.pack(priority, deadline), payload]
+        if self.hedge is not None and self.hedge.hedges(name):
+            copies = Hedged(name, payload, priority, deadline)
+            copies.headers[rid] = frames[:2]
+            self.copies[rid] = copies
+        self.pending[rid] = future, deadline
+        with self.pipe_lock:
+            self.pipe.send_multipart(frames)
+        return future
+
+    def request_stream(self, name, args=(), kwargs=None, timeout=None,
+                       priority=None, credits=stream.CREDITS,
+                       chunk_size=stream.CHUNK_SIZE):
+        """Send a request for a streamed reply and return a Stream of
+        its items.
+
+        :param timeout: milliseconds to wait for each chunk, defaults
+        to the client's timeout.
+
+        :param credits: how many chunks the worker may send ahead of
+        the ones taken from the stream.
+
+        :param chunk_size: how many items the worker sends per chunk.
+        """
+        if self.closed:
+            raise RuntimeError('Client is closed')
+        rid = request_id.pack(self.ids.next() & 0xffffffff)
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.time() + timeout / 1000.0
+        if priority is None:
+            priority = self.priority
+        headers = [rid, envelope.pack(priority, deadline),
+                   stream.pack_open(credits, chunk_size)]
+        result = Stream(self, rid, headers, timeout)
+        self.pending[rid] = result, deadline
+        payload = self.codec.dumps((name, args, kwargs or {}))
+        with self.pipe_lock:
+            self.pipe.send_multipart(headers + [payload])
+        return result
+
+    def stream(self, name, *args, **kwargs):
+        """Send a request for a streamed reply with the default
+        options, return a Stream of its items."""
+        return self.request_stream(name, args, kwargs)
+
+    def _grant(self, result):
+        """Grant the worker sending a stream a credit, and give the
+        stream another timeout to get its next chunk."""
+        if self.pending.get(result.rid, (None,))[0] is not result:
+            return
+        self.pending[result.rid] = (
+            result, time.time() + result.timeout / 1000.0)
+        with self.pipe_lock:
+            self.pipe.send_multipart(result.headers + [stream.pack_credit()])
+
+    def stats(self):
+        """Ask the broker for its metrics, return a future for them.
+        See Broker.stats."""
+        return self.request(None, priority=envelope.HIGH)
+
+    def submit(self, name, *args, **kwargs):
+        """Send a request with the default timeout, return a future."""
+        return self.request(name, args, kwargs)
+
+    def call_async(self, name, *args, **kwargs):
+        """Send a request, return an asyncio future for its reply."""
+        try:
+            import asyncio
+        except ImportError:
+            import trollius as asyncio
+        return asyncio.wrap_future(self.request(name, args, kwargs))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return partial(self.submit, name)
+
+    def close(self):
+        """Stop the I/O thread and fail any outstanding requests."""
+        if self.closed:
+            return
+        self.closed = True
+        with self.pipe_lock:
+            self.pipe.send_multipart([''])
+        self.thread.join()
+        self.pipe.close()
+
+    def _run(self):
+        socket = self.context.socket(zmq.DEALER)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.client_url)
+        poller = zmq.Poller()
+        poller.register(self.inbox, zmq.POLLIN)
+        poller.register(socket, zmq.POLLIN)
+        deadlines = []
+        hedges = []
+        try:
+            while True:
+                timeout = None
+                if deadlines or hedges:
+                    wake = min(deadlines[:1] + hedges[:1])[0]
+                    timeout = max(0, (wake - time.time()) * 1000)
+                socks = dict(poller.poll(timeout))
+
+                if socks.get(self.inbox) == zmq.POLLIN:
+                    if not self._send_requests(socket, deadlines, hedges):
+                        break
+
+                if socks.get(socket) == zmq.POLLIN:
+                    self._receive_replies(socket)
+
+                self._send_hedges(socket, hedges)
+                self._expire(deadlines)
+        except Exception:
+            logging.exception('Error in client I/O thread')
+        finally:
+            self.closed = True
+            for rid, (future, deadline) in self.pending.items():
+                if not future.done():
+                    future.set_exception(
+                        TimeoutError('Client closed before reply'))
+            self.pending.clear()
+            self.copies.clear()
+            socket.close()
+            self.inbox.close()
+
+    def _send_requests(self, socket, deadlines, hedges):
+        """Forward queued requests to the broker.  Returns False when
+        the client is closing."""
+        while True:
+            try:
+                frames = self.inbox.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return True
+            if frames == ['']:
+                return False
+            rid = frames[0]
+            pending = self.pending.get(rid)
+            if pending is None:
+                continue
+            heapq.heappush(deadlines, (pending[1], rid))
+            socket.send_multipart([''] + frames)
+            copies = self.copies.get(rid)
+            if copies is not None and len(copies.headers) == 1:
+                delay = self.hedge.delay(copies.name)
+                if delay is not None:
+                    heapq.heappush(hedges,
+                                   (copies.sent_at + delay / 1000.0, rid))
+
+    def _send_hedges(self, socket, hedges):
+        """Send a hedged copy of each request that is still waiting
+        for a reply after its hedge delay."""
+        now = time.time()
+        while hedges and hedges[0][0] <= now:
+            when, rid = heapq.heappop(hedges)
+            pending = self.pending.get(rid)
+            copies = self.copies.get(rid)
+            if pending is None or copies is None or pending[0].done():
+                continue
+            hedge_rid = request_id.pack(self.ids.next() & 0xffffffff)
+            headers = [hedge_rid, envelope.pack(copies.priority,
+                                                copies.deadline, hedge=True)]
+            copies.headers[hedge_rid] = headers
+            self.copies[hedge_rid] = copies
+            self.pending[hedge_rid] = pending
+            self.hedge.fired += 1
+            socket.send_multipart([''] + headers + [copies.payload])
+
+    def _settle(self, socket, rid):
+        """Forget the copies of a request that was answered by *rid*
+        and cancel the others."""
+        copies = self.copies.pop(rid, None)
+        if copies is None:
+            return
+        self.hedge.record(copies.name,
+                          (time.time() - copies.sent_at) * 1000)
+        for other, headers in copies.headers.items():
+            if other == rid:
+                continue
+            self.copies.pop(other, None)
+            if self.pending.pop(other, None) is not None:
+                socket.send_multipart([''] + headers + [envelope.CANCEL])
+
+    def _receive_replies(self, socket):
+        while True:
+            try:
+                message = socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            rid, reply = message[1], message[-1]
+            pending = self.pending.get(rid)
+            if pending is None:
+                # the request already timed out
+                continue
+            future = pending[0]
+            if isinstance(future, Stream):
+                # a reply without a chunk frame is an error from
+                # before the stream started
+                chunk = stream.unpack_chunk(message[-2])
+                seq, final = chunk or (0, True)
+                if final:
+                    del self.pending[rid]
+                future.feed(seq, final, reply)
+                continue
+            del self.pending[rid]
+            self._settle(socket, rid)
+            if future.done():
+                continue
+            try:
+                result = self.codec.loads(reply)
+            except Exception, e:
+                future.set_exception(e)
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _expire(self, deadlines):
+        now = time.time()
+        while deadlines and deadlines[0][0] <= now:
+            deadline, rid = heapq.heappop(deadlines)
+            pending = self.pending.get(rid)
+            if pending is not None and pending[1] == deadline:
+                del self.pending[rid]
+                copies = self.copies.pop(rid, None)
+                if copies is not None:
+                    # hedged copies share the original's deadline
+                    for other in copies.headers:
+                        self.pending.pop(other, None)
+                        self.copies.pop(other, None)
+                if pending[0].done():
+                    continue
+                pending[0].set_exception(
+                    TimeoutError('Timeout for request %s' %
+                                 request_id.unpack(rid)[0]))
+
+
 if __name__ == "__main__":
     from xodb.tools.signals import register_signals
     register_signals()
 
     import sys
     from ConfigParser import ConfigParser
+    from xodb.net.codec import from_config
 
     if len(sys.argv) < 1:
         print "usage: %s config_file" % sys.argv[0]
@@ -147,7 +651,8 @@ if __name__ == "__main__":
     log_file = client_config.get('log_file')
     timeout = int(client_config.get('timeout'))
     retry_limit = int(client_config.get('retry_limit'))
+    codec = from_config(config, 'client')
 
     import random
-    c = Client(client_url, timeout, retry_limit)
-    p = PromiseClient(client_url, timeout, retry_limit)
+    c = Client(client_url, timeout, retry_limit, codec)
+    p = PromiseClient(client_url, timeout, retry_limit, codec)
@@ -0,0 +1,127 @@
+"""
+Wire codecs for xodb.net request and reply payloads.
+
+Clients, brokers and workers encode payload frames with a codec
+object, selected by name with the 'codec' config option:
+
+  pickle -- The original protocol 0 pickles.  Can carry Record
+            objects.  This is the default.
+
+  binary -- Versioned compact binary frames.  Results are sent as
+            plain rows, tuples of xodb.net.reader.ROW_FIELDS, instead
+            of Records.
+
+All the processes talking to one broker should use the same codec,
+although the binary codec will read legacy pickle frames, so it can be
+rolled out to the workers first.
+"""
+import zlib
+import struct
+import marshal
+import cPickle
+
+
+class CodecError(Exception):
+    """A payload frame could not be decoded."""
+
+
+class PickleCodec(object):
+    """ASCII (protocol 0) pickles, the original xodb.net payloads."""
+
+    name = 'pickle'
+
+    records = True
+    """Results can be sent as Record objects."""
+
+    def dumps(self, obj):
+        return cPickle.dumps(obj)
+
+    def loads(self, data):
+        return cPickle.loads(data)
+
+
+class BinaryCodec(object):
+    """Compact binary payload frames.
+
+    A frame is a two byte header, the codec version and a flags byte,
+    followed by the body.  The body is marshal data, which is fast and
+    compact for the plain structures results are made of, falling back
+    to a binary pickle for anything marshal can't handle, like dates
+    and exceptions.  Bodies larger than *compress_threshold* bytes are
+    zlib compressed.
+
+    Frames that don't start with a known version are read as legacy
+    pickles.
+    """
+
+    name = 'binary'
+
+    records = False
+    """Results are sent as plain rows, not Record objects."""
+
+    version = 1
+
+    header = struct.Struct('!BB')
+
+    PICKLED = 0x01
+    COMPRESSED = 0x02
+
+    def __init__(self, compress_threshold=16384, compress_level=1):
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+
+    def dumps(self, obj):
+        flags = 0
+        try:
+            body = marshal.dumps(obj, 2)
+        except ValueError:
+            body = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+            flags |= self.PICKLED
+        if self.compress_threshold and len(body) > self.compress_threshold:
+            body = zlib.compress(body, self.compress_level)
+            flags |= self.COMPRESSED
+        return self.header.pack(self.version, flags) + body
+
+    def loads(self, data):
+        if not data or ord(data[0]) != self.version:
+            return cPickle.loads(data)
+        version, flags = self.header.unpack_from(data)
+        body = data[self.header.size:]
+        try:
+            if flags & self.COMPRESSED:
+                body = zlib.decompress(body)
+            if flags & self.PICKLED:
+                return cPickle.loads(body)
+            return marshal.loads(body)
+        except (zlib.error, ValueError, EOFError, TypeError), e:
+            raise CodecError('Bad frame: %s' % e)
+
+
+codecs = {
+    'pickle': PickleCodec,
+    'binary': BinaryCodec,
+    }
+
+
+def get_codec(codec='pickle', **options):
+    """Return a codec instance for a codec name.  Codec instances
+    are passed through unchanged.
+    """
+    if not isinstance(codec, basestring):
+        return codec
+    try:
+        return codecs[codec](**options)
+    except KeyError:
+        raise ValueError('Unknown codec %s' % codec)
+
+
+def from_config(config, section):
+    """Return the codec configured in a config file section."""
+    if not config.has_option(section, 'codec'):
+        return get_codec()
+    name = config.get(section, 'codec')
+    options = {}
+    if name == 'binary' and config.has_option(section, 'compress_threshold'):
+        options['compress_threshold'] = config.getint(
+            section, 'compress_threshold')
+    return get_codec(name, **options)
@@ -0,0 +1,84 @@
+"""Request envelopes.
+
+An envelope is an optional header frame that a client sends between
+its request id (if any) and the request payload.  It carries the
+request's priority and the absolute time after which the client no
+longer wants the reply.  Brokers use it to order their queues and to
+drop expired requests; workers echo it back like any other header.
+
+Deadlines are wall clock times, so clients and brokers are expected
+to have reasonably synchronized clocks.
+
+A request sent with the same header frames as an earlier one and
+CANCEL as its payload cancels the earlier request.
+"""
+import struct
+
+
+MAGIC = 'XE1'
+
+PRIORITIES = ('high', 'normal', 'low')
+"""Priority classes, most urgent first.  Interactive searches should
+be 'high' or 'normal', batch jobs and exports 'low'."""
+
+HIGH, NORMAL, LOW = range(len(PRIORITIES))
+
+HEDGE = 0x80
+"""Flag set on the priority of hedged copies of a request."""
+
+CANCEL = 'XCANCEL'
+
+envelope = struct.Struct('!3sBd')
+
+
+def priority_level(priority):
+    """Return the level of a priority given by name or level."""
+    if isinstance(priority, basestring):
+        return PRIORITIES.index(priority)
+    if not 0 <= priority < len(PRIORITIES):
+        raise ValueError('Unknown priority %r' % priority)
+    return priority
+
+
+def pack(priority=NORMAL, deadline=None, hedge=False):
+    """Return an envelope frame.
+
+    :param priority: A priority name or level.
+
+    :param deadline: The time.time() after which the request is
+    dropped, or None to never drop it.
+
+    :param hedge: True for a hedged copy of a request that was already
+    sent.  Brokers don't coalesce hedged copies with the original.
+    """
+    level = priority_level(priority)
+    if hedge:
+        level |= HEDGE
+    return envelope.pack(MAGIC, level, deadline or 0)
+
+
+def unpack(frame):
+    """Return the (priority, deadline) of an envelope frame, or None if
+    the frame is not an envelope."""
+    if len(frame) != envelope.size or not frame.startswith(MAGIC):
+        return None
+    magic, priority, deadline = envelope.unpack(frame)
+    return min(priority & ~HEDGE, LOW), deadline or None
+
+
+def find(headers):
+    """Return the (priority, deadline) of the envelope among a
+    request's header frames, or the defaults if it has none."""
+    for frame in headers:
+        found = unpack(frame)
+        if found is not None:
+            return found
+    return NORMAL, None
+
+
+def is_hedge(headers):
+    """Return True if a request's envelope marks it as a hedged copy."""
+    for frame in headers:
+        if unpack(frame) is not None:
+            return bool(ord(frame[len(MAGIC)]) & HEDGE)
+    return False
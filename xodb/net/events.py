@@ -9,22 +9,57 @@ from supervisor import childutils
 class SupervisorEventListener(object):
     """Broadcast supervisord events down a 0mq publication socket.
 
+    If a *revisions_url* is given, revision events pushed there by
+    writers are published on the same socket.
+
     If certain watched process names die, restart everything, which
     might be too bold.
     """
 
-    def __init__(self, publish_url, watching):
+    def __init__(self, publish_url, watching, revisions_url=None):
         self.publish_url = publish_url
         self.watching = watching
         self.context = zmq.Context(1)
         self.socket = self.context.socket(zmq.PUB)
         self.socket.bind(self.publish_url)
+        self.revisions = None
+        if revisions_url:
+            self.revisions = self.context.socket(zmq.PULL)
+            self.revisions.bind(revisions_url)
+        self.poller = zmq.Poller()
+
+    def wait(self):
+        """Wait for the next supervisor event, forwarding revision
+        events while waiting."""
+        if self.revisions is None:
+            return childutils.listener.wait(sys.stdin, sys.stdout)
+        childutils.listener.ready(sys.stdout)
+        while True:
+            socks = dict(self.poller.poll())
+            if socks.get(self.revisions) == zmq.POLLIN:
+                self.forward_revisions()
+            if socks.get(sys.stdin.fileno()) == zmq.POLLIN:
+                line = sys.stdin.readline()
+                headers = childutils.get_headers(line)
+                payload = sys.stdin.read(int(headers['len']))
+                return headers, payload
+
+    def forward_revisions(self):
+        while True:
+            try:
+                event = self.revisions.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self.socket.send(event)
 
     def run(self):
+        if self.revisions is not None:
+            self.poller.register(self.revisions, zmq.POLLIN)
+            self.poller.register(sys.stdin.fileno(), zmq.POLLIN)
         try:
             while True:
                 # get the supervisor event
-                headers, payload = childutils.listener.wait(sys.stdin, sys.stdout)
+                headers, payload = self.wait()
                 pheaders, pdata = childutils.eventdata(payload+'\n')
                 logging.debug((repr(headers), repr(pheaders), repr(pdata)))
 
@@ -45,6 +80,8 @@ class SupervisorEventListener(object):
         except:
             logging.exception('Event listener blew up')
         finally:
+            if self.revisions is not None:
+                self.revisions.close()
             self.socket.close()
             self.context.term()
 
@@ -62,7 +99,10 @@ if __name__ == '__main__':
     publish_url = config.get('events', 'publish_url')
     watching = set([name.strip() for name in config.get('events', 'watching').split(',')])
     log_file = config.get('events', 'log_file')
+    revisions_url = None
+    if config.has_option('events', 'revisions_url'):
+        revisions_url = config.get('events', 'revisions_url')
 
     logging.basicConfig(filename=log_file, level=logging.DEBUG)
-    e = SupervisorEventListener(publish_url, watching)
+    e = SupervisorEventListener(publish_url, watching, revisions_url)
     e.run()
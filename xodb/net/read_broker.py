@@ -1,18 +1,171 @@
-from xodb.net.broker import Broker, run
+import time
+from collections import deque
+
+from xodb.net import envelope
+from xodb.net.broker import Broker, run, payload_bytes
+from xodb.net.ring import HashRing
 
 
 class ReadBroker(Broker):
+    """Routes read requests to reader workers.
+
+    With the default 'lru' routing, each request goes to the least
+    recently used idle worker.  With 'affinity' routing, requests are
+    hashed on their method and query onto a consistent hash ring of
+    workers, so repeated queries land on the same worker and hit its
+    warm query and parser caches.  If the preferred worker is busy the
+    request waits up to *affinity_wait* milliseconds for it, with at
+    most *affinity_depth* requests waiting per worker, before falling
+    back to the LRU worker.
+
+    Reads are idempotent, so identical requests can be coalesced and
+    their replies cached, see Broker.
+    """
+
+    def __init__(self, worker_url, client_url, events_url, routing='lru',
+                 affinity_wait=20, affinity_depth=1, **options):
+        super(ReadBroker, self).__init__(worker_url, client_url, events_url,
+                                         **options)
+        if routing not in ('lru', 'affinity'):
+            raise ValueError('Unknown routing %s' % routing)
+        self.routing = routing
+        self.affinity_wait = affinity_wait / 1000.0
+        self.affinity_depth = affinity_depth
+        self.ring = HashRing()
+
+        # requests waiting for their preferred worker, in arrival
+        # order, and per worker.  entries are lists of [deadline,
+        # worker_name, client_addr, request, done]
+        self.parked = deque()
+        self.parked_by_worker = {}
+
+        self.affinity_counts = dict(hits=0, waits=0, misses=0)
+
+    @classmethod
+    def config_options(cls, config, name):
+        options = super(ReadBroker, cls).config_options(config, name)
+        if config.has_option(name, 'coalesce'):
+            options['coalesce'] = config.getboolean(name, 'coalesce')
+        if config.has_option(name, 'cache_size'):
+            options['cache_size'] = config.getint(name, 'cache_size')
+        if config.has_option(name, 'cache_ttl'):
+            options['cache_ttl'] = config.getint(name, 'cache_ttl')
+        if config.has_option(name, 'cache_bytes'):
+            options['cache_bytes'] = config.getint(name, 'cache_bytes')
+        if config.has_option(name, 'routing'):
+            options['routing'] = config.get(name, 'routing')
+        if config.has_option(name, 'affinity_wait'):
+            options['affinity_wait'] = config.getint(name, 'affinity_wait')
+        if config.has_option(name, 'affinity_depth'):
+            options['affinity_depth'] = config.getint(name, 'affinity_depth')
+        return options
+
+    def routing_key(self, request):
+        """Return the affinity key for a request: its method and query.
+
+        Requests that can't be decoded are keyed on their raw bytes.
+        """
+        payload = payload_bytes(request[-1])
+        try:
+            method, args, kwargs = self.codec.loads(payload)
+            query = args[0] if args else kwargs.get('query', '')
+            return '%s\0%r' % (method, query)
+        except Exception:
+            return payload
+
+    def route(self, client_addr, request, tries=0):
+        # retried requests and hedged copies go straight to the LRU
+        # worker, the preferred one is likely the one that is slow
+        if (self.routing == 'affinity' and not tries and
+            not envelope.is_hedge(request[:-1])):
+            if self.route_affinity(client_addr, request):
+                return
+            self.affinity_counts['misses'] += 1
+        super(ReadBroker, self).route(client_addr, request, tries)
+
+    def route_affinity(self, client_addr, request):
+        """Send or park a request for its preferred worker.  Returns
+        False if the request should go to the LRU worker instead."""
+        worker_name = self.ring.get(self.routing_key(request))
+        if worker_name is None:
+            return False
+        if worker_name in self.workers:
+            self.affinity_counts['hits'] += 1
+            worker_addr = self.workers.pop(worker_name)
+            self.dispatch(worker_name, worker_addr, client_addr, request)
+            return True
+        waiting = self.parked_by_worker.setdefault(worker_name, deque())
+        while waiting and waiting[0][4]:
+            waiting.popleft()
+        if len(waiting) >= self.affinity_depth:
+            return False
+        entry = [time.time() + self.affinity_wait, worker_name,
+                 client_addr, request, False]
+        waiting.append(entry)
+        self.parked.append(entry)
+        return True
+
+    def handle_worker_ready(self, worker_name):
+        if self.routing == 'affinity':
+            self.ring.add(worker_name)
+
+    def handle_worker_exited(self, worker_name):
+        self.ring.remove(worker_name)
+        # anything waiting for the dead worker falls back right away
+        for entry in self.parked_by_worker.pop(worker_name, ()):
+            entry[0] = 0
+
+    def handle_worker_idle(self, worker_name):
+        waiting = self.parked_by_worker.get(worker_name)
+        while waiting:
+            entry = waiting.popleft()
+            if entry[4]:
+                continue
+            entry[4] = True
+            self.affinity_counts['waits'] += 1
+            worker_addr = self.workers.pop(worker_name)
+            self.dispatch(worker_name, worker_addr, entry[2], entry[3])
+            return
+
+    def handle_timers(self):
+        now = time.time()
+        while self.parked:
+            entry = self.parked[0]
+            if entry[4]:
+                self.parked.popleft()
+                continue
+            if entry[0] > now or not self.workers:
+                return
+            # waited too long for the preferred worker, use the LRU
+            self.parked.popleft()
+            entry[4] = True
+            self.affinity_counts['misses'] += 1
+            worker_name, worker_addr = self.workers.popitem(last=False)
+            self.dispatch(worker_name, worker_addr, entry[2], entry[3])
+
+    def poll_timeout(self):
+        for entry in self.parked:
+            if not entry[4]:
+                if not self.workers:
+                    return None
+                return max(0, (entry[0] - time.time()) * 1000)
+        return None
 
-    def handle_worker(self):
-        """Handle a request from the front end, passing it to the backend. """
-        client_addr, empty, request= self.frontend.recv_multipart()
-        assert empty == ''
-        
-        # pop a worker, mark it busy.
-        worker_name, worker_addr = self.workers.popitem(last=False)
-        self.busy[worker_name] = client_addr, request, 0
+    def affinity_stats(self):
+        """Return the affinity counters and the hit rate, the fraction
+        of affinity routed requests that ran on their preferred
+        worker."""
+        stats = dict(self.affinity_counts)
+        total = sum(stats.values())
+        preferred = stats['hits'] + stats['waits']
+        stats['hit_rate'] = float(preferred) / total if total else 0.0
+        return stats
 
-        self.backend.send_multipart([worker_addr, "", client_addr, request])
+    def stats(self):
+        stats = super(ReadBroker, self).stats()
+        if self.routing == 'affinity':
+            stats['affinity'] = self.affinity_stats()
+        return stats
 
 
 if __name__ == "__main__":
@@ -1,20 +1,94 @@
+import time
 import logging
-from cPickle import dumps, loads
 
+from xodb.net import stream, stats
 from xodb.net.worker import Worker, run
 
 
+ROW_FIELDS = ('docid', 'percent', 'rank', 'weight', 'data')
+"""Field order of the plain result rows sent to clients."""
+
+
+def to_row(record):
+    """Turn a Record into a plain tuple of ROW_FIELDS that any codec
+    can carry."""
+    return (record._id,
+            record._xodb_percent,
+            record._xodb_rank,
+            record._xodb_weight,
+            record._xodb_schema.value)
+
+
+def plain_expansion(expansion):
+    """Turn the ordered dictionary returned by Database.expand into a
+    list of (name, score) pairs, or (name, score, expansion) triples
+    for names that were expanded further, best first."""
+    result = []
+    for name, value in expansion.items():
+        if isinstance(value, tuple):
+            score, sub = value
+            result.append((name, score, plain_expansion(sub)))
+        else:
+            result.append((name, value))
+    return result
+
+
 class Reader(Worker):
+    """Answers read requests.
+
+    Every result is a plain structure that any codec can carry, so a
+    pool of readers can serve the whole read workload:
+
+      count, estimate -- ints.
+
+      query -- a list of Records, or of ROW_FIELDS rows if the codec
+        can't carry Records.  Queries require a limit unless streamed.
+
+      allterms, suggest -- lists of terms, or of (term, weight) pairs
+        for suggest(score=True).
+
+      facet -- a dictionary of facet to count.
+
+      expand -- see plain_expansion.
+
+      spell, describe_query -- strings.
+
+      record_cache -- a dictionary of the record cache's counters, or
+        None.
+
+      multi(calls) -- a list of the results of a batch of (method,
+        args, kwargs) calls, with a call's exception in place of its
+        result if it failed.
+    """
 
     def handle_request(self):
-        client, data = self.socket.recv_multipart()
+        # any frames between the client address and the request are
+        # headers that get echoed back with the reply
+        message = self.recv()
+        if message is None:
+            return
+        started = time.time()
+        client, headers, data = message[0], message[1:-1], message[-1]
+        m = None
         try:
-            m, args, kwargs = loads(data)
+            m, args, kwargs = self.codec.loads(data)
+            self.refresh(kwargs.pop('min_revision', None))
+            opened = stream.find_open(headers)
+            if opened is not None:
+                # stream_ handlers produce their items lazily
+                handler = (getattr(self, 'stream_' + m, None) or
+                           getattr(self, 'handle_' + m))
+                self.send_stream(client, headers, handler(*args, **kwargs),
+                                 *opened)
+                return
             result = getattr(self, 'handle_' + m)(*args, **kwargs)
-            self.socket.send_multipart([self.name, client, '', dumps(result)])
         except Exception, e:
             logging.exception('Error handling request.')
-            self.socket.send_multipart([self.name, client, '', dumps(e)])
+            result = e
+        self.send([self.name, client, ''] + headers +
+                  [stats.pack_timing(m, time.time() - started,
+                                     isinstance(result, Exception)),
+                   self.codec.dumps(result)])
 
     def handle_count(self, *args, **kwargs):
         return self.db.count(*args, **kwargs)
@@ -25,7 +99,54 @@ class Reader(Worker):
     def handle_query(self, *args, **kwargs):
         if 'limit' not in kwargs:
             raise TypeError('Remote queries require a limit')
-        return list(self.db.query(*args, **kwargs))
+        records = self.db.query(*args, **kwargs)
+        if self.codec.records:
+            return list(records)
+        return [to_row(r) for r in records]
+
+    def handle_estimate(self, *args, **kwargs):
+        return self.db.estimate(*args, **kwargs)
+
+    def handle_facet(self, *args, **kwargs):
+        return dict(self.db.facet(*args, **kwargs))
+
+    def handle_expand(self, *args, **kwargs):
+        return plain_expansion(self.db.expand(*args, **kwargs))
+
+    def handle_suggest(self, *args, **kwargs):
+        return list(self.db.suggest(*args, **kwargs))
+
+    def handle_spell(self, *args, **kwargs):
+        return self.db.spell(*args, **kwargs)
+
+    def handle_describe_query(self, *args, **kwargs):
+        return self.db.describe_query(*args, **kwargs)
+
+    def handle_record_cache(self):
+        """Return the counters of the record cache, or None if the
+        process has none."""
+        cache = self.db.record_cache
+        return cache.stats() if cache is not None else None
+
+    def handle_multi(self, calls):
+        results = []
+        for m, args, kwargs in calls:
+            try:
+                if m == 'multi':
+                    raise ValueError('multi calls can not be nested')
+                results.append(getattr(self, 'handle_' + m)(*args, **kwargs))
+            except Exception, e:
+                logging.exception('Error handling %s in multi.' % m)
+                results.append(e)
+        return results
+
+    def stream_query(self, *args, **kwargs):
+        """Query results for a streamed reply, which need no limit
+        since they are never all in memory at once."""
+        records = self.db.query(*args, **kwargs)
+        if self.codec.records:
+            return records
+        return (to_row(r) for r in records)
 
 if __name__ == '__main__':
     run('reader', Reader)
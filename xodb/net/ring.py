@@ -0,0 +1,60 @@
+"""
+Consistent hash ring.
+
+Maps keys onto a set of nodes so that adding or removing a node only
+moves the keys that hashed to it.  Each node is placed on the ring
+*replicas* times to even out the distribution.
+"""
+import struct
+from hashlib import md5
+from bisect import bisect, insort
+
+_unsigned = struct.Struct('!I')
+
+
+def _hash(key):
+    return _unsigned.unpack_from(md5(key).digest())[0]
+
+
+class HashRing(object):
+
+    def __init__(self, nodes=(), replicas=64):
+        self.replicas = replicas
+        self.points = []
+        self.owners = {}
+        self.nodes = set()
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for i in xrange(self.replicas):
+            point = _hash('%s:%s' % (node, i))
+            self.owners[point] = node
+            insort(self.points, point)
+
+    def remove(self, node):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        for i in xrange(self.replicas):
+            point = _hash('%s:%s' % (node, i))
+            if self.owners.get(point) == node:
+                del self.owners[point]
+        self.points = [p for p in self.points if p in self.owners]
+
+    def get(self, key):
+        """Return the node that owns *key*, or None if the ring is
+        empty."""
+        if not self.points:
+            return None
+        i = bisect(self.points, _hash(key)) % len(self.points)
+        return self.owners[self.points[i]]
+
+    def __contains__(self, node):
+        return node in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
@@ -0,0 +1,139 @@
+"""Broker metrics.
+
+Workers put a timing frame before the payload of each reply, holding
+the request's method name, how long the worker took to handle it and
+whether the reply is an error, so brokers never have to decode
+payloads to tell.
+Brokers strip the frame before forwarding the reply, and keep per
+method request counts and latency histograms, both as measured by the
+broker from dispatch to reply and as reported by the workers.
+
+A client that sends STATS as its payload gets the broker's metrics
+back right away, as a dictionary of plain values.
+"""
+import time
+import struct
+from bisect import bisect_left
+
+
+STATS = 'XSTATS'
+
+TIMING = 'XT1'
+
+timing_frame = struct.Struct('!3sf?')
+
+BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+          30000, 60000)
+"""Upper bounds in milliseconds of the histogram buckets.  Latencies
+above the last bound go in an overflow bucket."""
+
+
+def pack_timing(method, seconds, failed=False):
+    """Return a timing frame for a request to *method* that took
+    *seconds* to handle, and *failed* if its reply is an error."""
+    if isinstance(method, unicode):
+        method = method.encode('utf8')
+    return (timing_frame.pack(TIMING, seconds * 1000, failed) +
+            (method or ''))
+
+
+def unpack_timing(frame):
+    """Return the (method, milliseconds, failed) of a timing frame, or
+    None."""
+    if len(frame) < timing_frame.size or not frame.startswith(TIMING):
+        return None
+    magic, elapsed, failed = timing_frame.unpack(frame[:timing_frame.size])
+    return frame[timing_frame.size:], elapsed, failed
+
+
+class Histogram(object):
+    """Counts of latencies in fixed, roughly logarithmic buckets."""
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed):
+        self.buckets[bisect_left(self.bounds, elapsed)] += 1
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def percentile(self, percentile):
+        """Return the upper bound of the bucket holding the given
+        percentile, or the largest latency seen if that is in the
+        overflow bucket."""
+        if not self.count:
+            return 0.0
+        rank = self.count * percentile / 100.0
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= rank:
+                return float(min(bound, self.max))
+        return self.max
+
+    def as_dict(self):
+        return dict(count=self.count,
+                    mean=self.total / self.count if self.count else 0.0,
+                    p50=self.percentile(50),
+                    p95=self.percentile(95),
+                    p99=self.percentile(99),
+                    max=self.max,
+                    buckets=[(bound, count) for bound, count
+                             in zip(self.bounds + (None,), self.buckets)
+                             if count])
+
+
+class Metrics(object):
+    """Per method request counts and latencies.
+
+    Rates are requests per second since the last call to roll().
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.latency = {}
+        self.execution = {}
+        self.rolled_at = time.time()
+        self.rolled_counts = {}
+
+    def record(self, method, latency=None, execution=None):
+        """Count a reply to *method*, with the milliseconds the broker
+        waited for it and the milliseconds the worker took."""
+        self.counts[method] = self.counts.get(method, 0) + 1
+        if latency is not None:
+            if method not in self.latency:
+                self.latency[method] = Histogram()
+            self.latency[method].add(latency)
+        if execution is not None:
+            if method not in self.execution:
+                self.execution[method] = Histogram()
+            self.execution[method].add(execution)
+
+    def rates(self, now=None):
+        elapsed = max((now or time.time()) - self.rolled_at, 1e-3)
+        return dict((method, (count - self.rolled_counts.get(method, 0)) /
+                     elapsed)
+                    for method, count in self.counts.items())
+
+    def roll(self, now=None):
+        """Start a new rate window."""
+        self.rolled_at = now or time.time()
+        self.rolled_counts = dict(self.counts)
+
+    def as_dict(self, now=None):
+        rates = self.rates(now)
+        methods = {}
+        for method, count in self.counts.items():
+            methods[method] = dict(count=count, rate=rates[method])
+            if method in self.latency:
+                methods[method]['latency'] = self.latency[method].as_dict()
+            if method in self.execution:
+                methods[method]['execution'] = (
+                    self.execution[method].as_dict())
+        return methods
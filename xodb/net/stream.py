@@ -0,0 +1,80 @@
+"""Streamed replies.
+
+A client asks for a streamed reply by sending an open frame among its
+request's header frames, holding the number of chunks the worker may
+send before waiting (its credits) and the number of items per chunk.
+The worker replies with any number of chunks, each a chunk frame with
+a sequence number and a final flag, followed by the encoded list of
+items.  The last chunk has the final flag set, and carries an
+exception instead of items if the stream failed.
+
+As the client consumes chunks it grants the worker more credits by
+sending a request with the same header frames and a credit frame as
+its payload.  Brokers route credits to the worker sending the stream.
+"""
+import struct
+
+
+OPEN, CHUNK, CREDIT = 'XO1', 'XK1', 'XC1'
+
+CHUNK_SIZE = 100
+"""Default number of items per chunk."""
+
+CREDITS = 4
+"""Default number of chunks a worker may send ahead of the client."""
+
+STREAM_TIMEOUT = 30000
+"""Milliseconds a worker waits for credits before giving up on a
+stream."""
+
+open_frame = struct.Struct('!3sII')
+chunk_frame = struct.Struct('!3sIB')
+credit_frame = struct.Struct('!3sI')
+
+
+class StreamError(Exception):
+    """A stream was interrupted."""
+
+
+def _unpack(frame, magic, frame_struct):
+    if len(frame) != frame_struct.size or not frame.startswith(magic):
+        return None
+    return frame_struct.unpack(frame)[1:]
+
+
+def pack_open(credits=CREDITS, chunk_size=CHUNK_SIZE):
+    return open_frame.pack(OPEN, credits, chunk_size)
+
+
+def find_open(headers):
+    """Return the (credits, chunk_size) of a stream request's open
+    frame, or None if the request is not for a stream."""
+    for frame in headers:
+        found = _unpack(frame, OPEN, open_frame)
+        if found is not None:
+            return found
+    return None
+
+
+def pack_chunk(seq, final=False):
+    return chunk_frame.pack(CHUNK, seq, bool(final))
+
+
+def unpack_chunk(frame):
+    """Return the (seq, final) of a chunk frame, or None."""
+    found = _unpack(frame, CHUNK, chunk_frame)
+    if found is not None:
+        return found[0], bool(found[1])
+    return None
+
+
+def pack_credit(credits=1):
+    return credit_frame.pack(CREDIT, credits)
+
+
+def unpack_credit(frame):
+    """Return the credits granted by a credit frame, or None."""
+    found = _unpack(frame, CREDIT, credit_frame)
+    if found is not None:
+        return found[0]
+    return None
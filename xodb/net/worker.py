@@ -2,35 +2,152 @@ import os
 import sys
 import zmq
 import time
+import Queue
 import logging
-from cPickle import dumps, loads
+import threading
+from cPickle import loads, dumps
+
+from xodb.tools import LRUCache
+from xodb.net import envelope, stream
+from xodb.net.codec import get_codec, from_config
 
 
 POLL_TIME = 1000
 
+HEARTBEAT = 'HEARTBEAT'
+
+HEARTBEAT_INTERVAL = 1000
+"""Milliseconds between the heartbeats DEALER workers send their
+broker."""
+
+REVISION_EVENT = 'XODB_REVISION'
+
+
+CANCELLED_LIMIT = 1000
+"""How many cancelled requests a worker remembers."""
+
+
+class RevisionError(Exception):
+    """The worker's database is older than the revision a client
+    asked for."""
+
+
+class CancelledError(Exception):
+    """The client cancelled the request before it was handled."""
+
+
+def revision_event(name, revision):
+    """Encode a revision event the way the events channel publishes
+    supervisor events."""
+    return dumps(({'eventname': REVISION_EVENT},
+                  {'processname': name, 'revision': revision},
+                  ''))
+
 
 class Worker(object):
+    """Handles requests from a broker.
+
+    With *threads* greater than one, the worker handles that many
+    requests at once.  The main thread talks to the broker and puts
+    the requests on a queue.  Each handler thread takes requests off
+    the queue and has its own read-only copy of the database, so the
+    threads share one process's memory and caches.  Replies go back
+    to the main thread over an inproc socket.  The worker advertises
+    a capacity of *threads* requests to the broker.
+    """
 
-    def __init__(self, name, worker_url, db):
+    socket_type = zmq.DEALER
+    """DEALER workers can be sent up to *capacity* requests at once,
+    and send the broker heartbeats while they are not busy with a
+    request.  REQ workers handle one request at a time and cannot
+    send heartbeats.
+    """
+
+    capacity = 1
+    """How many outstanding requests the broker may send this worker."""
+
+    writable = False
+    """Open the worker's database in writable mode."""
+
+    def __init__(self, name, worker_url, db, codec='pickle',
+                 events_url=None, threads=1):
         self.name = name
         self.worker_url = worker_url
-        self.db = db
+        self.main_db = db
+        self.codec = get_codec(codec)
         self.context = zmq.Context(1)
-        self.socket = self.context.socket(zmq.REQ)
+        self.socket = self.context.socket(self.socket_type)
         self.poller = zmq.Poller()
+        self.heartbeat_at = 0
+
+        # per thread state: the handler threads' databases and reply
+        # sockets
+        self.local = threading.local()
+        self.threads = threads
+        self.handlers = []
+        self.requests = None
+        self.replies = None
+        self.running = True
+
+        # credit queues of the streams being sent by handler threads
+        self.credits = {}
+
+        # requests cancelled by their clients, keyed by client address
+        # and headers; the oldest are forgotten, they were most likely
+        # answered
+        self.cancelled = LRUCache(limit=CANCELLED_LIMIT)
+        if threads > 1:
+            if self.writable:
+                raise ValueError('Writable workers cannot use threads')
+            if self.socket_type != zmq.DEALER:
+                raise ValueError('Threaded workers need DEALER sockets')
+            self.capacity = threads
+            self.requests = Queue.Queue()
+            self.replies_url = 'inproc://xodb-worker-%x' % id(self)
+            self.replies = self.context.socket(zmq.PULL)
+            self.replies.bind(self.replies_url)
+
+        # with an events channel, read only workers reopen their
+        # database when a new revision is announced instead of before
+        # every request.  the supervisor's TICK_5 events are a safety
+        # net for revision events that get lost.
+        self.events_url = events_url
+        self.events = None
+        self.generation = 0
+        if events_url and not self.writable:
+            self.events = self.context.socket(zmq.SUB)
+            self.events.setsockopt(zmq.SUBSCRIBE, '')
+            self.db.auto_reopen = False
 
     def run(self):
         try:
             self.poller.register(self.socket, zmq.POLLIN)
             self.socket.connect(self.worker_url)
+            if self.events is not None:
+                self.poller.register(self.events, zmq.POLLIN)
+                self.events.connect(self.events_url)
+            if self.replies is not None:
+                self.poller.register(self.replies, zmq.POLLIN)
+                self.start_threads()
             logging.debug('Sending ready message to server.')
-            self.socket.send_multipart(['READY', self.name])
+            self.send(['READY', self.name, str(self.capacity)])
             logging.debug('Ready to handle requests.')
             while True:
                 try:
-                    socks = dict(self.poller.poll(POLL_TIME))
+                    socks = dict(self.poller.poll(self.poll_timeout()))
+                    if (self.events is not None and
+                        socks.get(self.events) == zmq.POLLIN):
+                        self.handle_event()
+                    if (self.replies is not None and
+                        socks.get(self.replies) == zmq.POLLIN):
+                        self.forward_replies()
                     if socks.get(self.socket) == zmq.POLLIN:
-                        self.handle_request()
+                        if self.requests is not None:
+                            self.queue_requests()
+                        else:
+                            self.handle_request()
+                    self.handle_timers()
+                    self.heartbeat()
                 except Exception:
                     logging.exception('Error in read_worker inner loop')
         except Exception:
@@ -38,12 +155,292 @@ class Worker(object):
         finally:
             self.die()
 
+    @property
+    def db(self):
+        """The database of the current handler thread, or the
+        worker's database."""
+        return getattr(self.local, 'db', self.main_db)
+
+    def send(self, frames):
+        """Send frames to the broker.  DEALER sockets have to supply
+        the empty delimiter frame that REQ sockets add themselves.
+        Handler threads pass their frames to the main thread.
+
+        Frames may be any buffer, large ones are sent without being
+        copied, so they must not be changed afterwards."""
+        pipe = getattr(self.local, 'pipe', None)
+        if pipe is not None:
+            pipe.send_multipart(frames, copy=False)
+            return
+        if self.socket_type == zmq.DEALER:
+            frames = [''] + frames
+        self.socket.send_multipart(frames, copy=False)
+
+    def recv(self, flags=0):
+        """Receive frames from the broker, without the delimiter.
+        Returns None for a heartbeat.  Handler threads receive the
+        next request from the queue."""
+        if getattr(self.local, 'pipe', None) is not None:
+            return self.next_request()
+        frames = self.socket.recv_multipart(flags)
+        if self.socket_type == zmq.DEALER:
+            frames = frames[1:]
+        if frames == [HEARTBEAT]:
+            return None
+        if frames[-1] == envelope.CANCEL:
+            self.handle_cancel(frames)
+            return None
+        return frames
+
+    def next_request(self):
+        """Take the next request off the queue in a handler thread.
+        Requests cancelled while queued are answered with a
+        CancelledError, so the broker knows the worker is free."""
+        message = self.requests.get()
+        if message is None:
+            return None
+        client, headers = message[0], message[1:-1]
+        if self.cancelled.pop((client, tuple(headers)), None) is None:
+            return message
+        self.send([self.name, client, ''] + headers +
+                  [self.codec.dumps(CancelledError('Cancelled'))])
+        return None
+
+    def handle_cancel(self, message):
+        """A client cancelled a request.  Streams stop, queued
+        requests are skipped, running requests run to the end."""
+        key = (message[0], tuple(message[1:-1]))
+        self.cancelled.set(key, time.time())
+        credits = self.credits.get(key)
+        if credits is not None:
+            credits.put(0)
+
+    def heartbeat(self):
+        """Tell the broker the worker is alive, and how many requests
+        it can take, if it has not done so lately.  A broker that lost
+        track of the worker, say because it was restarted, registers
+        it again."""
+        if self.socket_type != zmq.DEALER:
+            return
+        now = time.time()
+        if now >= self.heartbeat_at:
+            self.heartbeat_at = now + HEARTBEAT_INTERVAL / 1000.0
+            self.send([HEARTBEAT, self.name, str(self.capacity)])
+
     def handle_request(self):
         return
 
+    def start_threads(self):
+        for i in xrange(self.threads):
+            thread = threading.Thread(target=self.serve,
+                                      name='%s-%s' % (self.name, i))
+            thread.daemon = True
+            thread.start()
+            self.handlers.append(thread)
+
+    def serve(self):
+        """Handle requests from the queue in a handler thread."""
+        self.local.db = self.open_database()
+        self.local.generation = self.generation
+        pipe = self.context.socket(zmq.PUSH)
+        pipe.connect(self.replies_url)
+        self.local.pipe = pipe
+        try:
+            while self.running:
+                try:
+                    self.handle_request()
+                except Exception:
+                    logging.exception('Error in handler thread')
+        finally:
+            pipe.close()
+
+    def open_database(self):
+        """Open a handler thread's own copy of the database."""
+        import xodb
+        db = xodb.open(self.main_db.db_path, writable=False)
+        db.auto_reopen = self.main_db.auto_reopen
+        return db
+
+    def queue_requests(self):
+        """Move the requests waiting on the socket to the queue."""
+        while True:
+            try:
+                message = self.socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            if self.socket_type == zmq.DEALER:
+                message = message[1:]
+            if message == [HEARTBEAT]:
+                continue
+            if message[-1] == envelope.CANCEL:
+                self.handle_cancel(message)
+                continue
+            granted = stream.unpack_credit(message[-1])
+            if granted is None:
+                self.requests.put(message)
+                continue
+            # credits go to the thread sending the stream
+            credits = self.credits.get((message[0], tuple(message[1:-1])))
+            if credits is not None:
+                credits.put(granted)
+
+    def forward_replies(self):
+        """Send the handler threads' replies to the broker, passing
+        their frames through without copying them."""
+        while True:
+            try:
+                frames = self.replies.recv_multipart(zmq.NOBLOCK,
+                                                     copy=False)
+            except zmq.Again:
+                return
+            self.send(frames)
+
+    def send_stream(self, client, headers, items, credits=stream.CREDITS,
+                    chunk_size=stream.CHUNK_SIZE):
+        """Send the items of an iterable to a client in chunks,
+        waiting for the client to grant credits whenever it has been
+        sent *credits* chunks it hasn't consumed yet.  The final chunk
+        is always sent, with an exception if the items could not be
+        produced or the client stopped granting credits.
+        """
+        key = (client, tuple(headers))
+        if self.requests is not None:
+            self.credits[key] = Queue.Queue()
+        seq = 0
+        chunk = []
+        try:
+            try:
+                for item in items:
+                    chunk.append(item)
+                    if len(chunk) < chunk_size:
+                        continue
+                    if self.cancelled.pop(key, None) is not None:
+                        raise stream.StreamError('Cancelled')
+                    while not credits:
+                        credits = self.wait_credit(key)
+                        if not credits:
+                            raise stream.StreamError('No credits granted')
+                    self.send([self.name, client, ''] + headers +
+                              [stream.pack_chunk(seq),
+                               self.codec.dumps(chunk)])
+                    seq += 1
+                    credits -= 1
+                    chunk = []
+            except Exception, e:
+                logging.exception('Error sending stream.')
+                chunk = e
+            self.send([self.name, client, ''] + headers +
+                      [stream.pack_chunk(seq, True), self.codec.dumps(chunk)])
+        finally:
+            self.credits.pop(key, None)
+
+    def wait_credit(self, key):
+        """Wait for the client of a stream to grant credits.  Returns
+        the credits granted, 0 if it timed out."""
+        timeout = stream.STREAM_TIMEOUT / 1000.0
+        if self.requests is not None:
+            try:
+                return self.credits[key].get(timeout=timeout)
+            except Queue.Empty:
+                return 0
+        # a single threaded worker has nothing else to do, so it reads
+        # the socket itself
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.socket.poll(remaining * 1000):
+                return 0
+            message = self.recv()
+            if key in self.cancelled:
+                return 0
+            if message is None:
+                continue
+            granted = stream.unpack_credit(message[-1])
+            if (granted is not None and
+                (message[0], tuple(message[1:-1])) == key):
+                return granted
+            logging.warning('Dropped a message while sending a stream')
+
+    def handle_event(self):
+        """Handle the events waiting on the events channel."""
+        while True:
+            try:
+                event = self.events.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            headers, eventdata, payload = loads(event)
+            eventname = headers.get('eventname')
+            if eventname == REVISION_EVENT:
+                self.handle_revision(eventdata.get('revision'))
+            elif eventname == 'TICK_5':
+                self.mark_stale()
+
+    def handle_revision(self, revision):
+        """A writer committed *revision*, None if its database has no
+        revision numbers."""
+        if (self.requests is not None or revision is None or
+            revision != self.db.revision):
+            self.mark_stale()
+
+    def mark_stale(self):
+        """Have every thread reopen its database before its next
+        request."""
+        self.generation += 1
+
+    def refresh(self, min_revision=None):
+        """Reopen the database if it changed since it was last
+        opened.
+
+        :param min_revision: The oldest revision the caller can
+        accept, from a client that wants to read its own writes.
+        RevisionError is raised if the database is still older after
+        reopening.  Databases with no revision are always reopened
+        for it.
+        """
+        generation = self.generation
+        if (getattr(self.local, 'generation', 0) != generation or
+            (min_revision is not None and
+             (self.db.revision is None or self.db.revision < min_revision))):
+            self.db.reopen(force=True)
+            self.local.generation = generation
+        if (min_revision is not None and self.db.revision is not None and
+            self.db.revision < min_revision):
+            raise RevisionError('Revision %r is older than %r' %
+                                (self.db.revision, min_revision))
+
+    def handle_timers(self):
+        """Called on every pass through the run loop."""
+        return
+
+    def poll_timeout(self):
+        """Milliseconds to wait for a request before handle_timers is
+        called."""
+        return POLL_TIME
+
+    @classmethod
+    def config_options(cls, config, section):
+        """Extra constructor arguments read from the worker's config
+        section."""
+        options = {}
+        if config.has_option(section, 'events_url'):
+            options['events_url'] = config.get(section, 'events_url')
+        if not cls.writable and config.has_option(section, 'threads'):
+            options['threads'] = config.getint(section, 'threads')
+        return options
+
     def die(self):
         time.sleep(1)
+        self.running = False
+        for thread in self.handlers:
+            # wake the handler threads so they can finish
+            self.requests.put(None)
+        for thread in self.handlers:
+            thread.join(1)
         self.socket.close()
+        if self.events is not None:
+            self.events.close()
+        if self.replies is not None:
+            self.replies.close()
         self.context.term()
         sys.exit()
 
@@ -65,9 +462,16 @@ def run(section, worker_cls):
     worker_url = config.get(section, 'worker_url')
     log_file = config.get(section, 'log_file')
     db_path = config.get(section, 'db_path')
+    codec = from_config(config, section)
+    options = worker_cls.config_options(config, section)
 
     logging.basicConfig(filename=log_file % name, level=logging.DEBUG)
-    db = xodb.open(db_path, writable=False)
-    w = worker_cls(name, worker_url, db)
+    if not worker_cls.writable and config.has_option(section,
+                                                     'record_cache'):
+        # the size in bytes of the process-wide decoded record cache
+        xodb.Database.record_cache = xodb.RecordCache(
+            config.getint(section, 'record_cache'))
+    db = xodb.open(db_path, writable=worker_cls.writable)
+    w = worker_cls(name, worker_url, db, codec, **options)
     logging.debug('Running worker on %s' % worker_url)
     w.run()
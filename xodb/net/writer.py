@@ -1,10 +1,200 @@
-from xodb.net.worker import Worker, run
+import time
+import logging
+
+import zmq
+
+from xodb.exc import ValidationError
+from xodb.database import _lookup_schema
+from xodb.net import stats
+from xodb.net.worker import Worker, run, POLL_TIME, revision_event
 
 
 class Writer(Worker):
+    """Applies write requests to the database in batches.
+
+    Requests from any number of clients are collected into a batch,
+    which is applied in one transaction and committed once the batch
+    has *batch_size* requests or its first request has waited
+    *batch_wait* milliseconds.  Each client is answered only after the
+    commit, with the result of its request and the revision the batch
+    was committed as, so that readers can reopen to at least that
+    revision.
+
+    Requests are (method, args, kwargs) tuples, like reads:
+
+      add(obj) -- Add a document, returns its docid.
+
+      replace(docid, obj) -- Replace the document with docid.
+
+      upsert(term, obj) -- Replace all documents indexed with a
+        unique term, or add one if there are none.  The term is added
+        to the document.
+
+      delete(docid_or_term) -- Delete a document by docid, or all the
+        documents with a term.
+
+    *obj* is either a memo dictionary (see Memo.dict) or a schema
+    dictionary, {'schema': 'module.SchemaClass', 'value': {...}}.
+
+    After each commit the new revision is pushed to the events
+    listener at *revisions_url*, which publishes it on the events
+    channel so that readers know to reopen their databases.
+
+    If the writer dies mid-batch the broker retries the batch's
+    requests, so a batch that was committed but not answered can be
+    applied twice.  Use upsert for writes that must be idempotent.
+    """
+
+    writable = True
+
+    def __init__(self, name, worker_url, db, codec='pickle',
+                 events_url=None, batch_size=100, batch_wait=10,
+                 revisions_url=None):
+        super(Writer, self).__init__(name, worker_url, db, codec,
+                                     events_url)
+        self.capacity = self.batch_size = batch_size
+        self.batch_wait = batch_wait / 1000.0
+        self.batch = []
+        self.batch_started = None
+
+        self.revisions = None
+        if revisions_url:
+            self.revisions = self.context.socket(zmq.PUSH)
+            self.revisions.setsockopt(zmq.LINGER, 0)
+            self.revisions.connect(revisions_url)
+
+    @classmethod
+    def config_options(cls, config, section):
+        options = super(Writer, cls).config_options(config, section)
+        if config.has_option(section, 'revisions_url'):
+            options['revisions_url'] = config.get(section, 'revisions_url')
+        if config.has_option(section, 'batch_size'):
+            options['batch_size'] = config.getint(section, 'batch_size')
+        if config.has_option(section, 'batch_wait'):
+            options['batch_wait'] = config.getint(section, 'batch_wait')
+        return options
 
     def handle_request(self):
-        return
+        while len(self.batch) < self.batch_size:
+            try:
+                message = self.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            if message is None:
+                continue
+            if not self.batch:
+                self.batch_started = time.time()
+            self.batch.append(message)
+        if len(self.batch) >= self.batch_size:
+            self.commit_batch()
+
+    def handle_timers(self):
+        if self.batch and (time.time() - self.batch_started >=
+                           self.batch_wait):
+            self.commit_batch()
+
+    def poll_timeout(self):
+        if self.batch:
+            remaining = self.batch_started + self.batch_wait - time.time()
+            return max(0, remaining * 1000)
+        return POLL_TIME
+
+    def commit_batch(self):
+        """Apply and commit the current batch, then answer its
+        clients."""
+        batch, self.batch = self.batch, []
+        started = time.time()
+        methods = [None] * len(batch)
+        results = []
+        revision = None
+        committed = False
+        # Database.begin and commit ignore the backend's errors, a
+        # batch is only answered as committed if it really was
+        backend = self.db.backend
+        try:
+            backend.begin_transaction()
+            for i, message in enumerate(batch):
+                try:
+                    method, args, kwargs = self.codec.loads(message[-1])
+                    methods[i] = method
+                    results.append(
+                        getattr(self, 'handle_' + method)(*args, **kwargs))
+                except Exception, e:
+                    logging.exception('Error applying write.')
+                    results.append(e)
+            backend.commit_transaction()
+            self.db.flush()
+            revision = self.db.revision
+            committed = True
+        except Exception, e:
+            logging.exception('Error committing batch.')
+            try:
+                backend.cancel_transaction()
+            except Exception:
+                # the failed commit may have ended the transaction
+                logging.exception('Error cancelling batch.')
+            results = [e] * len(batch)
+
+        elapsed = time.time() - started
+        logging.debug('Committed %s writes as revision %r' %
+                      (len(batch), revision))
+        if committed:
+            self.publish_revision(revision)
+        # every write in a batch takes as long as the whole batch
+        for message, method, result in zip(batch, methods, results):
+            if not isinstance(result, Exception):
+                result = dict(result=result, revision=revision)
+            client, headers = message[0], message[1:-1]
+            self.send([self.name, client, ''] + headers +
+                      [stats.pack_timing(method, elapsed,
+                                         isinstance(result, Exception)),
+                       self.codec.dumps(result)])
+        return revision
+
+    def publish_revision(self, revision):
+        """Announce a new revision.  Announcements are best effort,
+        they are dropped if the events listener is not keeping up."""
+        if self.revisions is None:
+            return
+        try:
+            self.revisions.send(revision_event(self.name, revision),
+                                zmq.NOBLOCK)
+        except zmq.Again:
+            logging.warning('Dropped revision event %r' % (revision,))
+
+    def die(self):
+        if self.revisions is not None:
+            self.revisions.close()
+        super(Writer, self).die()
+
+    def to_document(self, obj):
+        """Turn a memo or schema dictionary into a xapian document."""
+        if 'schema' not in obj:
+            return self.db.doc_from_dict(obj)
+        schema = _lookup_schema(obj['schema'])(obj.get('value', {}))
+        schema.__xodb_db__ = self.db
+        if not schema.validate():
+            raise ValidationError("Elements of %s did not validate" %
+                                  obj['schema'])
+        return self.db.to_document(schema)
+
+    def handle_add(self, obj):
+        return self.db.backend.add_document(self.to_document(obj))
+
+    def handle_replace(self, docid, obj):
+        docid = int(docid)
+        self.db.backend.replace_document(docid, self.to_document(obj))
+        return docid
+
+    def handle_upsert(self, term, obj):
+        doc = self.to_document(obj)
+        doc.add_boolean_term(term)
+        return self.db.backend.replace_document(term, doc)
+
+    def handle_delete(self, docid_or_term):
+        if not isinstance(docid_or_term, basestring):
+            docid_or_term = int(docid_or_term)
+        self.db.backend.delete_document(docid_or_term)
 
 
 if __name__ == "__main__":
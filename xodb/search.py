@@ -57,6 +57,12 @@ class Search(object):
     def filter(self, query):
         return self.operator(query, Query.OP_FILTER)
 
+    def date_range(self, name, begin, end,
+                   resolutions=('year', 'month', 'day')):
+        """Filter on a date range using bucket terms."""
+        return self.filter(self._db.date_range_query(
+            name, begin, end, resolutions))
+
     def and_(self, query):
         return self.operator(query, Query.OP_AND)
 
@@ -1,9 +1,21 @@
 from __future__ import absolute_import
 
 from cStringIO import StringIO
+from collections import Mapping
+from importlib import import_module
 
 from xapian import SimpleStopper
-from . import english, spanish, french, german, italian, russian
+
+languages = {
+    "en" : ("english", "latin-1"),
+    "es" : ("spanish", "latin-1"),
+    "ru" : ("russian", "koi8_r"),
+    "fr" : ("french", "latin-1"),
+    "de" : ("german", "latin-1"),
+    "it" : ("italian", "latin-1"),
+}
+"""Language code to stopword module name and encoding."""
+
 
 def build_stopwords(language, encoding="utf8"):
     file = StringIO(language.stopwords)
@@ -14,24 +26,52 @@ def build_stopwords(language, encoding="utf8"):
             stopwords.append(word)
     return stopwords
 
-stopwords = {
-    "en" : build_stopwords(english, encoding="latin-1"),
-    "es" : build_stopwords(spanish, encoding="latin-1"),
-    "ru" : build_stopwords(russian, encoding="koi8_r"),
-    "fr" : build_stopwords(french, encoding="latin-1"),
-    "de" : build_stopwords(german, encoding="latin-1"),
-    "it" : build_stopwords(italian, encoding="latin-1"),
-}
 
-stoppers = {}
+def _load_stopwords(code):
+    modname, encoding = languages[code]
+    return build_stopwords(import_module('.' + modname, __name__),
+                           encoding=encoding)
+
 
-for code in stopwords:
+def _load_stopper(code):
     stopper = SimpleStopper()
     for word in stopwords[code]:
         stopper.add(word)
-    stoppers[code] = stopper
+    return stopper
+
+
+class LazyRegistry(Mapping):
+    """Mapping of language code to a value that is only built the
+    first time it is looked up.
+
+    The keys are the known language codes, so membership tests and
+    len() load nothing, while items() and values() load every
+    language.  Built values are kept in *loaded*.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.loaded = {}
+
+    def __getitem__(self, code):
+        try:
+            return self.loaded[code]
+        except KeyError:
+            if code not in languages:
+                raise
+        value = self.loaded[code] = self.loader(code)
+        return value
+
+    def __contains__(self, code):
+        return code in languages
 
+    def __iter__(self):
+        return iter(languages)
 
+    def __len__(self):
+        return len(languages)
 
 
+stopwords = LazyRegistry(_load_stopwords)
 
+stoppers = LazyRegistry(_load_stopper)
@@ -1,6 +1,6 @@
-from collections import OrderedDict
-
-# LRUDict is cargoed from Idealist.org
+import sys
+import time
+import threading
 
 
 class lazy_property(object):
@@ -18,31 +18,225 @@ class lazy_property(object):
         return result
 
 
-class LRUDict(OrderedDict):
-    """
-    A simple data structure to provide item ordering based on usage for a
-    limited dictionary size. The last item in the dictionary will always be
-    considered the most recently used. By the same logic, the item at the front
-    will be the least recently used. If the dictionary is filled beyond the
-    limit, items at the front of the list will be discarded.
+_PREV, _NEXT, _KEY, _VALUE, _SIZE, _EXPIRES = range(6)
+
+
+def sizeof(value):
+    """The default size in bytes of a cached value: the length of
+    strings, and sys.getsizeof of anything else."""
+    if isinstance(value, basestring):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+class LRUCache(object):
+    """A least recently used cache.
+
+    Entries are kept in a dictionary of nodes of a circular doubly
+    linked list ordered from least to most recently used, so a hit
+    promotes its entry by relinking two nodes instead of re-inserting
+    the key, and an eviction unlinks the oldest node.
+
+    :param limit: The most entries kept, or None.
+
+    :param max_bytes: The most bytes kept, or None.  Entries are
+    counted at the size passed to set(), or the *sizeof* of their
+    value.
+
+    :param ttl: Seconds entries live for, or None.  set() can give an
+    entry its own ttl.  Expired entries are dropped when they are
+    looked up, and by purge_expired().
+
+    :param loader: Called with a missing key by get() and [], the
+    value it returns is cached and returned.
+
+    Hits, misses, evictions and expirations are counted, see stats().
+    Every operation holds a lock, except the loader.
     """
 
-    def __init__(self, items=(), limit=1000, on_cache_miss=None):
+    clock = staticmethod(time.time)
+
+    def __init__(self, items=(), limit=1000, max_bytes=None, ttl=None,
+                 loader=None, sizeof=sizeof, on_cache_miss=None):
         self.limit = limit
-        super(LRUDict, self).__init__(items)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.loader = loader or on_cache_miss
+        self.sizeof = sizeof
+        self.lock = threading.Lock()
+        self.clear()
+        if hasattr(items, 'items'):
+            items = items.items()
+        for key, value in items:
+            self[key] = value
 
-    def __setitem__(self, key, value):
-        if len(self) >= self.limit:
-            self.popitem()
-        super(LRUDict, self).__setitem__(key, value)
+    def clear(self):
+        with self.lock:
+            self.map = {}
+            self.root = root = []
+            root[:] = [root, root, None, None, 0, None]
+            self.size = 0
+            self.hits = self.misses = 0
+            self.evictions = self.expirations = 0
 
-    def __getitem__(self, key):
-        item = dict.pop(self, key)
-        self[key] = item
-        return item
+    def _unlink(self, node):
+        prev, next = node[_PREV], node[_NEXT]
+        prev[_NEXT] = next
+        next[_PREV] = prev
+
+    def _append(self, node):
+        root = self.root
+        last = root[_PREV]
+        node[_PREV] = last
+        node[_NEXT] = root
+        last[_NEXT] = root[_PREV] = node
+
+    def _remove(self, node):
+        self._unlink(node)
+        del self.map[node[_KEY]]
+        self.size -= node[_SIZE]
+
+    def _lookup(self, key):
+        """Return the live node of *key*, promoted, or None."""
+        node = self.map.get(key)
+        if node is None:
+            self.misses += 1
+            return None
+        if node[_EXPIRES] is not None and node[_EXPIRES] <= self.clock():
+            self._remove(node)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.hits += 1
+        root = self.root
+        if node[_NEXT] is not root:
+            self._unlink(node)
+            self._append(node)
+        return node
 
     def get(self, key, default=None):
-        try:
-            return self[key]
-        except KeyError:
+        with self.lock:
+            node = self._lookup(key)
+            if node is not None:
+                return node[_VALUE]
+        if self.loader is None:
             return default
+        value = self.loader(key)
+        self.set(key, value)
+        return value
+
+    def __getitem__(self, key):
+        with self.lock:
+            node = self._lookup(key)
+            if node is not None:
+                return node[_VALUE]
+        if self.loader is None:
+            raise KeyError(key)
+        value = self.loader(key)
+        self.set(key, value)
+        return value
+
+    def set(self, key, value, size=None, ttl=None):
+        """Cache *value* under *key*, evicting the least recently used
+        entries over the limits.  A value bigger than max_bytes on its
+        own is not cached."""
+        if self.max_bytes is None:
+            size = 0
+        elif size is None:
+            size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            self.pop(key, None)
+            return
+        if ttl is None:
+            ttl = self.ttl
+        expires = self.clock() + ttl if ttl is not None else None
+        with self.lock:
+            node = self.map.get(key)
+            if node is not None:
+                self._remove(node)
+            node = [None, None, key, value, size, expires]
+            self._append(node)
+            self.map[key] = node
+            self.size += size
+            self._evict()
+
+    __setitem__ = set
+
+    def _evict(self):
+        root = self.root
+        while ((self.limit is not None and len(self.map) > self.limit) or
+               (self.max_bytes is not None and self.size > self.max_bytes)):
+            self._remove(root[_NEXT])
+            self.evictions += 1
+
+    def pop(self, key, *default):
+        with self.lock:
+            node = self.map.get(key)
+            if node is not None:
+                self._remove(node)
+                return node[_VALUE]
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def __contains__(self, key):
+        """Whether *key* has a live entry.  Does not promote it or
+        count a hit or miss."""
+        node = self.map.get(key)
+        return node is not None and (node[_EXPIRES] is None or
+                                     node[_EXPIRES] > self.clock())
+
+    def __len__(self):
+        return len(self.map)
+
+    def _nodes(self):
+        with self.lock:
+            nodes = []
+            root = self.root
+            node = root[_NEXT]
+            while node is not root:
+                nodes.append(node)
+                node = node[_NEXT]
+            return nodes
+
+    def keys(self):
+        """The keys from least to most recently used."""
+        return [node[_KEY] for node in self._nodes()]
+
+    def values(self):
+        return [node[_VALUE] for node in self._nodes()]
+
+    def items(self):
+        return [(node[_KEY], node[_VALUE]) for node in self._nodes()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def purge_expired(self):
+        """Drop every expired entry."""
+        now = self.clock()
+        with self.lock:
+            for node in self.map.values():
+                if node[_EXPIRES] is not None and node[_EXPIRES] <= now:
+                    self._remove(node)
+                    self.expirations += 1
+
+    def stats(self):
+        """Return the cache's size and counters as a dictionary."""
+        lookups = self.hits + self.misses
+        return dict(entries=len(self.map),
+                    limit=self.limit,
+                    bytes=self.size,
+                    max_bytes=self.max_bytes,
+                    hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    expirations=self.expirations,
+                    hit_rate=self.hits / float(lookups) if lookups else 0.0)
+
+
+# the old name of LRUCache
+LRUDict = LRUCache
@@ -0,0 +1,87 @@
+"""
+Date bucket terms.
+
+Date and DateTime elements can index their value at several
+resolutions at once, for example the term 'published:2011' for the
+year, 'published:201103' for the month and 'published:20110304' for
+the day.  A range of dates can then be covered by the fewest such
+bucket terms, so that a filter on a large range becomes a union of a
+handful of boolean posting lists instead of a scan of value streams:
+
+  >>> buckets(date(2010, 11, 30), date(2012, 1, 2))
+  ['20101130', '201012', '2011', '20120101', '20120102']
+
+"""
+from datetime import date, datetime, timedelta
+
+
+resolutions = {
+    'year': '%Y',
+    'month': '%Y%m',
+    'day': '%Y%m%d',
+    'hour': '%Y%m%d%H',
+    }
+"""Term formats for each supported resolution."""
+
+order = ('year', 'month', 'day', 'hour')
+"""Resolutions from coarsest to finest."""
+
+
+def _as_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime(value.year, value.month, value.day)
+
+
+def _floor(value, resolution):
+    if resolution == 'year':
+        return datetime(value.year, 1, 1)
+    elif resolution == 'month':
+        return datetime(value.year, value.month, 1)
+    elif resolution == 'day':
+        return datetime(value.year, value.month, value.day)
+    return datetime(value.year, value.month, value.day, value.hour)
+
+
+def _next(value, resolution):
+    """Return the start of the bucket following the one that starts
+    at *value*."""
+    if resolution == 'year':
+        return datetime(value.year + 1, 1, 1)
+    elif resolution == 'month':
+        if value.month == 12:
+            return datetime(value.year + 1, 1, 1)
+        return datetime(value.year, value.month + 1, 1)
+    elif resolution == 'day':
+        return value + timedelta(days=1)
+    return value + timedelta(hours=1)
+
+
+def buckets(begin, end, use=('year', 'month', 'day')):
+    """Return the fewest bucket values that exactly cover the dates
+    from *begin* to *end*, inclusive.
+
+    :param begin: a date or datetime, start of the range.
+
+    :param end: a date or datetime, end of the range.  The bucket of
+    the finest resolution that contains *end* is included.
+
+    :param use: the resolutions to draw buckets from.  These must be
+    resolutions that the element was indexed with.
+    """
+    known = [r for r in order if r in use]
+    if not known:
+        raise ValueError('No known resolutions in %r' % (use,))
+    finest = known[-1]
+    cursor = _floor(_as_datetime(begin), finest)
+    stop = _next(_floor(_as_datetime(end), finest), finest)
+
+    values = []
+    while cursor < stop:
+        for resolution in known:
+            if (_floor(cursor, resolution) == cursor and
+                _next(cursor, resolution) <= stop):
+                break
+        values.append(cursor.strftime(resolutions[resolution]))
+        cursor = _next(cursor, resolution)
+    return values
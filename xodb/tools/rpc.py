@@ -1,4 +1,13 @@
+import os
 import sys
+import json
+import time
+import errno
+import signal
+import socket
+import logging
+import itertools
+import BaseHTTPServer
 
 ADDRESS = 'localhost'
 
@@ -32,3 +41,238 @@ def run_server(database, address=ADDRESS, port=PORT,
                passthrough_errors=errors_fatal,
                )
 
+
+
+STREAMED = frozenset(['query', 'suggest', 'allterms'])
+"""Methods whose results are sent a piece at a time as they are
+read from the database."""
+
+METHODS = STREAMED | frozenset(['count', 'estimate', 'facet', 'expand',
+                                'spell', 'describe_query', 'term_freq'])
+
+WORKERS = 4
+
+KEEPALIVE_TIMEOUT = 5
+
+RESPAWN_DELAY = 0.1
+"""Seconds to wait before replacing a worker that died."""
+
+CHUNK_SIZE = 65536
+"""Bytes of a streamed response buffered before they are sent."""
+
+
+def json_default(obj):
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    raise TypeError('%r is not JSON serializable' % obj)
+
+
+encoder = json.JSONEncoder(separators=(',', ':'), default=json_default)
+
+
+def plain(item):
+    """Turn a search Record into a dictionary, pass anything else
+    through."""
+    from xodb.database import Record
+    if isinstance(item, Record):
+        return dict(docid=item._id,
+                    percent=item._xodb_percent,
+                    rank=item._xodb_rank,
+                    weight=item._xodb_weight,
+                    data=item._xodb_schema.value)
+    return item
+
+
+def iter_response(request_id, items):
+    """Yield the JSON of a response whose result is the list of
+    *items*, an item at a time."""
+    yield '{"id":%s,"error":null,"result":[' % encoder.encode(request_id)
+    separator = ''
+    for item in items:
+        yield separator + encoder.encode(plain(item))
+        separator = ','
+    yield ']}'
+
+
+class RPCHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers JSON-RPC requests POSTed over keep-alive HTTP/1.1
+    connections.  The server's *database* is read-only and belongs to
+    this process."""
+
+    protocol_version = 'HTTP/1.1'
+
+    timeout = KEEPALIVE_TIMEOUT
+
+    def do_POST(self):
+        request_id = None
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            request = json.loads(self.rfile.read(length))
+            request_id = request.get('id')
+            method, params = request['method'], request.get('params', [])
+            if method not in METHODS:
+                raise AttributeError('No method %r' % method)
+            args, kwargs = (params, {}) if isinstance(params, list) else (
+                (), dict((str(k), v) for k, v in params.items()))
+            result = getattr(self.server.database, method)(*args, **kwargs)
+            if method in STREAMED:
+                # most errors surface on the first item, before the
+                # response has started
+                result = iter(result)
+                first = list(itertools.islice(result, 1))
+                result = itertools.chain(first, result)
+        except Exception, e:
+            logging.exception('Error handling %s' % self.path)
+            self.send_json(dict(id=request_id, result=None,
+                                error=dict(name=type(e).__name__,
+                                           message=str(e))))
+            return
+        if method in STREAMED:
+            self.send_stream(iter_response(request_id, result))
+        else:
+            self.send_json(dict(id=request_id, result=plain(result),
+                                error=None))
+
+    def send_json(self, response):
+        body = encoder.encode(response)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, pieces):
+        """Send a chunked response made of the strings in *pieces*."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        buffered = []
+        size = 0
+        try:
+            for piece in pieces:
+                buffered.append(piece)
+                size += len(piece)
+                if size >= CHUNK_SIZE:
+                    self.write_chunk(''.join(buffered))
+                    buffered, size = [], 0
+        except Exception:
+            # the client sees the response end without its last chunk
+            logging.exception('Error streaming %s' % self.path)
+            self.close_connection = 1
+            return
+        if buffered:
+            self.write_chunk(''.join(buffered))
+        self.wfile.write('0\r\n\r\n')
+
+    def write_chunk(self, data):
+        self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+
+    def log_message(self, format, *args):
+        logging.debug('%s %s' % (self.address_string(), format % args))
+
+
+class PreforkServer(object):
+    """A JSON-RPC server that forks *workers* processes to answer
+    requests on one listening socket.
+
+    Each process opens its own read-only database at *path* after it
+    is forked, so no database is ever shared between processes or
+    threads, and serves one keep-alive connection at a time.  A
+    connection that is idle for *keepalive_timeout* seconds is closed
+    to free its process for other clients.  Processes that die are
+    replaced.
+    """
+
+    def __init__(self, path, address=ADDRESS, port=PORT, workers=WORKERS,
+                 keepalive_timeout=KEEPALIVE_TIMEOUT, backlog=128):
+        self.path = path
+        self.address = address
+        self.port = port
+        self.workers = workers
+        self.keepalive_timeout = keepalive_timeout
+        self.backlog = backlog
+        self.children = set()
+        self.running = False
+        self.socket = None
+
+    def run(self):
+        """Fork the workers and replace them as they die, until the
+        server gets a SIGTERM or SIGINT."""
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.address, self.port))
+        self.socket.listen(self.backlog)
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        print >> sys.stderr, " * Listening on %s:%s with %s workers." % (
+            self.address, self.port, self.workers)
+        try:
+            while self.running:
+                while len(self.children) < self.workers:
+                    self.spawn()
+                try:
+                    pid, status = os.wait()
+                except OSError, e:
+                    if e.errno != errno.EINTR:
+                        raise
+                    continue
+                if pid in self.children:
+                    self.children.discard(pid)
+                    if self.running:
+                        logging.warning('Worker %s exited with %s' %
+                                        (pid, status))
+                        # don't spin if workers can't start at all
+                        time.sleep(RESPAWN_DELAY)
+        finally:
+            for pid in self.children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            for pid in self.children:
+                try:
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+            self.children.clear()
+            self.socket.close()
+
+    def stop(self, signum=None, frame=None):
+        self.running = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return pid
+        status = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            self.serve()
+        except Exception:
+            logging.exception('Error in worker %s' % os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def serve(self):
+        """Open the database and answer requests, in a worker."""
+        import xodb
+        class Handler(RPCHandler):
+            timeout = self.keepalive_timeout
+
+        server = BaseHTTPServer.HTTPServer(
+            (self.address, self.port), Handler, bind_and_activate=False)
+        server.socket.close()
+        server.socket = self.socket
+        server.database = xodb.open(self.path, writable=False)
+        server.serve_forever()
+
+
+def run_prefork(path, address=ADDRESS, port=PORT, workers=WORKERS,
+                keepalive_timeout=KEEPALIVE_TIMEOUT):
+    """Serve the database at *path* with a PreforkServer."""
+    PreforkServer(path, address, port, workers, keepalive_timeout).run()
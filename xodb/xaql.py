@@ -1,5 +1,3 @@
-import pyparsing
-
 """
 The query language that won't die.
 
@@ -14,27 +12,41 @@ Syntax:
 
       term term term ...
 
-    This expands to '(term AND term AND term AND ...)'
+    This expands to '(term AND term AND term AND ...)', or whatever
+    default operator the query is compiled with.  AND binds tighter
+    than the default operator, and OR looser than both.  The operators
+    are recognized in any case.  A term preceded by a minus is excluded
+    like NOT term, one preceded by a plus is required even when the
+    default operator is OR.  An empty query or group matches nothing.
 
     Terms can be prefixed.  The prefix and the value are separated by
-    colons.  Values that contain spaces must be double quoted.
+    colons.  Values that contain spaces must be double quoted, and are
+    searched as a phrase.  A prefix applies to every term of a group.
+
+      term color:blue name:"My Lagoon" color:(red OR green)
+
+    Prefixed values with two dots between their bounds are ranges of
+    the prefix's value, either bound can be left out:
 
-      term color:blue name:"My Lagoon"
+      salary:1000..5000 hired:2010..
 
 
 Functions:
 
     Functions provide features that take query input from the user and
     do some transformation on the query itself.  Functions begin with
-    a star, then a name, then a pair of parenthesis that contain the
-    query input.  The syntax of the input is up to the function:
+    a dollar sign, then a name, then a pair of parenthesis that contain
+    the query input.  The syntax of the input is up to the function:
 
     $xp(...) -- Pass the input string directly into the Xapian
      query parser.
 
-    $rel(...)
+    $rel(...) -- The query inside only adds to the relevance of the
+     documents matched by the rest of its group, it does not restrict
+     them.
 
-    $now
+    $now -- The current time, as a bound of a range or the value of
+     a prefix modifier: 'published:..$now'.
 
 
 Prefix Modifiers:
@@ -42,7 +54,457 @@ Prefix Modifiers:
   This are pre-prefixes that transform the following term.
 
     published-before:now
-    
+    published-after:20100101
 
+  'before' and 'after' compare a value with its bound, inclusively.
+
+
+Queries are parsed into an Expression by parse(), which caches them
+by text, and compiled straight to a xapian.Query by its compile()
+method against a database's prefixes and values.  Database.querify
+accepts expressions anywhere it accepts a query string, and caches
+their compiled queries like parsed strings, except for queries that
+use $now.
 """
+import re
+import time
+from collections import namedtuple
+
+import xapian
+from xapian import Query
+
+from . import snowball
+from .exc import QuerySyntaxError
+from .tools import LRUCache
+
+
+PARSE_CACHE_SIZE = 10000
+
+NOW = '$now'
+
+MODIFIERS = {'before': Query.OP_VALUE_LE,
+             'after': Query.OP_VALUE_GE}
+
+
+_token = re.compile(r'''
+    (?P<space>\s+)
+  | (?P<lparen>\()
+  | (?P<rparen>\))
+  | "(?P<phrase>[^"]*)"?
+  | \$(?P<function>\w+)
+  | (?P<prefix>\w[\w-]*):(?=[^\s)])
+  | (?P<sign>[+-])(?=[^\s)])
+  | (?P<word>[^\s()"]+)
+''', re.UNICODE | re.VERBOSE)
+
+_value = re.compile(r'[^\s()]+', re.UNICODE)
+
+_operators = {'and': 'and', 'or': 'or', 'not': 'not'}
+
+
+def tokenize(text):
+    """Return a list of (kind, value) tokens of a query."""
+    tokens = []
+    pos, end = 0, len(text)
+    while pos < end:
+        match = _token.match(text, pos)
+        kind = match.lastgroup
+        value = match.group(kind)
+        pos = match.end()
+        if kind == 'space':
+            continue
+        if kind == 'word':
+            kind = _operators.get(value.lower(), kind)
+        elif kind == 'prefix':
+            tokens.append((kind, value))
+            # the value of a prefix is one word including $ and the
+            # dots of ranges, unless it is a phrase or a group
+            if text[pos] not in '("':
+                match = _value.match(text, pos)
+                tokens.append(('value', match.group()))
+                pos = match.end()
+            continue
+        elif kind == 'function' and value == 'xp':
+            if text[pos:pos + 1] != '(':
+                raise QuerySyntaxError('$xp needs a (query)')
+            close = _closing_paren(text, pos)
+            tokens.append(('raw', text[pos + 1:close]))
+            pos = close + 1
+            continue
+        tokens.append((kind, value))
+    return tokens
+
+
+def _closing_paren(text, pos):
+    """Return the index of the parenthesis closing the one at *pos*,
+    skipping over quoted strings."""
+    depth = 0
+    quoted = False
+    for i in xrange(pos, len(text)):
+        char = text[i]
+        if char == '"':
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if not depth:
+                return i
+    raise QuerySyntaxError('Unbalanced parenthesis in %r' % text[pos:])
+
+
+class Term(namedtuple('Term', 'prefix value')):
+    __slots__ = ()
+
+
+class Phrase(namedtuple('Phrase', 'prefix words')):
+    __slots__ = ()
+
+
+class Range(namedtuple('Range', 'name begin end')):
+    __slots__ = ()
+
+
+class Compare(namedtuple('Compare', 'name modifier value')):
+    __slots__ = ()
+
+
+class Not(namedtuple('Not', 'operand')):
+    __slots__ = ()
+
+
+class Required(namedtuple('Required', 'operand')):
+    __slots__ = ()
+
+
+class Rel(namedtuple('Rel', 'operand')):
+    __slots__ = ()
+
+
+class Raw(namedtuple('Raw', 'text')):
+    __slots__ = ()
+
+
+class Group(namedtuple('Group', 'op operands')):
+    """Operands joined by 'and', 'or' or the 'default' operator."""
+    __slots__ = ()
+
+
+class Expression(namedtuple('Expression', 'root volatile')):
+    """A parsed query.  It is volatile if it uses $now, and must be
+    compiled again every time it is used."""
+    __slots__ = ()
+
+    def compile(self, db, language=None, default_op=Query.OP_AND):
+        """Return the xapian.Query of the expression for *db*."""
+        return Compiler(db, language, default_op).compile(self.root)
+
+
+class Parser(object):
+    """A recursive descent parser of a list of tokens."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+        self.volatile = False
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos][0]
+        return None
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def expect(self, kind):
+        if self.peek() != kind:
+            raise QuerySyntaxError('Expected %s, got %s' %
+                                   (kind, self.peek() or 'the end'))
+        return self.next()[1]
+
+    def parse(self):
+        root = self.parse_or(None)
+        if self.peek() is not None:
+            raise QuerySyntaxError('Unexpected %s' % self.peek())
+        return Expression(root, self.volatile)
+
+    def parse_or(self, prefix):
+        operands = [self.parse_default(prefix)]
+        while self.peek() == 'or':
+            self.next()
+            operands.append(self.parse_default(prefix))
+        return operands[0] if len(operands) == 1 else Group('or',
+                                                            tuple(operands))
+
+    def parse_default(self, prefix):
+        operands = []
+        while self.peek() not in (None, 'rparen', 'or'):
+            operands.append(self.parse_and(prefix))
+        if len(operands) == 1:
+            return operands[0]
+        return Group('default', tuple(operands))
+
+    def parse_and(self, prefix):
+        operands = [self.parse_unary(prefix)]
+        while self.peek() == 'and':
+            self.next()
+            operands.append(self.parse_unary(prefix))
+        return operands[0] if len(operands) == 1 else Group('and',
+                                                            tuple(operands))
+
+    def parse_unary(self, prefix):
+        kind = self.peek()
+        if kind == 'not':
+            self.next()
+            return Not(self.parse_unary(prefix))
+        if kind == 'sign':
+            sign = self.next()[1]
+            operand = self.parse_atom(prefix)
+            return Not(operand) if sign == '-' else Required(operand)
+        return self.parse_atom(prefix)
+
+    def parse_atom(self, prefix):
+        kind = self.peek()
+        if kind is None:
+            raise QuerySyntaxError('Unexpected end of query')
+        kind, value = self.next()
+        if kind == 'lparen':
+            group = self.parse_or(prefix)
+            self.expect('rparen')
+            return group
+        if kind == 'phrase':
+            return phrase(prefix, value)
+        if kind == 'word':
+            return Term(prefix, value.lower())
+        if kind == 'prefix':
+            return self.parse_prefixed(value)
+        if kind == 'function':
+            return self.parse_function(value, prefix)
+        if kind == 'raw':
+            return Raw(value)
+        raise QuerySyntaxError('Unexpected %s' % kind)
+
+    def parse_prefixed(self, name):
+        kind = self.peek()
+        if kind == 'lparen':
+            return self.parse_atom(name)
+        if kind == 'phrase':
+            return phrase(name, self.next()[1])
+        value = self.expect('value')
+        field, _, modifier = name.rpartition('-')
+        if field and modifier in MODIFIERS:
+            return Compare(field, modifier, self.bound(value, 'now'))
+        if '..' in value:
+            begin, _, end = value.partition('..')
+            if '..' in end or not (begin or end):
+                raise QuerySyntaxError('Bad range %s:%s' % (name, value))
+            return Range(name, self.bound(begin), self.bound(end))
+        return Term(name, value.lower())
+
+    def parse_function(self, name, prefix):
+        if name == 'rel':
+            if self.peek() != 'lparen':
+                raise QuerySyntaxError('$rel needs a (query)')
+            return Rel(self.parse_atom(prefix))
+        if name == 'now':
+            raise QuerySyntaxError('$now is only a range bound')
+        raise QuerySyntaxError('Unknown function $%s' % name)
+
+    def bound(self, value, *now):
+        if value == NOW or value in now:
+            self.volatile = True
+            return NOW
+        return value or None
+
+
+def phrase(prefix, text):
+    words = tuple(text.lower().split())
+    if not words:
+        return Group('default', ())
+    if len(words) == 1:
+        return Term(prefix, words[0])
+    return Phrase(prefix, words)
+
+
+def _parse(text):
+    if isinstance(text, str):
+        text = text.decode('utf-8')
+    return Parser(tokenize(text)).parse()
+
+
+parse_cache = LRUCache(limit=PARSE_CACHE_SIZE, loader=_parse)
+
+
+def parse(text):
+    """Return the Expression of a query string, from the cache if it
+    was parsed before."""
+    return parse_cache[text]
+
+
+def serializers(sort):
+    """Return the serializers of the begin and end bounds of a range
+    of values sorted as *sort*, the same way Database's query parsers
+    serialize them."""
+    if sort in ('integer', 'float'):
+        return ((lambda value: xapian.sortable_serialise(float(value))),) * 2
+    if sort == 'datetime':
+        return ((lambda value: value + '0' * (14 - len(value))),
+                (lambda value: value + '9' * (14 - len(value))))
+    return (str, str)
+
+
+def now(sort):
+    """The current time as a value sorted as *sort*."""
+    if sort in ('integer', 'float'):
+        return time.time()
+    if sort == 'date':
+        return time.strftime('%Y%m%d')
+    return time.strftime('%Y%m%d%H%M%S')
+
+
+class Compiler(object):
+    """Compiles expression trees into xapian queries.
+
+    Words are stemmed the way QueryParser's STEM_SOME strategy does for
+    the languages the database has stemmers for, boolean prefixed
+    terms add no weight, and prefixes the database does not know use
+    xodb's own 'XNAME:' convention.
+    """
+
+    def __init__(self, db, language, default_op):
+        self.db = db
+        self.language = language
+        self.default_op = default_op
+        if language in snowball.stoppers:
+            self.stemmer = xapian.Stem(language)
+        else:
+            self.stemmer = None
+
+    def compile(self, node):
+        return getattr(self, 'compile_' + type(node).__name__)(node)
+
+    def prefix(self, name):
+        """Return the term prefix of a prefix name, and whether it is
+        boolean."""
+        if name is None:
+            return '', False
+        prefix = self.db.boolean_prefixes.get(name)
+        if prefix is not None:
+            return prefix, True
+        prefix = self.db.relevance_prefixes.get(name)
+        if prefix is not None:
+            return prefix, False
+        return 'X%s:' % name.upper().encode('utf-8'), True
+
+    def compile_Term(self, node):
+        prefix, boolean = self.prefix(node.prefix)
+        value = node.value.encode('utf-8')
+        if boolean:
+            return Query(Query.OP_SCALE_WEIGHT, Query(prefix + value), 0)
+        if self.stemmer is not None:
+            return Query('Z' + prefix + self.stemmer(value))
+        return Query(prefix + value)
+
+    def compile_Phrase(self, node):
+        prefix, boolean = self.prefix(node.prefix)
+        if boolean:
+            # boolean values are indexed whole
+            return self.compile(Term(node.prefix, u' '.join(node.words)))
+        return Query(Query.OP_PHRASE,
+                     [prefix + word.encode('utf-8') for word in node.words])
+
+    def value(self, name):
+        valno = self.db.values.get(name)
+        if valno is None:
+            raise QuerySyntaxError('%s is not a value' % name)
+        return valno, self.db.value_sorts.get(name)
+
+    def bound(self, value, sort, serializer):
+        if value == NOW:
+            value = now(sort)
+            if sort in ('integer', 'float'):
+                return xapian.sortable_serialise(value)
+            return value
+        try:
+            return serializer(value.encode('utf-8'))
+        except ValueError:
+            raise QuerySyntaxError('Bad %s bound %s' % (sort, value))
+
+    def compile_Range(self, node):
+        valno, sort = self.value(node.name)
+        begin, end = serializers(sort)
+        if node.begin is None and node.end is None:
+            raise QuerySyntaxError('Range of %s has no bounds' % node.name)
+        if node.begin is None:
+            return Query(Query.OP_VALUE_LE, valno,
+                         self.bound(node.end, sort, end))
+        if node.end is None:
+            return Query(Query.OP_VALUE_GE, valno,
+                         self.bound(node.begin, sort, begin))
+        return Query(Query.OP_VALUE_RANGE, valno,
+                     self.bound(node.begin, sort, begin),
+                     self.bound(node.end, sort, end))
+
+    def compile_Compare(self, node):
+        valno, sort = self.value(node.name)
+        op = MODIFIERS[node.modifier]
+        serializer = serializers(sort)[op == Query.OP_VALUE_LE]
+        return Query(op, valno, self.bound(node.value, sort, serializer))
+
+    def compile_Raw(self, node):
+        return self.db.querify(node.text, self.language,
+                               default_op=self.default_op)
+
+    def compile_Not(self, node):
+        return self.compile(Group('and', (node,)))
+
+    def compile_Required(self, node):
+        return self.compile(node.operand)
+
+    def compile_Rel(self, node):
+        return self.compile(node.operand)
 
+    def compile_Group(self, node):
+        required, optional, excluded, relevant = [], [], [], []
+        for operand in node.operands:
+            kind = type(operand)
+            if kind is Not:
+                queries, operand = excluded, operand.operand
+            elif kind is Rel:
+                queries, operand = relevant, operand.operand
+            elif kind is Required or node.op == 'and' or (
+                node.op == 'default' and self.default_op == Query.OP_AND):
+                queries = required
+            elif node.op == 'or' or self.default_op == Query.OP_OR:
+                queries = optional
+            else:
+                queries = required
+            query = self.compile(operand)
+            # empty groups and phrases add nothing to their group
+            if not query.empty():
+                queries.append(query)
+        if required:
+            query = Query(Query.OP_AND, required)
+            if optional:
+                query = Query(Query.OP_AND_MAYBE, query,
+                              Query(Query.OP_OR, optional))
+        elif optional:
+            query = Query(Query.OP_OR, optional)
+        elif relevant and not excluded:
+            return Query(Query.OP_OR, relevant)
+        elif excluded:
+            query = Query('')
+        else:
+            # an empty query matches nothing
+            return Query()
+        if excluded:
+            query = Query(Query.OP_AND_NOT, query,
+                          Query(Query.OP_OR, excluded))
+        if relevant:
+            query = Query(Query.OP_AND_MAYBE, query,
+                          Query(Query.OP_OR, relevant))
+        return query